@@ -0,0 +1,242 @@
+"""Async BoxMedia endpoints for the ASGI application
+
+They mirror BoxMediaViewSet's retrieve, create, update and destroy, but
+every S3 call goes through aioboto3, so a slow transfer only parks a
+coroutine instead of pinning a whole worker. The Procfile serves the
+project through its ASGI application; under WSGI every request would run
+on a new event loop and leave an aioboto3 client open, so these views
+refuse WSGI requests.
+"""
+
+import functools
+import logging
+
+from asgiref.sync import sync_to_async
+from botocore.exceptions import ClientError
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (
+    HttpResponse,
+    HttpResponseNotAllowed,
+    JsonResponse,
+)
+from rest_framework import status
+
+from box.aws_utils.async_s3_utils import AsyncS3FileManager, aiter_body_chunks
+from box.aws_utils.media_cache import media_cache
+from box.aws_utils.s3_utils import MB
+from box.blobs import asave_media_file
+from box.conditional import not_modified_response
+from box.models import Box, BoxMedia, RepoAccess
+from box.serializers import BoxMediaSerializer
+from box.streaming import (
+    format_range,
+    if_range_conditions,
+    parse_range_header,
+    range_not_satisfiable,
+    s3_object_response,
+)
+from box.views import (
+    box_id_from_body,
+    get_max_filesize_mb,
+    user_has_repo_admin_access,
+)
+from user.authentication import authenticate_request
+
+logger = logging.getLogger(__name__)
+
+ADMIN_ACCESS = [
+    RepoAccess.REPO_ACCESS_TYPE_ADMIN,
+    RepoAccess.REPO_ACCESS_TYPE_OWNER,
+]
+VIEW_ACCESS = ADMIN_ACCESS + [RepoAccess.REPO_ACCESS_TYPE_VIEWER]
+
+
+def _msg(msg, status_code):
+    return JsonResponse({"msg": msg}, status=status_code)
+
+
+def _file_too_large(max_filesize_mb):
+    return JsonResponse(
+        {
+            "msg": f"Max size of file is {max_filesize_mb} MB",
+            "max_size": f"{max_filesize_mb} MB",
+        },
+        status=status.HTTP_400_BAD_REQUEST,
+    )
+
+
+async def _authenticate(request):
+    """Run the viewsets' authentication classes; returns the user or None"""
+    user = await sync_to_async(authenticate_request)(request)
+    if user is not None:
+        request.user = user
+    return user
+
+
+async def _has_access(request, repo_id, required_access):
+    return await sync_to_async(user_has_repo_admin_access)(
+        request.user, repo_id, required_access=required_access, request=request
+    )
+
+
+def _parse_multipart(request):
+    """Django only parses POST bodies, so PUT uploads are parsed here"""
+    if request.method == "POST":
+        return request.POST, request.FILES
+    return request.parse_file_upload(request.META, request)
+
+
+def _csrf_exempt(view):
+    """Token-authenticated like the viewsets, so CSRF does not apply
+
+    Django's csrf_exempt wraps views in a sync function before 5.0, which
+    would hand the handler an unawaited coroutine.
+    """
+    view.csrf_exempt = True
+    return view
+
+
+def _asgi_only(view):
+    @functools.wraps(view)
+    async def asgi_view(request, *args, **kwargs):
+        if not isinstance(request, ASGIRequest):
+            return _msg(
+                "Only served by the ASGI application",
+                status.HTTP_501_NOT_IMPLEMENTED,
+            )
+        return await view(request, *args, **kwargs)
+
+    return asgi_view
+
+
+def _is_missing(error):
+    return error.response["Error"]["Code"] in ("NoSuchKey", "404")
+
+
+@_csrf_exempt
+@_asgi_only
+async def box_media_list(request):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    if await _authenticate(request) is None:
+        return _msg("Invalid or missing token", status.HTTP_401_UNAUTHORIZED)
+    data, files = await sync_to_async(_parse_multipart)(request)
+
+    box_id = box_id_from_body(data)
+    if box_id is None:
+        return _msg("box must be the id of a box", status.HTTP_400_BAD_REQUEST)
+    box = await Box.objects.filter(id=box_id).afirst()
+    if box is None:
+        return _msg("Box not found", status.HTTP_404_NOT_FOUND)
+    if not await _has_access(request, box.repo_id, ADMIN_ACCESS):
+        return _msg("Not authorized to perform action", status.HTTP_401_UNAUTHORIZED)
+    if not files.get("file", False):
+        return _msg("file key is missing in body", status.HTTP_400_BAD_REQUEST)
+    if "file_name" not in data:
+        return _msg("file_name is missing in body", status.HTTP_400_BAD_REQUEST)
+    received_file = files.getlist("file")[0]
+    max_filesize_mb = await sync_to_async(get_max_filesize_mb)(request.user)
+    if received_file.size > max_filesize_mb * MB:
+        return _file_too_large(max_filesize_mb)
+
+    box_media = await BoxMedia.objects.acreate(
+        user=request.user, box=box, file_name=data["file_name"]
+    )
+    await asave_media_file(AsyncS3FileManager(), box_media, received_file)
+    return JsonResponse(
+        BoxMediaSerializer(box_media).data, status=status.HTTP_201_CREATED
+    )
+
+
+@_csrf_exempt
+@_asgi_only
+async def box_media_detail(request, pk):
+    if request.method not in ("GET", "PUT", "DELETE"):
+        return HttpResponseNotAllowed(["GET", "PUT", "DELETE"])
+    if await _authenticate(request) is None:
+        return _msg("Invalid or missing token", status.HTTP_401_UNAUTHORIZED)
+    box_media = await BoxMedia.objects.select_related("box").filter(pk=pk).afirst()
+    if box_media is None:
+        return _msg("Not found", status.HTTP_404_NOT_FOUND)
+    if request.method == "GET":
+        return await _retrieve(request, box_media)
+    if request.method == "PUT":
+        return await _update(request, box_media)
+    return await _destroy(request, box_media)
+
+
+async def _retrieve(request, box_media):
+    if not await _has_access(request, box_media.box.repo_id, VIEW_ACCESS):
+        return _msg("Not authorized to perform action", status.HTTP_401_UNAUTHORIZED)
+    if box_media.upload_status != BoxMedia.UPLOAD_STATUS_COMPLETE:
+        return _msg("File upload has not been finalized", status.HTTP_409_CONFLICT)
+    if box_media.etag:
+        not_modified = not_modified_response(
+            request, box_media.etag, box_media.updated_at
+        )
+        if not_modified is not None:
+            return not_modified
+
+    s3 = AsyncS3FileManager()
+    key = box_media.s3_bucket_file_path
+    try:
+        s3_object = await _get_object(s3, key, request)
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "InvalidRange":
+            head = await s3.head_file(key)
+            return range_not_satisfiable(head["ContentLength"])
+        if not _is_missing(error):
+            raise
+        return _msg("File not found in storage", status.HTTP_404_NOT_FOUND)
+    return s3_object_response(s3_object, body=aiter_body_chunks(s3_object["Body"]))
+
+
+async def _get_object(s3, key, request):
+    """Fetch the object, or the single byte range the request asks for
+
+    Multi-range requests get the whole object, which RFC 9110 allows.
+    """
+    ranges = parse_range_header(request.META.get("HTTP_RANGE"))
+    conditions = if_range_conditions(request.META.get("HTTP_IF_RANGE"))
+    if not ranges or len(ranges) > 1 or conditions is None:
+        return await s3.get_file_object(key)
+    try:
+        return await s3.get_file_object(
+            key, byte_range=format_range(*ranges[0]), **conditions
+        )
+    except ClientError as error:
+        if error.response["Error"]["Code"] not in ("PreconditionFailed", "412"):
+            raise
+        return await s3.get_file_object(key)
+
+
+async def _update(request, box_media):
+    if not await _has_access(request, box_media.box.repo_id, ADMIN_ACCESS):
+        return _msg("Not authorized to perform action", status.HTTP_401_UNAUTHORIZED)
+    data, files = await sync_to_async(_parse_multipart)(request)
+    if not files.get("file", False):
+        return _msg("file key is missing in body", status.HTTP_400_BAD_REQUEST)
+    received_file = files.getlist("file")[0]
+    max_filesize_mb = await sync_to_async(get_max_filesize_mb)(request.user)
+    if received_file.size > max_filesize_mb * MB:
+        return _file_too_large(max_filesize_mb)
+
+    box_media.file_name = data.get("file_name", box_media.file_name)
+    await asave_media_file(
+        AsyncS3FileManager(), box_media, received_file, update_fields=["file_name"]
+    )
+    return JsonResponse(BoxMediaSerializer(box_media).data, status=status.HTTP_200_OK)
+
+
+async def _destroy(request, box_media):
+    logger.info(f"""Attempting to destroy {box_media}""")
+    if not await _has_access(request, box_media.box.repo_id, ADMIN_ACCESS):
+        return _msg("Not authorized to perform action", status.HTTP_401_UNAUTHORIZED)
+    if not box_media.blob_id:
+        # Shared blobs are released when the row is deleted
+        s3 = AsyncS3FileManager()
+        await s3.delete_file(key=box_media.s3_bucket_file_path)
+        media_cache.invalidate(box_media.s3_bucket_file_path)
+    await box_media.adelete()
+    logger.info(f"Successfully deleted {box_media}")
+    return HttpResponse(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import weakref
+
+import aioboto3
+from aiobotocore.config import AioConfig
+from asgiref.sync import sync_to_async
+
+from box.aws_utils.s3_utils import (
+    DOWNLOAD_CHUNK_SIZE,
+    MULTIPART_CONCURRENCY,
+    MULTIPART_PART_SIZE,
+    MULTIPART_THRESHOLD,
+    client_options,
+    session_credentials,
+)
+from box.instrumentation import instrument_s3_client
+
+logger = logging.getLogger(__name__)
+
+# One open client per event loop; aiohttp sessions cannot cross loops
+_clients = weakref.WeakKeyDictionary()
+
+
+def build_async_client_config():
+    return AioConfig(
+        connector_args={
+            "keepalive_timeout": float(os.getenv("S3_KEEPALIVE_TIMEOUT", 60)),
+        },
+        **client_options(),
+    )
+
+
+async def get_async_s3_client():
+    """Return the S3 client shared by every coroutine on the running loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        session = aioboto3.Session(**session_credentials())
+        client = await session.client(
+            "s3",
+            endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+            config=build_async_client_config(),
+        ).__aenter__()
+        instrument_s3_client(client)
+        # Another coroutine may have won the race while this one was awaiting
+        shared = _clients.setdefault(loop, client)
+        if shared is not client:
+            await client.close()
+            client = shared
+    return client
+
+
+async def close_async_s3_client():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+async def aiter_body_chunks(body, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Relay an aiobotocore StreamingBody in fixed-size chunks"""
+    async with body:
+        async for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+
+
+async def read_off_loop(file_content, size=-1):
+    """Read an upload in a worker thread; spooled uploads block on the disk"""
+    # Not thread sensitive, so reads do not queue behind ORM calls
+    return await sync_to_async(file_content.read, thread_sensitive=False)(size)
+
+
+class AsyncS3FileManager:
+    """asyncio counterpart of S3FileManager used by the ASGI media views"""
+
+    def __init__(self):
+        self.bucket_name = os.getenv("S3_BUCKET_NAME")
+
+    async def upload_file(self, key, file_content, content_type=None):
+        """Upload an object and return its ETag"""
+        size = getattr(file_content, "size", None)
+        if size is not None and size >= MULTIPART_THRESHOLD:
+            return await self.multipart_upload(key, file_content, content_type)
+        client = await get_async_s3_client()
+        extra = {"ContentType": content_type} if content_type else {}
+        if hasattr(file_content, "read"):
+            body = await read_off_loop(file_content)
+        else:
+            body = file_content
+        response = await client.put_object(
+            Bucket=self.bucket_name, Key=key, Body=body, **extra
+        )
+        return response["ETag"]
+
+    async def multipart_upload(
+        self,
+        key,
+        file_content,
+        content_type=None,
+        part_size=None,
+        concurrency=None,
+    ):
+        """Upload parts as concurrent tasks, aborting the upload on failure"""
+        part_size = part_size or MULTIPART_PART_SIZE
+        concurrency = concurrency or MULTIPART_CONCURRENCY
+        client = await get_async_s3_client()
+        extra = {"ContentType": content_type} if content_type else {}
+        upload_id = (
+            await client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=key, **extra
+            )
+        )["UploadId"]
+        in_flight = asyncio.Semaphore(concurrency)
+        failed = asyncio.Event()
+
+        async def upload_part(part_number, chunk):
+            try:
+                response = await client.upload_part(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=chunk,
+                )
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                in_flight.release()
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+        tasks = []
+        try:
+            part_number = 1
+            while not failed.is_set():
+                await in_flight.acquire()
+                chunk = await read_off_loop(file_content, part_size)
+                if not chunk:
+                    in_flight.release()
+                    break
+                tasks.append(asyncio.ensure_future(upload_part(part_number, chunk)))
+                part_number += 1
+            parts = await asyncio.gather(*tasks)
+            response = await client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            logger.exception(f"Aborting multipart upload of {key}")
+            for task in tasks:
+                task.cancel()
+            await client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id
+            )
+            raise
+        return response["ETag"]
+
+    async def delete_file(self, key):
+        client = await get_async_s3_client()
+        await client.delete_objects(
+            Bucket=self.bucket_name, Delete={"Objects": [{"Key": key}]}
+        )
+
+    async def get_file_object(
+        self, key, byte_range=None, if_match=None, if_unmodified_since=None
+    ):
+        """Return the S3 GetObject response without reading its body"""
+        client = await get_async_s3_client()
+        params = {"Bucket": self.bucket_name, "Key": key}
+        if byte_range:
+            params["Range"] = byte_range
+        if if_match:
+            params["IfMatch"] = if_match
+        if if_unmodified_since:
+            params["IfUnmodifiedSince"] = if_unmodified_since
+        return await client.get_object(**params)
+
+    async def head_file(self, key):
+        client = await get_async_s3_client()
+        return await client.head_object(Bucket=self.bucket_name, Key=key)
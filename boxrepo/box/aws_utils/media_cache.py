@@ -0,0 +1,303 @@
+"""On-disk read-through cache of S3 object bodies
+
+Each entry is one file per (key, version) holding a small JSON header with
+the object metadata followed by the body. The versions of a key share a
+subdirectory of MEDIA_CACHE_DIR, so invalidating a key only lists its own
+entries. Files are written under a temporary name and renamed into place,
+so every gunicorn worker on a host can share the directory without ever
+reading a half-written entry. A hit bumps the file's mtime and the least recently
+used files are evicted once the directory outgrows MEDIA_CACHE_MAX_MB.
+
+Each process keeps a running total of the directory's size, so a fill
+costs no directory scan. The total only counts the process's own fills,
+so it is resynchronised by a scan once it goes over the limit, and also
+every MEDIA_CACHE_RESCAN_FILLS fills to pick up the other workers' fills.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+from datetime import datetime
+
+from box.metrics import record_cache_lookup
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Unset disables the cache
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR") or None
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_MB", 1024)) * MB
+# Larger objects are streamed from S3 without being cached
+MEDIA_CACHE_MAX_OBJECT_BYTES = int(os.getenv("MEDIA_CACHE_MAX_OBJECT_MB", 16)) * MB
+MEDIA_CACHE_RESCAN_FILLS = int(os.getenv("MEDIA_CACHE_RESCAN_FILLS", 64))
+
+HEADER_LENGTH = struct.Struct(">I")
+TEMP_PREFIX = ".tmp-"
+METADATA_FIELDS = ("ContentLength", "ContentType", "ETag")
+
+
+def _digest(value):
+    return hashlib.sha256(str(value).encode("utf-8")).hexdigest()
+
+
+class CachedBody:
+    """A cache file exposed through the StreamingBody methods the views use"""
+
+    def __init__(self, file):
+        self._file = file
+
+    def read(self, amt=None):
+        return self._file.read(-1 if amt is None else amt)
+
+    def iter_chunks(self, chunk_size):
+        while True:
+            chunk = self._file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self._file.close()
+
+
+class TeeBody:
+    """Relays an S3 body while copying it into a new cache entry
+
+    The entry is only renamed into place once the whole body was read; a
+    transfer cut short by the client leaves nothing behind.
+    """
+
+    def __init__(self, cache, path, body, header, size):
+        self._cache = cache
+        self._path = path
+        self._body = body
+        self._size = size
+        self._written = 0
+        self._header_size = len(header)
+        try:
+            fd, self._temp_path = tempfile.mkstemp(
+                prefix=TEMP_PREFIX, dir=cache.directory
+            )
+            self._temp = os.fdopen(fd, "wb")
+            self._temp.write(header)
+        except OSError:
+            logger.exception("Could not open a media cache entry")
+            self._temp = None
+
+    def _copy(self, chunk):
+        if self._temp is None:
+            return
+        try:
+            self._temp.write(chunk)
+            self._written += len(chunk)
+        except OSError:
+            logger.exception("Could not write a media cache entry")
+            self._discard()
+
+    def read(self, amt=None):
+        chunk = self._body.read() if amt is None else self._body.read(amt)
+        self._copy(chunk)
+        return chunk
+
+    def iter_chunks(self, chunk_size):
+        for chunk in self._body.iter_chunks(chunk_size=chunk_size):
+            self._copy(chunk)
+            yield chunk
+
+    def _discard(self):
+        self._temp.close()
+        os.unlink(self._temp_path)
+        self._temp = None
+
+    def close(self):
+        self._body.close()
+        if self._temp is None:
+            return
+        if self._written != self._size:
+            self._discard()
+            return
+        self._temp.close()
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            os.replace(self._temp_path, self._path)
+        except FileNotFoundError:
+            # The key's directory was emptied and removed by an eviction
+            os.unlink(self._temp_path)
+            self._temp = None
+            return
+        self._temp = None
+        self._cache.record_fill(self._header_size + self._written)
+
+
+class MediaCache:
+    def __init__(
+        self,
+        directory,
+        max_bytes,
+        max_object_bytes,
+        rescan_fills=MEDIA_CACHE_RESCAN_FILLS,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.rescan_fills = rescan_fills
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # Size of the directory as of the last scan plus our fills since
+        self._total_bytes = None
+        self._fills_since_scan = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def _key_directory(self, key):
+        return os.path.join(self.directory, _digest(key))
+
+    def _path(self, key, version):
+        return os.path.join(self._key_directory(key), _digest(version)[:32])
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+        if counter in ("hits", "misses"):
+            record_cache_lookup("media", counter == "hits")
+
+    def get(self, key, version):
+        """Return a GetObject-shaped dict for a cached entry, or None"""
+        path = self._path(key, version)
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            self._count("misses")
+            return None
+        try:
+            (length,) = HEADER_LENGTH.unpack(file.read(HEADER_LENGTH.size))
+            metadata = json.loads(file.read(length))
+            os.utime(path)
+        except (OSError, ValueError, struct.error):
+            # Evicted while being opened, or not a cache entry
+            file.close()
+            self._count("misses")
+            return None
+        self._count("hits")
+        s3_object = {field: metadata.get(field) for field in METADATA_FIELDS}
+        if metadata.get("LastModified") is not None:
+            s3_object["LastModified"] = datetime.fromisoformat(metadata["LastModified"])
+        s3_object["Body"] = CachedBody(file)
+        return s3_object
+
+    def store(self, key, version, s3_object):
+        """Return s3_object with its body copied into the cache as it is read"""
+        size = s3_object["ContentLength"]
+        if size > self.max_object_bytes or s3_object.get("ContentRange"):
+            return s3_object
+        metadata = {field: s3_object.get(field) for field in METADATA_FIELDS}
+        if s3_object.get("LastModified") is not None:
+            metadata["LastModified"] = s3_object["LastModified"].isoformat()
+        encoded = json.dumps(metadata).encode("utf-8")
+        header = HEADER_LENGTH.pack(len(encoded)) + encoded
+        return {
+            **s3_object,
+            "Body": TeeBody(
+                self, self._path(key, version), s3_object["Body"], header, size
+            ),
+        }
+
+    def _scandir(self, directory):
+        try:
+            return list(os.scandir(directory))
+        except FileNotFoundError:
+            return []
+
+    def _entries(self):
+        for key_directory in self._scandir(self.directory):
+            if key_directory.name.startswith(TEMP_PREFIX):
+                continue
+            for entry in self._scandir(key_directory.path):
+                try:
+                    yield entry, entry.stat()
+                except FileNotFoundError:
+                    continue
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def invalidate(self, *keys):
+        """Remove every cached version of the given storage keys"""
+        if not self.enabled or not keys:
+            return
+        for key in keys:
+            for entry in self._scandir(self._key_directory(key)):
+                self._remove(entry.path)
+
+    def record_fill(self, size):
+        """Count a new entry, evicting once the running total is over max_bytes"""
+        with self._lock:
+            self._fills_since_scan += 1
+            if self._total_bytes is not None:
+                self._total_bytes += size
+            scan = (
+                self._total_bytes is None
+                or self._total_bytes > self.max_bytes
+                or self._fills_since_scan >= self.rescan_fills
+            )
+        if scan:
+            self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits max_bytes"""
+        entries = list(self._entries())
+        total = sum(stat.st_size for _, stat in entries)
+        if total > self.max_bytes:
+            total = self._evict_entries(entries, total)
+        with self._lock:
+            self._total_bytes = total
+            self._fills_since_scan = 0
+
+    def _evict_entries(self, entries, total):
+        emptied = set()
+        for entry, stat in sorted(entries, key=lambda item: item[1].st_mtime):
+            if total <= self.max_bytes:
+                break
+            if self._remove(entry.path):
+                self._count("evictions")
+                emptied.add(os.path.dirname(entry.path))
+            total -= stat.st_size
+        for key_directory in emptied:
+            try:
+                os.rmdir(key_directory)
+            except OSError:
+                # Still holds other versions, or already removed
+                continue
+        return total
+
+    def stats(self):
+        """Counters of this process, plus the shared directory's usage"""
+        entries = list(self._entries()) if self.enabled else []
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(stat.st_size for _, stat in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+media_cache = MediaCache(
+    MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_MAX_OBJECT_BYTES
+)
@@ -1,32 +1,370 @@
 import base64
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.config import Config
 import logging
+from box.aws_utils.media_cache import media_cache
+from box.instrumentation import bind_request_metrics, instrument_s3_client
+from box.metrics import record_cache_lookup
 
 logger = logging.getLogger(__name__)
 
+MB = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("S3_DOWNLOAD_CHUNK_SIZE", 64 * 1024))
+# Files at least this large are uploaded as concurrent multipart parts
+MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", 16)) * MB
+# S3 rejects non-final parts smaller than 5 MB
+MULTIPART_PART_SIZE = max(int(os.getenv("S3_MULTIPART_PART_SIZE_MB", 8)), 5) * MB
+MULTIPART_CONCURRENCY = int(os.getenv("S3_MULTIPART_CONCURRENCY", 4))
+# Objects written at once by batch uploads
+UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", 8))
+# S3 accepts at most 1000 keys per DeleteObjects call
+DELETE_BATCH_SIZE = 1000
+DELETE_CONCURRENCY = int(os.getenv("S3_DELETE_CONCURRENCY", 4))
+PRESIGNED_UPLOAD_EXPIRES = int(os.getenv("S3_PRESIGNED_UPLOAD_EXPIRES", 15 * 60))
+PRESIGNED_DOWNLOAD_EXPIRES = int(os.getenv("S3_PRESIGNED_DOWNLOAD_EXPIRES", 15 * 60))
+# A cached download URL is only handed out while it has this long left to live
+PRESIGNED_URL_MIN_TTL = int(os.getenv("S3_PRESIGNED_URL_MIN_TTL", 60))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("S3_PRESIGNED_URL_CACHE_SIZE", 10000))
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _env_bool(name, default):
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
+
+
+def client_options():
+    """Pool, timeout and retry settings shared by the sync and async clients"""
+    return {
+        "max_pool_connections": int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50)),
+        "connect_timeout": float(os.getenv("S3_CONNECT_TIMEOUT", 5)),
+        "read_timeout": float(os.getenv("S3_READ_TIMEOUT", 60)),
+        "retries": {
+            "max_attempts": int(os.getenv("S3_MAX_ATTEMPTS", 3)),
+            "mode": "standard",
+        },
+    }
+
+
+def session_credentials():
+    return {
+        "aws_access_key_id": os.getenv("AWS_ACCESS_KEY_ID"),
+        "aws_secret_access_key": os.getenv("AWS_SECRET_ACCESS_KEY"),
+    }
+
+
+def build_client_config():
+    """botocore settings for the shared client, overridable from the env"""
+    return Config(tcp_keepalive=_env_bool("S3_TCP_KEEPALIVE", True), **client_options())
+
+
+def _build_client():
+    session = boto3.Session(**session_credentials())
+    client = session.client(
+        "s3",
+        endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        config=build_client_config(),
+    )
+    return instrument_s3_client(client)
+
+
+def get_s3_client():
+    """Return the process-wide S3 client
+
+    boto3 clients are thread-safe, so every request in a worker shares one
+    client and its connection pool. A forked child (e.g. a gunicorn worker
+    forked from a preloaded master) builds its own instead of sharing
+    sockets with its parent.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = _build_client()
+                _client_pid = pid
+    return _client
+
+
+def reset_s3_client():
+    """Drop the shared client so the next call builds a fresh one"""
+    global _client, _client_pid, _client_lock
+    _client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_s3_client)
+
+
+class PresignedUrlCache:
+    """Bounded in-process cache of signed URLs, dropped near their expiry
+
+    Signing is local CPU work, so the cache lives in the process rather
+    than in a shared backend that would cost a round trip per URL.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is None:
+                return None
+            url, stale_at = entry
+            if time.monotonic() >= stale_at:
+                del self._urls[key]
+                return None
+            self._urls.move_to_end(key)
+            return url
+
+    def set(self, key, url, ttl):
+        with self._lock:
+            self._urls[key] = (url, time.monotonic() + ttl)
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.max_size:
+                self._urls.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+
+
+presigned_url_cache = PresignedUrlCache(PRESIGNED_URL_CACHE_SIZE)
+
+
+def iter_body_chunks(body, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Relay an S3 StreamingBody in fixed-size chunks, closing it when done"""
+    try:
+        for chunk in body.iter_chunks(chunk_size=chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+
 class S3FileManager:
     def __init__(self):
-        self.AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-        self.AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+        self.client = get_s3_client()
+        self.bucket_name = os.getenv("S3_BUCKET_NAME")
 
-        self.session = boto3.Session(
-            aws_access_key_id=self.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=self.AWS_SECRET_ACCESS_KEY,
+    def upload_file(self, key, file_content, content_type=None):
+        """Upload an object and return its ETag"""
+        size = getattr(file_content, "size", None)
+        if size is not None and size >= MULTIPART_THRESHOLD:
+            return self.multipart_upload(key, file_content, content_type)
+        extra = {"ContentType": content_type} if content_type else {}
+        response = self.client.put_object(
+            Bucket=self.bucket_name, Key=key, Body=file_content, **extra
         )
-        self.bucket_name = os.getenv("S3_BUCKET_NAME")
-        self.s3 = self.session.resource("s3")
-        self.bucket = self.s3.Bucket(self.bucket_name)
+        return response["ETag"]
+
+    def upload_files(self, uploads, concurrency=None):
+        """Upload (key, file_content, content_type) tuples concurrently
+
+        Returns one result per upload, in order: the ETag on success or the
+        exception raised for that object.
+        """
+
+        def upload(item):
+            key, file_content, content_type = item
+            try:
+                return self.upload_file(key, file_content, content_type)
+            except Exception as error:
+                logger.exception(f"Failed to upload {key}")
+                return error
+
+        with ThreadPoolExecutor(max_workers=concurrency or UPLOAD_CONCURRENCY) as pool:
+            return list(pool.map(bind_request_metrics(upload), uploads))
+
+    def multipart_upload(
+        self,
+        key,
+        file_content,
+        content_type=None,
+        part_size=None,
+        concurrency=None,
+    ):
+        """Upload a file-like object as parts sent concurrently from a pool
+
+        At most two parts per worker are held in memory at once. Any failure
+        aborts the multipart upload so no orphaned parts are left billed.
+        """
+        part_size = part_size or MULTIPART_PART_SIZE
+        concurrency = concurrency or MULTIPART_CONCURRENCY
+        extra = {"ContentType": content_type} if content_type else {}
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=key, **extra
+        )["UploadId"]
+        in_flight = threading.BoundedSemaphore(concurrency * 2)
+        failed = threading.Event()
+
+        def on_done(future):
+            in_flight.release()
+            if future.exception() is not None:
+                failed.set()
+
+        upload_part = bind_request_metrics(self._upload_part)
+        try:
+            futures = []
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                part_number = 1
+                while not failed.is_set():
+                    chunk = file_content.read(part_size)
+                    if not chunk:
+                        break
+                    in_flight.acquire()
+                    future = pool.submit(
+                        upload_part, key, upload_id, part_number, chunk
+                    )
+                    future.add_done_callback(on_done)
+                    futures.append(future)
+                    part_number += 1
+            parts = [future.result() for future in futures]
+            response = self.client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            logger.exception(f"Aborting multipart upload of {key}")
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id
+            )
+            raise
+        return response["ETag"]
+
+    def _upload_part(self, key, upload_id, part_number, chunk):
+        response = self.client.upload_part(
+            Bucket=self.bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=chunk,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
 
-    def upload_file(self, key, file_content):
-        self.bucket.put_object(Key=key, Body=file_content)
-        return key
+    def presigned_upload_post(
+        self, key, max_size, content_type=None, expires_in=PRESIGNED_UPLOAD_EXPIRES
+    ):
+        """Presigned POST policy; S3 itself rejects bodies over max_size"""
+        fields = {}
+        conditions = [["content-length-range", 0, max_size]]
+        if content_type:
+            fields["Content-Type"] = content_type
+            conditions.append({"Content-Type": content_type})
+        return self.client.generate_presigned_post(
+            Bucket=self.bucket_name,
+            Key=key,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expires_in,
+        )
+
+    def presigned_upload_put(
+        self, key, content_type=None, expires_in=PRESIGNED_UPLOAD_EXPIRES
+    ):
+        params = {"Bucket": self.bucket_name, "Key": key}
+        if content_type:
+            params["ContentType"] = content_type
+        return self.client.generate_presigned_url(
+            "put_object", Params=params, ExpiresIn=expires_in, HttpMethod="PUT"
+        )
+
+    def presigned_download_url(self, key, expires_in=PRESIGNED_DOWNLOAD_EXPIRES):
+        """Short-lived GET URL, reused until it has PRESIGNED_URL_MIN_TTL left"""
+        cache_key = (self.bucket_name, key, expires_in)
+        url = presigned_url_cache.get(cache_key)
+        record_cache_lookup("presigned_url", url is not None)
+        if url is None:
+            url = self.client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": self.bucket_name, "Key": key},
+                ExpiresIn=expires_in,
+            )
+            ttl = expires_in - PRESIGNED_URL_MIN_TTL
+            if ttl > 0:
+                presigned_url_cache.set(cache_key, url, ttl)
+        return url
 
     def delete_file(self, key):
-        self.bucket.delete_objects(Delete={"Objects": [{"Key": key}]})
-    
-    def get_file_content(self,key):
-        obj = self.s3.Object(self.bucket_name, key)
-        logger.info(f"obj in bucket {obj.__dict__}")
-        converted_string = base64.b64encode(obj.get()['Body'].read())
+        self.client.delete_objects(
+            Bucket=self.bucket_name, Delete={"Objects": [{"Key": key}]}
+        )
+
+    def delete_files(self, keys, concurrency=None):
+        """Delete keys in concurrent 1000-key DeleteObjects batches
+
+        Returns the set of keys S3 failed to delete.
+        """
+        keys = list(keys)
+        batches = [
+            keys[start : start + DELETE_BATCH_SIZE]
+            for start in range(0, len(keys), DELETE_BATCH_SIZE)
+        ]
+
+        def delete_batch(batch):
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+                )
+            except Exception:
+                logger.exception(f"Failed to delete a batch of {len(batch)} keys")
+                return set(batch)
+            return {error["Key"] for error in response.get("Errors", [])}
+
+        failed = set()
+        with ThreadPoolExecutor(max_workers=concurrency or DELETE_CONCURRENCY) as pool:
+            for batch_failures in pool.map(bind_request_metrics(delete_batch), batches):
+                failed |= batch_failures
+        return failed
+
+    def get_file_object(
+        self, key, byte_range=None, if_match=None, if_unmodified_since=None
+    ):
+        """Return the S3 GetObject response without reading its body"""
+        params = {"Bucket": self.bucket_name, "Key": key}
+        if byte_range:
+            params["Range"] = byte_range
+        if if_match:
+            params["IfMatch"] = if_match
+        if if_unmodified_since:
+            params["IfUnmodifiedSince"] = if_unmodified_since
+        return self.client.get_object(**params)
+
+    def get_cached_file_object(self, key, version=None):
+        """get_file_object through the local disk cache when it is enabled
+
+        version must change whenever the object does, e.g. its ETag.
+        """
+        if version is None or not media_cache.enabled:
+            return self.get_file_object(key)
+        s3_object = media_cache.get(key, version)
+        if s3_object is None:
+            s3_object = media_cache.store(key, version, self.get_file_object(key))
+        return s3_object
+
+    def head_file(self, key):
+        return self.client.head_object(Bucket=self.bucket_name, Key=key)
+
+    def get_file_content(self, key, version=None):
+        """Legacy download: the whole object read into memory as base64"""
+        obj = self.get_cached_file_object(key, version)
+        logger.info(f"obj in bucket {self.bucket_name}/{key}")
+        try:
+            converted_string = base64.b64encode(obj["Body"].read())
+        finally:
+            obj["Body"].close()
         return converted_string
@@ -0,0 +1,46 @@
+"""Bookkeeping for BoxMedia rows deleted in bulk
+
+Deleting media sends post_delete once per row, and each receiver would
+bump its repo's tree and release its blob on its own. Inside
+batched_media_deletes() the receivers only note the blobs, and when the
+block exits each repo the caller named is bumped once and each blob is
+released once.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from box.blobs import release_blobs
+from box.tree_cache import bump_tree_generation
+
+_current_batch = ContextVar("media_delete_batch", default=None)
+
+
+class MediaDeleteBatch:
+    def __init__(self, repo_ids):
+        self.repo_ids = set(repo_ids)
+        self.blob_digests = Counter()
+
+
+def current_media_delete_batch():
+    """The batch of the enclosing batched_media_deletes() block, or None"""
+    return _current_batch.get()
+
+
+@contextmanager
+def batched_media_deletes(repo_ids):
+    """Defer the per-row bookkeeping of media deleted from repo_ids
+
+    Use inside the transaction of the delete; nothing is done when the
+    block raises, since the deletes are rolled back with it.
+    """
+    batch = MediaDeleteBatch(repo_ids)
+    token = _current_batch.set(batch)
+    try:
+        yield batch
+    finally:
+        _current_batch.reset(token)
+    for repo_id in batch.repo_ids:
+        bump_tree_generation(repo_id)
+    release_blobs(batch.blob_digests.elements())
@@ -0,0 +1,221 @@
+"""Content-addressed media storage
+
+With BOX_MEDIA_DEDUPLICATION on, uploaded files are stored once per
+SHA-256 digest under blobs/sha256/<digest> and shared by every BoxMedia
+row holding the same bytes. MediaBlob.ref_count counts those rows and the
+object is deleted once the last of them is gone.
+"""
+
+import hashlib
+import logging
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from box.aws_utils.media_cache import media_cache
+from box.aws_utils.s3_utils import S3FileManager
+from box.models import MediaBlob
+
+logger = logging.getLogger(__name__)
+
+
+def file_digest(file_content):
+    """SHA-256 hex digest and size of an upload
+
+    Files parsed from a request were hashed as they arrived; any other file
+    is read chunk by chunk.
+    """
+    if getattr(file_content, "sha256", None):
+        return file_content.sha256, file_content.size
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in file_content.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    file_content.seek(0)
+    return digest.hexdigest(), size
+
+
+def acquire_blob(file_content):
+    """Take a reference on the blob for this content, creating it if new
+
+    The caller must upload the content when the returned blob has no etag
+    yet, and release the reference if that upload fails.
+    """
+    digest, size = file_digest(file_content)
+    with transaction.atomic():
+        # The lock waits out a concurrent purge of the same digest
+        blob, _ = MediaBlob.objects.select_for_update().get_or_create(
+            digest=digest, defaults={"size": size}
+        )
+        MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1)
+    return blob
+
+
+def mark_uploaded(blob, etag):
+    MediaBlob.objects.filter(pk=blob.pk).update(etag=etag)
+    blob.etag = etag
+
+
+def release_blob(digest, count=1):
+    """Drop references; the object is purged once the count reaches zero"""
+    released = MediaBlob.objects.filter(digest=digest, ref_count__gt=0).update(
+        ref_count=Greatest(F("ref_count") - count, 0)
+    )
+    # Only the release that drops the last reference schedules the purge,
+    # so a cascade over many rows sharing the blob purges it once
+    if released and MediaBlob.objects.filter(digest=digest, ref_count=0).exists():
+        # Robust, so a failed purge after the commit is logged rather than
+        # failing a request whose writes are already committed
+        transaction.on_commit(lambda: purge_blob(digest), robust=True)
+
+
+def release_blobs(digests):
+    """release_blob for many rows, with one update per distinct digest"""
+    for digest, count in Counter(digests).items():
+        release_blob(digest, count)
+
+
+def purge_blob(digest):
+    """Delete an unreferenced blob's row, then its object once that commits"""
+    with transaction.atomic():
+        blob = (
+            MediaBlob.objects.select_for_update()
+            .filter(digest=digest, ref_count=0)
+            .first()
+        )
+        if blob is None:
+            return
+        blob.delete()
+        # S3 is only called once the row lock is released. A failed delete
+        # leaves an orphaned object, which the next upload of the same
+        # content overwrites.
+        transaction.on_commit(lambda: delete_blob_object(digest), robust=True)
+
+
+def delete_blob_object(digest):
+    # A row created since the purge means the content was uploaded again,
+    # under the same key
+    if MediaBlob.objects.filter(digest=digest).exists():
+        return
+    key = MediaBlob.key_for(digest)
+    S3FileManager().delete_file(key=key)
+    media_cache.invalidate(key)
+    logger.info(f"Purged blob {digest}")
+
+
+def save_media_file(s3, box_media, received_file, update_fields=()):
+    """Store a BoxMedia's file and save the row with its new ETag
+
+    Content-addressed content that is already stored is not uploaded again.
+    """
+    content_type = received_file.content_type
+    if box_media.etag and not box_media.blob_id:
+        media_cache.invalidate(box_media.s3_bucket_file_path)
+    if not settings.BOX_MEDIA_DEDUPLICATION:
+        box_media.etag = s3.upload_file(
+            key=box_media.s3_bucket_file_path,
+            file_content=received_file,
+            content_type=content_type,
+        )
+        box_media.save(update_fields=[*update_fields, "etag", "updated_at"])
+        return
+
+    previous_blob = box_media.blob_id
+    previous_key = box_media.s3_bucket_file_path if box_media.etag else None
+    blob = acquire_blob(received_file)
+    if not blob.etag:
+        try:
+            etag = s3.upload_file(
+                key=blob.s3_key, file_content=received_file, content_type=content_type
+            )
+        except Exception:
+            release_blob(blob.digest)
+            raise
+        mark_uploaded(blob, etag)
+    box_media.blob = blob
+    box_media.etag = blob.etag
+    box_media.save(update_fields=[*update_fields, "blob", "etag", "updated_at"])
+    if previous_blob:
+        release_blob(previous_blob)
+    elif previous_key:
+        # The row moved off its id-based object onto the shared blob
+        s3.delete_file(key=previous_key)
+
+
+async def asave_media_file(s3, box_media, received_file, update_fields=()):
+    """save_media_file for the async views, uploading through aioboto3"""
+    content_type = received_file.content_type
+    if box_media.etag and not box_media.blob_id:
+        media_cache.invalidate(box_media.s3_bucket_file_path)
+    if not settings.BOX_MEDIA_DEDUPLICATION:
+        box_media.etag = await s3.upload_file(
+            key=box_media.s3_bucket_file_path,
+            file_content=received_file,
+            content_type=content_type,
+        )
+        await box_media.asave(update_fields=[*update_fields, "etag", "updated_at"])
+        return
+
+    previous_blob = box_media.blob_id
+    previous_key = box_media.s3_bucket_file_path if box_media.etag else None
+    blob = await sync_to_async(acquire_blob)(received_file)
+    if not blob.etag:
+        try:
+            etag = await s3.upload_file(
+                key=blob.s3_key, file_content=received_file, content_type=content_type
+            )
+        except Exception:
+            await sync_to_async(release_blob)(blob.digest)
+            raise
+        await sync_to_async(mark_uploaded)(blob, etag)
+    box_media.blob = blob
+    box_media.etag = blob.etag
+    await box_media.asave(update_fields=[*update_fields, "blob", "etag", "updated_at"])
+    if previous_blob:
+        await sync_to_async(release_blob)(previous_blob)
+    elif previous_key:
+        await s3.delete_file(key=previous_key)
+
+
+def upload_media_files(s3, box_media_list, received_files):
+    """Upload the files of new BoxMedia rows concurrently
+
+    Returns one result per row: the ETag, or the exception that failed it.
+    Rows are not saved. With deduplication on each distinct content is
+    uploaded at most once and stored content is not uploaded at all.
+    """
+    if not settings.BOX_MEDIA_DEDUPLICATION:
+        return s3.upload_files(
+            (box_media.s3_bucket_file_path, received_file, received_file.content_type)
+            for box_media, received_file in zip(box_media_list, received_files)
+        )
+
+    blobs = [acquire_blob(received_file) for received_file in received_files]
+    pending = {}
+    for blob, received_file in zip(blobs, received_files):
+        if not blob.etag:
+            pending.setdefault(blob.digest, (blob, received_file))
+    etags = s3.upload_files(
+        (blob.s3_key, received_file, received_file.content_type)
+        for blob, received_file in pending.values()
+    )
+    uploaded = {}
+    for (blob, _), etag in zip(pending.values(), etags):
+        if not isinstance(etag, Exception):
+            mark_uploaded(blob, etag)
+        uploaded[blob.digest] = etag
+
+    results = []
+    for box_media, blob in zip(box_media_list, blobs):
+        etag = uploaded.get(blob.digest, blob.etag)
+        if isinstance(etag, Exception):
+            release_blob(blob.digest)
+        else:
+            box_media.blob = blob
+        results.append(etag)
+    return results
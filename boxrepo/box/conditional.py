@@ -0,0 +1,91 @@
+import hashlib
+from collections import namedtuple
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from box.models import Box, Repo
+
+TreeValidators = namedtuple("TreeValidators", ["repo_id", "etag", "last_modified"])
+
+
+def _tree_etag(*parts):
+    digest = hashlib.md5(":".join(str(part) for part in parts).encode()).hexdigest()
+    return f'W/"{digest}"'
+
+
+def _latest(*timestamps):
+    return max(timestamp for timestamp in timestamps if timestamp is not None)
+
+
+def repo_tree_validators(repo_id, variant=""):
+    """Fingerprint a repo tree from one aggregate query
+
+    Row counts catch deletions and the newest updated_at catches inserts and
+    edits, so the tree never has to be loaded to decide whether it changed.
+    """
+    row = (
+        Repo.objects.filter(pk=repo_id)
+        .annotate(
+            num_boxes=Count("boxes", distinct=True),
+            box_updated_at=Max("boxes__updated_at"),
+            media_count=Count("boxes__boxmedia", distinct=True),
+            media_updated_at=Max("boxes__boxmedia__updated_at"),
+        )
+        .values(
+            "id",
+            "updated_at",
+            "num_boxes",
+            "box_updated_at",
+            "media_count",
+            "media_updated_at",
+        )
+        .first()
+    )
+    if row is None:
+        return None
+    return TreeValidators(
+        repo_id=row["id"],
+        etag=_tree_etag("repo", *row.values(), variant),
+        last_modified=_latest(
+            row["updated_at"], row["box_updated_at"], row["media_updated_at"]
+        ),
+    )
+
+
+def box_tree_validators(box_id, variant=""):
+    """Fingerprint a box and its media from one aggregate query"""
+    row = (
+        Box.objects.filter(pk=box_id)
+        .annotate(
+            media_count=Count("boxmedia"),
+            media_updated_at=Max("boxmedia__updated_at"),
+        )
+        .values("id", "repo_id", "updated_at", "media_count", "media_updated_at")
+        .first()
+    )
+    if row is None:
+        return None
+    return TreeValidators(
+        repo_id=row["repo_id"],
+        etag=_tree_etag("box", *row.values(), variant),
+        last_modified=_latest(row["updated_at"], row["media_updated_at"]),
+    )
+
+
+def not_modified_response(request, etag=None, last_modified=None):
+    """Return a 304/412 response when the request's preconditions say so"""
+    return get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+
+
+def set_validator_headers(response, etag=None, last_modified=None):
+    if etag:
+        response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    return response
@@ -0,0 +1,121 @@
+"""Sparse fieldsets and expansion of nested relations
+
+Read requests choose what a repo or box body contains:
+
+    ?fields=id,repo_name,boxes_list.box_name
+        only the named fields; dotted names select fields of a relation
+    ?expand=boxes_list.box_media_list
+        embed the named relations, dotted for deeper levels
+    ?depth=1
+        embed every relation down to that many levels
+
+Without any of them every relation is embedded, as it always was. With
+any of them a relation is embedded only when it is named or within the
+depth, and views prefetch only the relations that will be serialized.
+"""
+
+from rest_framework.exceptions import ParseError
+
+FIELDS_PARAM = "fields"
+EXPAND_PARAM = "expand"
+DEPTH_PARAM = "depth"
+
+
+def _split(value):
+    return [path.strip() for path in value.split(",") if path.strip()]
+
+
+class Fieldset:
+    """Fields and relations requested at one level of a serialized tree
+
+    A depth of None embeds every relation below this level.
+    """
+
+    def __init__(self, serializer_class, depth=None):
+        self.serializer_class = serializer_class
+        self.depth = depth
+        # None selects every field
+        self.fields = None
+        self.relations = {}
+
+    def _child_depth(self):
+        return None if self.depth is None else max(self.depth - 1, 0)
+
+    def _relation(self, name, param):
+        expandable = self.serializer_class.expandable_fields
+        if name not in expandable:
+            raise ParseError(f"'{name}' in {param} is not an expandable relation")
+        if name not in self.relations:
+            _, serializer_class = expandable[name]
+            self.relations[name] = Fieldset(serializer_class, self._child_depth())
+        return self.relations[name]
+
+    def select(self, path):
+        """Add a dotted path from ?fields="""
+        name, _, rest = path.partition(".")
+        if name not in self.serializer_class.Meta.fields:
+            raise ParseError(f"Unknown field '{name}' in {FIELDS_PARAM}")
+        if self.fields is None:
+            self.fields = set()
+        self.fields.add(name)
+        if rest:
+            self._relation(name, FIELDS_PARAM).select(rest)
+        elif name in self.serializer_class.expandable_fields:
+            self._relation(name, FIELDS_PARAM)
+
+    def expand(self, path):
+        """Add a dotted path from ?expand="""
+        name, _, rest = path.partition(".")
+        child = self._relation(name, EXPAND_PARAM)
+        if self.fields is not None:
+            self.fields.add(name)
+        if rest:
+            child.expand(rest)
+
+    def includes(self, name):
+        if self.fields is not None and name not in self.fields:
+            return False
+        if name not in self.serializer_class.expandable_fields:
+            return True
+        return name in self.relations or self.depth is None or self.depth > 0
+
+    def child(self, name):
+        """The fieldset of an embedded relation"""
+        if name in self.relations:
+            return self.relations[name]
+        _, serializer_class = self.serializer_class.expandable_fields[name]
+        return Fieldset(serializer_class, self._child_depth())
+
+    def prefetch_lookups(self, prefix=""):
+        """Prefetch lookups for exactly the relations that will be embedded"""
+        expandable = self.serializer_class.expandable_fields
+        for name, (lookup, _) in expandable.items():
+            if self.includes(name):
+                path = prefix + lookup
+                yield path
+                yield from self.child(name).prefetch_lookups(f"{path}__")
+
+
+def parse_fieldset(query_params, serializer_class):
+    """Build the requested fieldset, raising ParseError on unknown names"""
+    fields = query_params.get(FIELDS_PARAM)
+    expand = query_params.get(EXPAND_PARAM)
+    depth = query_params.get(DEPTH_PARAM)
+    if fields is None and expand is None and depth is None:
+        return Fieldset(serializer_class)
+    if depth is None:
+        depth = 0
+    else:
+        try:
+            depth = int(depth)
+        except ValueError:
+            depth = -1
+        if depth < 0:
+            raise ParseError(f"{DEPTH_PARAM} must be a non-negative integer")
+    fieldset = Fieldset(serializer_class, depth)
+    # Fields first, so expanded relations are added to a sparse selection
+    for path in _split(fields or ""):
+        fieldset.select(path)
+    for path in _split(expand or ""):
+        fieldset.expand(path)
+    return fieldset
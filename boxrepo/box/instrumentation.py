@@ -0,0 +1,246 @@
+"""Per-request timing of SQL, S3 and response rendering
+
+RequestInstrumentationMiddleware opens a RequestMetrics for each request
+and keeps it in a context variable. Queries are counted by an execute
+wrapper installed on every database connection, and S3 calls by botocore
+event hooks on the shared clients; both do nothing outside a request.
+The totals go out as a Server-Timing header and one JSON log line, and
+feed the request and S3 metrics in box.metrics.
+
+The total covers the view and rendering. A streamed body (a media
+download) is still being sent when the line is logged.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from box.metrics import (
+    REQUEST_DB_QUERIES,
+    REQUEST_DURATION,
+    REQUESTS,
+    REQUESTS_IN_FLIGHT,
+    S3_BYTES,
+    S3_DURATION,
+    S3_ERRORS,
+)
+
+logger = logging.getLogger(__name__)
+
+current_metrics = ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.s3_calls = 0
+        self.s3_bytes = 0
+        self.s3_seconds = 0.0
+        self.render_seconds = 0.0
+        self._render_started = None
+        # S3 calls also run on upload and delete pool threads
+        self._lock = threading.Lock()
+
+    def add_s3_call(self, seconds, num_bytes):
+        with self._lock:
+            self.s3_calls += 1
+            self.s3_bytes += num_bytes
+            self.s3_seconds += seconds
+
+    def start_render(self):
+        self._render_started = time.perf_counter()
+
+    def stop_render(self):
+        if self._render_started is not None:
+            self.render_seconds += time.perf_counter() - self._render_started
+            self._render_started = None
+
+    def server_timing(self, total_seconds):
+        return ", ".join(
+            [
+                f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"',
+                f"s3;dur={self.s3_seconds * 1000:.1f};"
+                f'desc="{self.s3_calls} calls, {self.s3_bytes} bytes"',
+                f"render;dur={self.render_seconds * 1000:.1f}",
+                f"total;dur={total_seconds * 1000:.1f}",
+            ]
+        )
+
+    def as_log_record(self, request, response, total_seconds):
+        return {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total_seconds * 1000, 1),
+            "db_queries": self.db_queries,
+            "db_ms": round(self.db_seconds * 1000, 1),
+            "s3_calls": self.s3_calls,
+            "s3_bytes": self.s3_bytes,
+            "s3_ms": round(self.s3_seconds * 1000, 1),
+            "render_ms": round(self.render_seconds * 1000, 1),
+        }
+
+
+def record_query(execute, sql, params, many, context):
+    """Connection execute wrapper timing the queries of the current request"""
+    metrics = current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_queries += 1
+        metrics.db_seconds += time.perf_counter() - start
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+def bind_request_metrics(fn):
+    """Carry the current request's metrics into a pool thread running fn"""
+    metrics = current_metrics.get()
+    if metrics is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = current_metrics.set(metrics)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current_metrics.reset(token)
+
+    return run
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    # Django uploads know their size; other streams are not measured
+    return getattr(body, "size", 0) or 0
+
+
+def _start_s3_call(model, params, context, **kwargs):
+    context["instrumentation_started"] = time.perf_counter()
+    context["instrumentation_operation"] = model.name
+    context["instrumentation_bytes"] = _body_size(params.get("body"))
+
+
+def _finish_s3_call(context, http_response=None, **kwargs):
+    started = context.pop("instrumentation_started", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    operation = context.pop("instrumentation_operation")
+    num_bytes = context.pop("instrumentation_bytes", 0)
+    if http_response is not None:
+        num_bytes += int(http_response.headers.get("content-length") or 0)
+    S3_DURATION.observe(seconds, operation=operation)
+    S3_BYTES.inc(num_bytes, operation=operation)
+    if http_response is None or http_response.status_code >= 400:
+        S3_ERRORS.inc(operation=operation)
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.add_s3_call(seconds, num_bytes)
+
+
+def instrument_s3_client(client):
+    """Count and time every API call made through a boto3 or aioboto3 client"""
+    events = client.meta.events
+    events.register("before-call.s3", _start_s3_call)
+    events.register("after-call.s3", _finish_s3_call)
+    events.register("after-call-error.s3", _finish_s3_call)
+    return client
+
+
+class RequestInstrumentationMiddleware:
+    """Reports where each request's time went; runs under WSGI and ASGI"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = settings.REQUEST_INSTRUMENTATION
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        # Connections opened before this module was imported missed the signal
+        install_query_recorder(connection)
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = self.get_response(request)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            current_metrics.reset(token)
+        return self.report(request, response, metrics)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = await self.get_response(request)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            current_metrics.reset(token)
+        return self.report(request, response, metrics)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook returns
+        metrics = current_metrics.get()
+        if metrics is not None:
+            metrics.start_render()
+            response.add_post_render_callback(lambda _: metrics.stop_render())
+        return response
+
+    def report(self, request, response, metrics):
+        total_seconds = time.perf_counter() - metrics.started
+        if settings.SERVER_TIMING_HEADER:
+            response["Server-Timing"] = metrics.server_timing(total_seconds)
+        logger.info(json.dumps(metrics.as_log_record(request, response, total_seconds)))
+        view, action = view_labels(request)
+        REQUESTS.inc(
+            view=view, action=action, method=request.method, status=response.status_code
+        )
+        REQUEST_DURATION.observe(total_seconds, view=view, action=action)
+        REQUEST_DB_QUERIES.observe(metrics.db_queries, view=view, action=action)
+        return response
+
+
+def view_labels(request):
+    """(view, action) naming the viewset action or view that served a request"""
+    match = getattr(request, "resolver_match", None)
+    method = request.method.lower()
+    if match is None:
+        return "unmatched", method
+    view_class = getattr(match.func, "cls", None)
+    if view_class is None:
+        return match.func.__name__, method
+    actions = getattr(match.func, "actions", None) or {}
+    return view_class.__name__, actions.get(method, method)
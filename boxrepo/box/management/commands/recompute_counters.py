@@ -0,0 +1,43 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from box.models import Box, Repo, UserRepoCounter
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized box and repo counters from the rows"
+
+    def handle(self, *args, **options):
+        box_counts = (
+            Box.objects.filter(repo=OuterRef("pk"))
+            .order_by()
+            .values("repo")
+            .annotate(count=Count("id"))
+            .values("count")
+        )
+        repo_counts = (
+            Repo.objects.filter(user=OuterRef("pk"))
+            .order_by()
+            .values("user")
+            .annotate(count=Count("id"))
+            .values("count")
+        )
+        with transaction.atomic():
+            repos = Repo.objects.update(box_count=Coalesce(Subquery(box_counts), 0))
+            UserRepoCounter.objects.bulk_create(
+                UserRepoCounter(user_id=user_id)
+                for user_id in get_user_model()
+                .objects.filter(repo_counter__isnull=True)
+                .values_list("pk", flat=True)
+            )
+            users = UserRepoCounter.objects.update(
+                repo_count=Coalesce(Subquery(repo_counts), 0)
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Recomputed counters of {repos} repos and {users} users"
+            )
+        )
@@ -0,0 +1,357 @@
+"""Process-local metrics merged across gunicorn workers
+
+Metrics are recorded in memory and each process flushes its values to
+its own JSON file in METRICS_DIR every METRICS_FLUSH_INTERVAL seconds.
+The /metrics endpoint merges the files of every worker of the same
+gunicorn master and renders them in the Prometheus text exposition format.
+
+When a worker exits, the next collection folds its counters and
+histograms into an archive file, so totals never go backwards. Its
+gauges are dropped. Files left by a previous master are deleted.
+"""
+
+import bisect
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ARCHIVE = "archive"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def merge(self, merged, key, value):
+        merged[key] = merged.get(key, 0) + value
+
+    def samples(self, values):
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.changed()
+
+
+class Gauge(Metric):
+    """Summed over the live processes only"""
+
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.changed()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=None):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets or DEFAULT_BUCKETS)
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        # Per-bucket counts with a final +Inf bucket, then the sum
+        index = bisect.bisect_left(self.buckets, value)
+        with self.registry.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+        self.registry.changed()
+
+    def merge(self, merged, key, value):
+        if len(value) != len(self.buckets) + 2:
+            # Written with other buckets by an older release
+            return
+        current = merged.get(key)
+        merged[key] = (
+            value if current is None else [a + b for a, b in zip(current, value)]
+        )
+
+    def samples(self, values):
+        for key, counts in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket", {**labels, "le": le}, cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self._reset()
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        for metric in self.metrics.values():
+            metric.values = {}
+        self._pid = os.getpid()
+        self._started = time.time_ns()
+        self._dirty = False
+        self._flusher = None
+
+    @property
+    def enabled(self):
+        return settings.METRICS_ENABLED
+
+    @property
+    def directory(self):
+        return settings.METRICS_DIR
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _group(self):
+        # Workers of one gunicorn master share its pid as their parent
+        return str(os.getppid())
+
+    def _path(self, group, name):
+        return os.path.join(self.directory, f"{group}-{name}.json")
+
+    def changed(self):
+        """Note new values and make sure a flusher thread will write them"""
+        self._dirty = True
+        if self._flusher is None:
+            with self.lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(
+                        target=self._flush_periodically, daemon=True
+                    )
+                    self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            if self._pid != os.getpid():
+                return
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Could not flush metrics")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: [[list(key), value] for key, value in metric.values.items()]
+                for name, metric in self.metrics.items()
+                if metric.values
+            }
+
+    def flush(self, force=False):
+        """Write this process's values to its file"""
+        if not (self._dirty or force):
+            return
+        self._dirty = False
+        name = f"{os.getpid()}-{self._started}"
+        self._write(self._path(self._group(), name), self.snapshot())
+
+    def _write(self, path, data):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "w") as file:
+            json.dump(data, file)
+        os.replace(temp_path, path)
+
+    def _read(self, path):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _merge(self, merged, data, include_gauges=True):
+        for name, values in data.items():
+            metric = self.metrics.get(name)
+            if metric is None or (metric.kind == "gauge" and not include_gauges):
+                continue
+            target = merged.setdefault(name, {})
+            for key, value in values:
+                metric.merge(target, tuple(key), value)
+
+    def _files(self):
+        """(group, name, path) of every metrics file in the directory"""
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json") or entry.name.startswith("."):
+                continue
+            group, _, name = entry.name[: -len(".json")].partition("-")
+            yield group, name, entry.path
+
+    def _compact(self, group):
+        """Fold the files of exited workers into the archive"""
+        archive_path = self._path(group, ARCHIVE)
+        lock_path = os.path.join(self.directory, f".{group}.lock")
+        with open(lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archived = {}
+            dead = []
+            for file_group, name, path in self._files():
+                if file_group != group:
+                    # Left behind by a previous master
+                    if file_group.isdigit() and not _pid_alive(int(file_group)):
+                        os.unlink(path)
+                    continue
+                if name != ARCHIVE and not _pid_alive(int(name.split("-")[0])):
+                    dead.append(path)
+            if not dead:
+                return
+            self._merge(archived, self._read(archive_path), include_gauges=False)
+            for path in dead:
+                self._merge(archived, self._read(path), include_gauges=False)
+            self._write(
+                archive_path,
+                {
+                    name: [[list(key), value] for key, value in values.items()]
+                    for name, values in archived.items()
+                },
+            )
+            for path in dead:
+                os.unlink(path)
+
+    def collect(self):
+        """Merged values of every worker of this master"""
+        self.flush(force=True)
+        group = self._group()
+        self._compact(group)
+        merged = {}
+        for file_group, name, path in self._files():
+            if file_group == group:
+                self._merge(merged, self._read(path))
+        return merged
+
+    def exposition(self):
+        """All metrics in the Prometheus text format"""
+        merged = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for sample, labels, value in metric.samples(merged.get(name, {})):
+                lines.append(f"{sample}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+registry = MetricsRegistry()
+
+if hasattr(os, "register_at_fork"):
+    # A worker forked from a preloaded master starts from zero
+    os.register_at_fork(after_in_child=registry._reset)
+
+REQUESTS = registry.counter(
+    "boxrepo_http_requests_total",
+    "Requests served, by view action and status",
+    ["view", "action", "method", "status"],
+)
+REQUEST_DURATION = registry.histogram(
+    "boxrepo_http_request_duration_seconds",
+    "Request latency by view action",
+    ["view", "action"],
+)
+REQUEST_DB_QUERIES = registry.histogram(
+    "boxrepo_http_request_db_queries",
+    "SQL queries per request by view action",
+    ["view", "action"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+REQUESTS_IN_FLIGHT = registry.gauge(
+    "boxrepo_http_requests_in_flight", "Requests being served"
+)
+S3_DURATION = registry.histogram(
+    "boxrepo_s3_operation_duration_seconds",
+    "S3 API call latency by operation",
+    ["operation"],
+)
+S3_BYTES = registry.counter(
+    "boxrepo_s3_bytes_total", "Bytes sent and received by S3 operation", ["operation"]
+)
+S3_ERRORS = registry.counter(
+    "boxrepo_s3_errors_total", "Failed S3 API calls by operation", ["operation"]
+)
+CACHE_REQUESTS = registry.counter(
+    "boxrepo_cache_requests_total",
+    "Cache lookups by cache and result; hits / all gives the hit ratio",
+    ["cache", "result"],
+)
+
+
+def record_cache_lookup(cache_name, hit):
+    CACHE_REQUESTS.inc(cache=cache_name, result="hit" if hit else "miss")
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("box", "0008_boxmedia_created_at_boxmedia_updated_at_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="box",
+            index=models.Index(
+                fields=["created_at", "id"], name="box_created_at_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="repo",
+            index=models.Index(
+                fields=["created_at", "id"], name="repo_created_at_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="repoaccess",
+            index=models.Index(
+                fields=["created_at", "id"], name="repoaccess_created_at_id_idx"
+            ),
+        ),
+    ]
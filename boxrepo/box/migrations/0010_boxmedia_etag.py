@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 07:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("box", "0009_created_at_id_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="boxmedia",
+            name="etag",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.5 on 2026-10-18 07:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("box", "0010_boxmedia_etag"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="boxmedia",
+            name="upload_status",
+            field=models.CharField(
+                choices=[("PENDING", "PENDING"), ("COMPLETE", "COMPLETE")],
+                default="COMPLETE",
+                max_length=255,
+            ),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.5 on 2026-10-18 07:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("box", "0011_boxmedia_upload_status"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MediaBlob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("digest", models.CharField(max_length=64, unique=True)),
+                ("size", models.BigIntegerField(default=0)),
+                ("etag", models.CharField(blank=True, default="", max_length=255)),
+                ("ref_count", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="boxmedia",
+            name="blob",
+            field=models.ForeignKey(
+                blank=True,
+                db_column="content_digest",
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="box_media",
+                to="box.mediablob",
+                to_field="digest",
+            ),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.5 on 2026-10-18 07:26
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def populate_counters(apps, schema_editor):
+    Repo = apps.get_model("box", "Repo")
+    Box = apps.get_model("box", "Box")
+    UserRepoCounter = apps.get_model("box", "UserRepoCounter")
+    box_counts = (
+        Box.objects.filter(repo=OuterRef("pk"))
+        .order_by()
+        .values("repo")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    Repo.objects.update(box_count=Coalesce(Subquery(box_counts), 0))
+    UserRepoCounter.objects.bulk_create(
+        UserRepoCounter(user_id=row["user"], repo_count=row["count"])
+        for row in Repo.objects.order_by()
+        .values("user")
+        .annotate(count=Count("id"))
+        .iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("box", "0012_mediablob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserRepoCounter",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="repo_counter",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("repo_count", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="repo",
+            name="box_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
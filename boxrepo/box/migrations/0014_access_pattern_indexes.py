@@ -0,0 +1,46 @@
+# Generated by Django 4.2.5 on 2026-10-18 07:32
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def delete_duplicate_access(apps, schema_editor):
+    """Keep the oldest row of each (user, repo, access_type) triple"""
+    RepoAccess = apps.get_model("box", "RepoAccess")
+    keep = (
+        RepoAccess.objects.order_by()
+        .values("user", "repo", "access_type")
+        .annotate(keep_id=Min("id"))
+        .values_list("keep_id", flat=True)
+    )
+    RepoAccess.objects.exclude(id__in=keep).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("box", "0013_quota_counters"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_access, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="box",
+            index=models.Index(
+                fields=["repo", "created_at"], name="box_repo_created_at_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="boxmedia",
+            index=models.Index(
+                fields=["box", "created_at"], name="boxmedia_box_created_at_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="repoaccess",
+            constraint=models.UniqueConstraint(
+                fields=("user", "repo", "access_type"),
+                name="repoaccess_user_repo_access_type_uniq",
+            ),
+        ),
+    ]
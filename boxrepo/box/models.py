@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth import get_user_model
 import datetime
 from user.models import Account
@@ -17,15 +18,26 @@ class Repo(models.Model):
         auto_now_add=True,
     )
     updated_at = models.DateTimeField(auto_now=True)
+    # Maintained by Box.save and the post_delete signal, see recompute_counters
+    box_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="repo_created_at_id_idx"),
+        ]
 
     def save(self, *args, **kwargs):
         """Automatically create an OWNER access type"""
-        super().save()
-        if not RepoAccess.objects.filter(
-            user=self.user, repo=self, access_type=RepoAccess.REPO_ACCESS_TYPE_OWNER
-        ).exists():
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save()
+            if adding:
+                UserRepoCounter.increment(self.user_id)
+            # A single lookup on the unique (user, repo, access_type) index
             RepoAccess.objects.get_or_create(
-                user=self.user, repo=self, access_type=RepoAccess.REPO_ACCESS_TYPE_OWNER
+                user=self.user,
+                repo=self,
+                access_type=RepoAccess.REPO_ACCESS_TYPE_OWNER,
             )
 
     @property
@@ -33,6 +45,32 @@ class Repo(models.Model):
         return self.boxes.all()
 
 
+class UserRepoCounter(models.Model):
+    """Number of repos a user owns, kept next to the rows it counts"""
+
+    user = models.OneToOneField(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="repo_counter",
+    )
+    repo_count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def increment(cls, user_id):
+        counter, created = cls.objects.get_or_create(
+            user_id=user_id, defaults={"repo_count": 1}
+        )
+        if not created:
+            cls.objects.filter(pk=user_id).update(repo_count=F("repo_count") + 1)
+
+    @classmethod
+    def decrement(cls, user_id):
+        cls.objects.filter(pk=user_id, repo_count__gt=0).update(
+            repo_count=F("repo_count") - 1
+        )
+
+
 class RepoAccess(models.Model):
     REPO_ACCESS_TYPE_OWNER = "OWNER"
     REPO_ACCESS_TYPE_ADMIN = "ADMIN"
@@ -57,6 +95,20 @@ class RepoAccess(models.Model):
     )
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["created_at", "id"], name="repoaccess_created_at_id_idx"
+            ),
+        ]
+        constraints = [
+            # Also covers the per-user access map, which reads only these columns
+            models.UniqueConstraint(
+                fields=["user", "repo", "access_type"],
+                name="repoaccess_user_repo_access_type_uniq",
+            ),
+        ]
+
 
 class Box(models.Model):
     user = models.ForeignKey(
@@ -76,8 +128,67 @@ class Box(models.Model):
     )
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="box_created_at_id_idx"),
+            models.Index(fields=["repo", "created_at"], name="box_repo_created_at_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remembered so a save can move the box between repo counters
+        instance._loaded_repo_id = instance.__dict__.get("repo_id")
+        return instance
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        previous_repo_id = getattr(self, "_loaded_repo_id", None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                Repo.objects.filter(pk=self.repo_id).update(
+                    box_count=F("box_count") + 1
+                )
+            elif previous_repo_id is not None and previous_repo_id != self.repo_id:
+                Repo.objects.filter(pk=previous_repo_id, box_count__gt=0).update(
+                    box_count=F("box_count") - 1
+                )
+                Repo.objects.filter(pk=self.repo_id).update(
+                    box_count=F("box_count") + 1
+                )
+        self._loaded_repo_id = self.repo_id
+
+
+class MediaBlob(models.Model):
+    """One stored object shared by every BoxMedia with the same content"""
+
+    digest = models.CharField(max_length=64, unique=True)  # SHA-256 hex
+    size = models.BigIntegerField(default=0)
+    etag = models.CharField(max_length=255, blank=True, default="")  # "" until stored
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def key_for(digest):
+        return f"blobs/sha256/{digest}"
+
+    @property
+    def s3_key(self):
+        return self.key_for(self.digest)
+
 
 class BoxMedia(models.Model):
+    UPLOAD_STATUS_PENDING = "PENDING"
+    UPLOAD_STATUS_COMPLETE = "COMPLETE"
+    UPLOAD_STATUS_CHOICES = (
+        (UPLOAD_STATUS_PENDING, UPLOAD_STATUS_PENDING),
+        (UPLOAD_STATUS_COMPLETE, UPLOAD_STATUS_COMPLETE),
+    )
+
     user = models.ForeignKey(
         get_user_model(),
         on_delete=models.CASCADE,
@@ -89,11 +200,36 @@ class BoxMedia(models.Model):
         default=None,
     )
     file_name = models.TextField(default="")  # front end will encrypt the file_name
+    etag = models.CharField(max_length=255, blank=True, default="")  # S3 ETag
+    # Set when the file is stored content-addressed; blob_id is the digest
+    blob = models.ForeignKey(
+        MediaBlob,
+        to_field="digest",
+        db_column="content_digest",
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name="box_media",
+    )
+    # PENDING until a direct-to-storage upload has been finalized
+    upload_status = models.CharField(
+        max_length=255, choices=UPLOAD_STATUS_CHOICES, default=UPLOAD_STATUS_COMPLETE
+    )
     created_at = models.DateTimeField(
         auto_now_add=True,
     )
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["box", "created_at"], name="boxmedia_box_created_at_idx"
+            ),
+        ]
+
     @property
     def s3_bucket_file_path(self):
-        return f"repo_{self.box.repo.id}/box_{self.box.id}/file_{self.id}"
+        """Built from foreign key ids so no related rows have to be fetched"""
+        if self.blob_id:
+            return MediaBlob.key_for(self.blob_id)
+        return f"repo_{self.box.repo_id}/box_{self.box_id}/file_{self.id}"
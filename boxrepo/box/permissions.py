@@ -0,0 +1,84 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from box.metrics import record_cache_lookup
+from box.models import RepoAccess
+
+ACCESS_VERSION_KEY = "repo_access_version:{user_id}"
+ACCESS_MAP_KEY = "repo_access_map:{user_id}:{version}"
+REQUEST_ATTR = "_repo_permissions"
+
+
+def get_access_version(user_id):
+    """Return the current access map version for a user"""
+    key = ACCESS_VERSION_KEY.format(user_id=user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_access_version(user_id):
+    """Invalidate every cached access map of a user
+
+    Versions are random rather than incremented so a version key that was
+    evicted can never resurrect an older cached map.
+    """
+    cache.set(ACCESS_VERSION_KEY.format(user_id=user_id), uuid.uuid4().hex, None)
+
+
+class RepoPermissionResolver:
+    """Resolves a user's access types per repo from one cached map"""
+
+    def __init__(self, user):
+        self.user = user
+        self._access_map = None
+
+    @property
+    def access_map(self):
+        if self._access_map is None:
+            self._access_map = self._load_access_map()
+        return self._access_map
+
+    def _load_access_map(self):
+        if not self.user.is_authenticated:
+            return {}
+        if not settings.SHARED_CACHE:
+            # Other workers would keep granting revoked access from their copy
+            return self._query_access_map()
+        version = get_access_version(self.user.pk)
+        key = ACCESS_MAP_KEY.format(user_id=self.user.pk, version=version)
+        access_map = cache.get(key)
+        record_cache_lookup("repo_access", access_map is not None)
+        if access_map is None:
+            access_map = self._query_access_map()
+            cache.set(key, access_map, settings.REPO_ACCESS_CACHE_TIMEOUT)
+        return access_map
+
+    def _query_access_map(self):
+        access_map = {}
+        for repo_id, access_type in RepoAccess.objects.filter(
+            user_id=self.user.pk
+        ).values_list("repo_id", "access_type"):
+            access_map.setdefault(repo_id, set()).add(access_type)
+        return access_map
+
+    def access_types(self, repo):
+        """Return the access types the user holds on a repo or repo id"""
+        repo_id = getattr(repo, "pk", repo)
+        return self.access_map.get(int(repo_id), set())
+
+    def has_access(self, repo, required_access):
+        return not self.access_types(repo).isdisjoint(required_access)
+
+
+def get_repo_permissions(request):
+    """Return the resolver memoized on the request for its user"""
+    resolver = getattr(request, REQUEST_ATTR, None)
+    if resolver is None or resolver.user is not request.user:
+        resolver = RepoPermissionResolver(request.user)
+        setattr(request, REQUEST_ATTR, resolver)
+    return resolver
@@ -0,0 +1,130 @@
+"""On-demand cProfile captures of single requests
+
+A staff user adds an X-Profile header or a ?profile=1 query parameter to
+a request. That one request then runs under cProfile. The stats are
+saved in PROFILE_DIR, and the response names them in an X-Profile-Id
+header. ProfileViewSet lists them and serves them for download. Without
+the trigger the middleware only checks the header and the query string.
+
+Only requests served through WSGI are profiled. Under ASGI a profile
+would also pick up every other coroutine running on the event loop.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from user.authentication import authenticate_request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ID_RE = re.compile(r"^[0-9]+-[0-9a-f]{32}$")
+PROFILE_SUFFIX = ".prof"
+
+
+def profile_path(profile_id):
+    """Path of a stored profile, or None for an id that is not one of ours"""
+    if not PROFILE_ID_RE.match(profile_id):
+        return None
+    return os.path.join(settings.PROFILE_DIR, profile_id + PROFILE_SUFFIX)
+
+
+def list_profiles():
+    """Stored profiles, newest first"""
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return []
+    profiles = []
+    for entry in os.scandir(settings.PROFILE_DIR):
+        profile_id = entry.name[: -len(PROFILE_SUFFIX)]
+        if entry.name.endswith(PROFILE_SUFFIX) and PROFILE_ID_RE.match(profile_id):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            profiles.append(
+                {"id": profile_id, "size": stat.st_size, "created": stat.st_mtime}
+            )
+    return sorted(profiles, key=lambda profile: profile["id"], reverse=True)
+
+
+def _prune():
+    for profile in list_profiles()[settings.PROFILE_MAX_FILES :]:
+        try:
+            os.unlink(profile_path(profile["id"]))
+        except FileNotFoundError:
+            pass
+
+
+def save_profile(profiler):
+    """Write a profiler's stats and return the id to download them by"""
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    # Ids sort by creation time
+    profile_id = f"{time.time_ns()}-{uuid.uuid4().hex}"
+    profiler.dump_stats(profile_path(profile_id))
+    _prune()
+    return profile_id
+
+
+def profile_summary(profile_id, sort="cumulative", limit=50):
+    """The top functions of a stored profile as pstats text"""
+    output = io.StringIO()
+    stats = pstats.Stats(profile_path(profile_id), stream=output)
+    stats.sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+def profiling_requested(request):
+    if "HTTP_X_PROFILE" in request.META:
+        return True
+    # Only parse the query string when it could hold the parameter
+    if "profile=" not in request.META.get("QUERY_STRING", ""):
+        return False
+    return request.GET.get("profile", "").lower() in ("1", "true")
+
+
+class RequestProfilerMiddleware:
+    """Profiles a single request when a staff user asks for it"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not (settings.REQUEST_PROFILING and profiling_requested(request)):
+            return self.get_response(request)
+        if not self.is_staff(request):
+            return self.get_response(request)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        profile_id = save_profile(profiler)
+        logger.info(f"Profiled {request.method} {request.path} as {profile_id}")
+        response["X-Profile-Id"] = profile_id
+        return response
+
+    async def __acall__(self, request):
+        return await self.get_response(request)
+
+    def is_staff(self, request):
+        # Token users are only known once DRF authenticates them in the view
+        user = getattr(request, "user", None)
+        if user is None or not user.is_authenticated:
+            user = authenticate_request(request)
+        return user is not None and user.is_staff
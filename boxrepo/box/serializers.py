@@ -1,11 +1,68 @@
 from django.contrib.auth import get_user_model, authenticate
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
+from rest_framework.validators import UniqueTogetherValidator
+from box.aws_utils.s3_utils import S3FileManager
+from box.fieldsets import Fieldset
 from box.models import Repo, RepoAccess, Box, BoxMedia
+from box.permissions import get_repo_permissions
 
-class BoxMediaSerializer(serializers.ModelSerializer):
+
+def signed_urls_requested(request):
+    """Clients opt in to embedded download URLs with ?signed_urls=1"""
+    if request is None:
+        return False
+    return request.query_params.get("signed_urls", "").lower() in ("1", "true")
+
+
+VIEW_ACCESS = (
+    RepoAccess.REPO_ACCESS_TYPE_VIEWER,
+    RepoAccess.REPO_ACCESS_TYPE_ADMIN,
+    RepoAccess.REPO_ACCESS_TYPE_OWNER,
+)
+
+
+class FieldsetMixin:
+    """Keeps only the fields selected by the fieldset passed in
+
+    expandable_fields maps each nested relation to its prefetch lookup and
+    serializer class. Without a fieldset every field is kept.
+    """
+
+    expandable_fields = {}
+
+    def __init__(self, *args, fieldset=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fieldset is None:
+            fieldset = Fieldset(type(self))
+        self.fieldset = fieldset
+        for name in list(self.fields):
+            if not fieldset.includes(name):
+                self.fields.pop(name)
+
+
+class BoxMediaSerializer(FieldsetMixin, serializers.ModelSerializer):
     """Serializer for the BoxMedia Model"""
 
+    download_url = serializers.SerializerMethodField("_get_download_url")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not signed_urls_requested(self.context.get("request")):
+            self.fields.pop("download_url", None)
+
+    def _get_download_url(self, obj):
+        if obj.upload_status != BoxMedia.UPLOAD_STATUS_COMPLETE:
+            return None
+        # A signed URL hands out the object, so it needs the same access as
+        # downloading it through the media endpoint
+        permissions = get_repo_permissions(self.context["request"])
+        if not permissions.has_access(obj.box.repo_id, VIEW_ACCESS):
+            return None
+        if not hasattr(self, "_s3"):
+            self._s3 = S3FileManager()
+        return self._s3.presigned_download_url(obj.s3_bucket_file_path)
+
     class Meta:
         model = BoxMedia
         fields = (
@@ -14,15 +71,23 @@ class BoxMediaSerializer(serializers.ModelSerializer):
             "user_id",
             "file_name",
             "s3_bucket_file_path",
+            "upload_status",
+            "download_url",
         )
 
 
-class BoxSerializer(serializers.ModelSerializer):
+class BoxSerializer(FieldsetMixin, serializers.ModelSerializer):
     """Serializer for the Box Model"""
     box_media_list = serializers.SerializerMethodField('_get_children')
+    expandable_fields = {"box_media_list": ("boxmedia_set", BoxMediaSerializer)}
 
     def _get_children(self, obj):
-        serializer = BoxMediaSerializer(obj.boxmedia_set.all(), many=True)
+        serializer = BoxMediaSerializer(
+            obj.boxmedia_set.all(),
+            many=True,
+            context=self.context,
+            fieldset=self.fieldset.child("box_media_list"),
+        )
         return serializer.data
 
     class Meta:
@@ -41,13 +106,19 @@ class BoxSerializer(serializers.ModelSerializer):
 
 
 
-class RepoSerializer(serializers.ModelSerializer):
+class RepoSerializer(FieldsetMixin, serializers.ModelSerializer):
     """Serializer for the Repo Model"""
 
     boxes_list = serializers.SerializerMethodField("_get_boxes")
+    expandable_fields = {"boxes_list": ("boxes", BoxSerializer)}
 
     def _get_boxes(self, obj):
-        serializer = BoxSerializer(obj.boxes_list, many=True)
+        serializer = BoxSerializer(
+            obj.boxes_list,
+            many=True,
+            context=self.context,
+            fieldset=self.fieldset.child("boxes_list"),
+        )
         return serializer.data
 
     class Meta:
@@ -62,3 +133,10 @@ class RepoAccessSerializer(serializers.ModelSerializer):
     class Meta:
         model = RepoAccess
         fields = "__all__"
+        # DRF does not derive validators from UniqueConstraint yet
+        validators = [
+            UniqueTogetherValidator(
+                queryset=RepoAccess.objects.all(),
+                fields=("user", "repo", "access_type"),
+            )
+        ]
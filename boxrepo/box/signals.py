@@ -0,0 +1,89 @@
+from django.contrib.auth import get_user_model
+from django.db.models import F, QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from box.batching import current_media_delete_batch
+from box.blobs import release_blob
+from box.models import Box, BoxMedia, Repo, RepoAccess, UserRepoCounter
+from box.permissions import bump_access_version
+from box.tree_cache import bump_tree_generation
+
+
+@receiver(post_save, sender=RepoAccess)
+@receiver(post_delete, sender=RepoAccess)
+def invalidate_repo_access(sender, instance, **kwargs):
+    bump_access_version(instance.user_id)
+
+
+@receiver(post_save, sender=Repo)
+def invalidate_repo_owner_access(sender, instance, **kwargs):
+    bump_access_version(instance.user_id)
+
+
+@receiver(post_save, sender=get_user_model())
+def invalidate_new_user_access(sender, instance, created, **kwargs):
+    """A recycled user id must never see a previous user's cached map"""
+    if created:
+        bump_access_version(instance.pk)
+
+
+@receiver(post_delete, sender=BoxMedia)
+def release_box_media_blob(sender, instance, **kwargs):
+    """Also covers rows removed by a cascade from their box or repo"""
+    if not instance.blob_id:
+        return
+    batch = current_media_delete_batch()
+    if batch is not None:
+        batch.blob_digests[instance.blob_id] += 1
+    else:
+        release_blob(instance.blob_id)
+
+
+@receiver(post_save, sender=Repo)
+@receiver(post_delete, sender=Repo)
+def invalidate_repo_tree(sender, instance, **kwargs):
+    bump_tree_generation(instance.pk)
+
+
+@receiver(post_save, sender=Box)
+@receiver(post_delete, sender=Box)
+@receiver(post_save, sender=RepoAccess)
+@receiver(post_delete, sender=RepoAccess)
+def invalidate_parent_repo_tree(sender, instance, **kwargs):
+    bump_tree_generation(instance.repo_id)
+
+
+@receiver(post_save, sender=BoxMedia)
+@receiver(post_delete, sender=BoxMedia)
+def invalidate_box_media_tree(sender, instance, origin=None, **kwargs):
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if origin_model in (Box, Repo):
+        # A cascade; the receivers of the box or repo bump the same tree
+        return
+    if current_media_delete_batch() is not None:
+        # Bumped once per repo when the batch ends
+        return
+    if BoxMedia.box.is_cached(instance):
+        repo_id = instance.box.repo_id
+    else:
+        repo_id = (
+            Box.objects.filter(pk=instance.box_id)
+            .values_list("repo_id", flat=True)
+            .first()
+        )
+    if repo_id is not None:
+        bump_tree_generation(repo_id)
+
+
+@receiver(post_delete, sender=Box)
+def decrement_repo_box_count(sender, instance, **kwargs):
+    """Runs inside the delete's transaction, cascades included"""
+    Repo.objects.filter(pk=instance.repo_id, box_count__gt=0).update(
+        box_count=F("box_count") - 1
+    )
+
+
+@receiver(post_delete, sender=Repo)
+def decrement_user_repo_count(sender, instance, **kwargs):
+    UserRepoCounter.decrement(instance.user_id)
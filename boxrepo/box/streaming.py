@@ -0,0 +1,203 @@
+import re
+import uuid
+
+from botocore.exceptions import ClientError
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+from box.aws_utils.s3_utils import iter_body_chunks
+
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+# Beyond this many ranges a multipart response costs more than the whole file
+MAX_RANGES = 8
+RANGE_SPEC_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+def s3_object_response(s3_object, body=None):
+    """Stream a GetObject response to the client chunk by chunk
+
+    body overrides the chunk iterator, e.g. with an async one under ASGI.
+    """
+    response = StreamingHttpResponse(
+        iter_body_chunks(s3_object["Body"]) if body is None else body,
+        content_type=s3_object.get("ContentType") or DEFAULT_CONTENT_TYPE,
+    )
+    response["Content-Length"] = s3_object["ContentLength"]
+    response["Accept-Ranges"] = "bytes"
+    if s3_object.get("ETag"):
+        response["ETag"] = s3_object["ETag"]
+    if s3_object.get("LastModified"):
+        response["Last-Modified"] = http_date(s3_object["LastModified"].timestamp())
+    if s3_object.get("ContentRange"):
+        response.status_code = 206
+        response["Content-Range"] = s3_object["ContentRange"]
+    return response
+
+
+def parse_range_header(header):
+    """Parse a bytes Range header into [(start, end), ...]
+
+    Either bound may be None for open and suffix ranges. Returns None when
+    the header is missing or malformed, in which case it must be ignored.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        match = RANGE_SPEC_RE.match(part)
+        if not match:
+            return None
+        start, end = (int(bound) if bound else None for bound in match.groups())
+        if start is None and end is None:
+            return None
+        if start is not None and end is not None and end < start:
+            return None
+        ranges.append((start, end))
+    return ranges
+
+
+def resolve_ranges(ranges, size):
+    """Clamp ranges to the object size, drop unsatisfiable ones, merge overlaps"""
+    resolved = []
+    for start, end in ranges:
+        if start is None:
+            if end == 0:
+                continue
+            start, end = max(size - end, 0), size - 1
+        else:
+            if start >= size:
+                continue
+            end = size - 1 if end is None else min(end, size - 1)
+        resolved.append((start, end))
+    merged = []
+    for start, end in sorted(resolved):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def format_range(start, end):
+    return f"bytes={'' if start is None else start}-{'' if end is None else end}"
+
+
+def if_range_conditions(header):
+    """Translate If-Range into S3 GetObject preconditions
+
+    Returns None when the validator can never match (weak or unparseable),
+    meaning the full object has to be sent.
+    """
+    if not header:
+        return {}
+    header = header.strip()
+    if header.startswith('"'):
+        return {"if_match": header}
+    if header.startswith("W/"):
+        return None
+    last_modified = parse_http_date_safe(header)
+    if last_modified is None:
+        return None
+    return {"if_unmodified_since": last_modified}
+
+
+def _matches_conditions(head, conditions):
+    if "if_match" in conditions:
+        return head["ETag"] == conditions["if_match"]
+    if "if_unmodified_since" in conditions:
+        return head["LastModified"].timestamp() <= conditions["if_unmodified_since"]
+    return True
+
+
+def _error_code(error):
+    return error.response.get("Error", {}).get("Code")
+
+
+def range_not_satisfiable(size):
+    response = HttpResponse(status=416)
+    response["Content-Range"] = f"bytes */{size}"
+    return response
+
+
+def s3_media_response(s3, key, range_header=None, if_range=None, version=None):
+    """Serve an S3 object, honouring Range and If-Range
+
+    Single ranges are passed straight to a ranged S3 GET. Multiple ranges
+    become a multipart/byteranges body with one ranged GET per part.
+    Whole-object responses go through the disk cache when a version is given.
+    """
+    ranges = parse_range_header(range_header)
+    conditions = if_range_conditions(if_range) if ranges else {}
+    if not ranges or conditions is None:
+        return s3_object_response(s3.get_cached_file_object(key, version))
+
+    if len(ranges) == 1:
+        try:
+            s3_object = s3.get_file_object(
+                key, byte_range=format_range(*ranges[0]), **conditions
+            )
+        except ClientError as error:
+            code = _error_code(error)
+            if code == "InvalidRange":
+                return range_not_satisfiable(s3.head_file(key)["ContentLength"])
+            if code in ("PreconditionFailed", "412"):
+                return s3_object_response(s3.get_file_object(key))
+            raise
+        return s3_object_response(s3_object)
+
+    head = s3.head_file(key)
+    if not _matches_conditions(head, conditions):
+        return s3_object_response(s3.get_file_object(key))
+    size = head["ContentLength"]
+    resolved = resolve_ranges(ranges, size)
+    if not resolved:
+        return range_not_satisfiable(size)
+    if len(resolved) > MAX_RANGES:
+        return s3_object_response(s3.get_file_object(key, if_match=head["ETag"]))
+    if len(resolved) == 1:
+        return s3_object_response(
+            s3.get_file_object(
+                key, byte_range=format_range(*resolved[0]), if_match=head["ETag"]
+            )
+        )
+    return _multipart_response(s3, key, head, resolved)
+
+
+def _multipart_response(s3, key, head, ranges):
+    size = head["ContentLength"]
+    content_type = head.get("ContentType") or DEFAULT_CONTENT_TYPE
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode("ascii")
+        for start, end in ranges
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode("ascii")
+
+    def body():
+        for part_header, (start, end) in zip(part_headers, ranges):
+            yield part_header
+            part = s3.get_file_object(
+                key, byte_range=format_range(start, end), if_match=head["ETag"]
+            )
+            yield from iter_body_chunks(part["Body"])
+        yield closing
+
+    response = StreamingHttpResponse(
+        body(),
+        status=206,
+        content_type=f"multipart/byteranges; boundary={boundary}",
+    )
+    response["Content-Length"] = (
+        sum(len(part_header) for part_header in part_headers)
+        + sum(end - start + 1 for start, end in ranges)
+        + len(closing)
+    )
+    response["Accept-Ranges"] = "bytes"
+    return response
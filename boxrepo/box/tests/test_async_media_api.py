@@ -0,0 +1,227 @@
+import os
+from unittest import mock
+
+import boto3
+from asgiref.sync import sync_to_async
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from moto.server import ThreadedMotoServer
+from rest_framework.authtoken.models import Token
+
+from box.aws_utils.async_s3_utils import close_async_s3_client
+from box.models import Box, BoxMedia, Repo
+from box.tests.utils import TEST_BUCKET, create_user
+
+ASYNC_BOX_MEDIA_LIST_URL = reverse("box:async_boxmedia-list")
+
+
+def async_box_media_url(box_media_id):
+    return reverse("box:async_boxmedia-detail", args=[box_media_id])
+
+
+class FakeBody:
+    """Stands in for aiobotocore's StreamingBody"""
+
+    def __init__(self, content):
+        self.content = content
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    async def iter_chunks(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+
+class AsyncBoxMediaApiTests(TestCase):
+    def setUp(self):
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.token = Token.objects.create(user=self.user)
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        self.box_media = BoxMedia.objects.create(
+            user=self.user, box=self.box, file_name="photo.png", etag='"abc"'
+        )
+        patcher = mock.patch("box.async_views.AsyncS3FileManager")
+        self.s3 = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.s3.upload_file = mock.AsyncMock(return_value='"etag-1"')
+        self.s3.delete_file = mock.AsyncMock()
+        self.auth = {"Authorization": f"Token {self.token.key}"}
+
+    async def test_requires_token(self):
+        res = await self.async_client.get(async_box_media_url(self.box_media.id))
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_wsgi_requests_are_refused(self):
+        res = self.client.get(async_box_media_url(self.box_media.id), headers=self.auth)
+
+        self.assertEqual(res.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        self.s3.get_file_object.assert_not_called()
+
+    async def test_retrieve_streams_object(self):
+        content = b"x" * 100_000
+        self.s3.get_file_object = mock.AsyncMock(
+            return_value={
+                "Body": FakeBody(content),
+                "ContentLength": len(content),
+                "ContentType": "image/png",
+                "ETag": '"abc"',
+            }
+        )
+
+        res = await self.async_client.get(
+            async_box_media_url(self.box_media.id), headers=self.auth
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res["Content-Length"], str(len(content)))
+        self.assertEqual(b"".join([chunk async for chunk in res]), content)
+        self.s3.get_file_object.assert_awaited_once_with(
+            self.box_media.s3_bucket_file_path
+        )
+
+    async def test_retrieve_not_modified(self):
+        self.s3.get_file_object = mock.AsyncMock()
+
+        res = await self.async_client.get(
+            async_box_media_url(self.box_media.id),
+            headers={"If-None-Match": '"abc"', **self.auth},
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.s3.get_file_object.assert_not_awaited()
+
+    async def test_create_stores_etag(self):
+        upload = SimpleUploadedFile("new.png", b"bytes", content_type="image/png")
+
+        res = await self.async_client.post(
+            ASYNC_BOX_MEDIA_LIST_URL,
+            {"box": self.box.id, "file_name": "new.png", "file": upload},
+            headers=self.auth,
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        box_media = await BoxMedia.objects.aget(id=res.json()["id"])
+        self.assertEqual(box_media.etag, '"etag-1"')
+        self.s3.upload_file.assert_awaited_once()
+
+    async def test_create_rejects_bad_input(self):
+        for data, expected in (
+            ({"file_name": "new.png"}, status.HTTP_400_BAD_REQUEST),
+            ({"box": "x", "file_name": "new.png"}, status.HTTP_400_BAD_REQUEST),
+            (
+                {"box": self.box.id + 1, "file_name": "new.png"},
+                status.HTTP_404_NOT_FOUND,
+            ),
+            ({"box": self.box.id}, status.HTTP_400_BAD_REQUEST),
+        ):
+            with self.subTest(data=data):
+                upload = SimpleUploadedFile("new.png", b"bytes")
+                res = await self.async_client.post(
+                    ASYNC_BOX_MEDIA_LIST_URL,
+                    {**data, "file": upload},
+                    headers=self.auth,
+                )
+                self.assertEqual(res.status_code, expected)
+        self.assertEqual(await BoxMedia.objects.acount(), 1)
+        self.s3.upload_file.assert_not_awaited()
+
+    async def test_destroy(self):
+        res = await self.async_client.delete(
+            async_box_media_url(self.box_media.id), headers=self.auth
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(await BoxMedia.objects.filter(id=self.box_media.id).aexists())
+        self.s3.delete_file.assert_awaited_once_with(
+            key=self.box_media.s3_bucket_file_path
+        )
+
+    async def test_destroy_without_access_is_rejected(self):
+        other = await sync_to_async(create_user)(
+            username="other@boxrepo.com", password="testpass"
+        )
+        token = await Token.objects.acreate(user=other)
+
+        res = await self.async_client.delete(
+            async_box_media_url(self.box_media.id),
+            headers={"Authorization": f"Token {token.key}"},
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertTrue(await BoxMedia.objects.filter(id=self.box_media.id).aexists())
+        self.s3.delete_file.assert_not_awaited()
+
+
+class AsyncS3RoundTripTests(TestCase):
+    """The async views against a moto server, through the real aioboto3 client
+
+    moto's in-process mock cannot answer aiobotocore, so this runs moto's
+    HTTP server on a local port.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+        cls.server.start()
+        cls.addClassCleanup(cls.server.stop)
+        host, port = cls.server.get_host_and_port()
+        env = mock.patch.dict(
+            os.environ,
+            {
+                "AWS_ACCESS_KEY_ID": "testing",
+                "AWS_SECRET_ACCESS_KEY": "testing",
+                "AWS_DEFAULT_REGION": "us-east-1",
+                "S3_BUCKET_NAME": TEST_BUCKET,
+                "S3_ENDPOINT_URL": f"http://{host}:{port}",
+            },
+        )
+        env.start()
+        cls.addClassCleanup(env.stop)
+        cls.s3 = boto3.client("s3", endpoint_url=os.environ["S3_ENDPOINT_URL"])
+        cls.s3.create_bucket(Bucket=TEST_BUCKET)
+
+    def setUp(self):
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.token = Token.objects.create(user=self.user)
+        repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=repo, box_name="Box")
+        self.auth = {"Authorization": f"Token {self.token.key}"}
+
+    async def test_upload_download_and_delete(self):
+        try:
+            upload = SimpleUploadedFile("photo.png", b"async bytes")
+            res = await self.async_client.post(
+                ASYNC_BOX_MEDIA_LIST_URL,
+                {"box": self.box.id, "file_name": "photo.png", "file": upload},
+                headers=self.auth,
+            )
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+            box_media = await BoxMedia.objects.aget(id=res.json()["id"])
+            self.assertTrue(box_media.etag)
+
+            res = await self.async_client.get(
+                async_box_media_url(box_media.id), headers=self.auth
+            )
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(b"".join([chunk async for chunk in res]), b"async bytes")
+
+            res = await self.async_client.delete(
+                async_box_media_url(box_media.id), headers=self.auth
+            )
+            self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+            listing = await sync_to_async(self.s3.list_objects_v2)(Bucket=TEST_BUCKET)
+            self.assertNotIn("Contents", listing)
+        finally:
+            # The client belongs to this test's event loop
+            await close_async_s3_client()
@@ -0,0 +1,336 @@
+"""Endpoint benchmarks gated against a committed baseline
+
+Every router endpoint runs against repos seeded with BOX_BENCHMARK_SIZES
+boxes (one media each, plus as many media again in the first box) and an
+in-process moto bucket. Each run fails when an endpoint issues more
+queries than the baseline recorded for the same size, or when its queries
+grow from the smallest to the largest size faster than they did in the
+baseline, so a hot path scales worse.
+
+Wall time, peak traced allocations and response bytes depend on the
+machine and its load, so they are only measured and checked with
+
+    BOX_BENCHMARK_FULL=1 python manage.py test box.tests.test_benchmarks
+
+which also fails when a response is noticeably larger than the baseline,
+or when time or allocations grow faster than they did in the baseline.
+Absolute times are never compared, only their growth. Regenerate the
+baseline after an intended change with
+
+    BOX_BENCHMARK_UPDATE=1 python manage.py test box.tests.test_benchmarks
+
+and larger trees with e.g. BOX_BENCHMARK_SIZES=10,1000,10000.
+"""
+
+import json
+import logging
+import os
+import time
+import tracemalloc
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, reset_queries
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from box.models import Box, BoxMedia, Repo, RepoAccess
+from box.tests.utils import TEST_BUCKET, S3TestCase
+from user.models import Account
+
+logger = logging.getLogger(__name__)
+
+BASELINE_PATH = Path(__file__).with_name("benchmark_baseline.json")
+SIZES = [int(size) for size in os.getenv("BOX_BENCHMARK_SIZES", "10,100").split(",")]
+UPDATE_BASELINE = os.getenv("BOX_BENCHMARK_UPDATE", "").lower() in ("1", "true")
+FULL_CHECKS = os.getenv("BOX_BENCHMARK_FULL", "").lower() in ("1", "true")
+# Best of this many timed runs per endpoint
+REPEAT = int(os.getenv("BOX_BENCHMARK_REPEAT", 3))
+# Allowed factor over the baseline's growth in time and allocations
+GROWTH_TOLERANCE = float(os.getenv("BOX_BENCHMARK_GROWTH_TOLERANCE", 2.0))
+# Allowed factor over the baseline's response size; ids and dates vary
+BYTES_TOLERANCE = float(os.getenv("BOX_BENCHMARK_BYTES_TOLERANCE", 1.25))
+# Growth below this many seconds or bytes is noise, not scaling
+TIME_FLOOR = 0.02
+ALLOCATION_FLOOR = 256 * 1024
+
+FILE_CONTENT = b"benchmark-bytes" * 64
+
+
+def _upload(name="photo.png"):
+    return SimpleUploadedFile(name, FILE_CONTENT, content_type="image/png")
+
+
+class Fixture:
+    """A user owning one repo of `size` boxes, and a stored media file"""
+
+    def __init__(self, s3, size):
+        self.s3 = s3
+        self.size = size
+        self.user = get_user_model().objects.create_user(
+            username=f"bench_{size}@boxrepo.com", password="testpass", is_staff=True
+        )
+        Account.objects.create(user=self.user, account_type="PAID")
+        self.repo = Repo.objects.create(user=self.user, repo_name=f"Repo {size}")
+        boxes = Box.objects.bulk_create(
+            Box(user=self.user, repo=self.repo, box_name=f"Box {i}")
+            for i in range(size)
+        )
+        Repo.objects.filter(pk=self.repo.pk).update(box_count=size)
+        self.box = boxes[0]
+        BoxMedia.objects.bulk_create(
+            BoxMedia(user=self.user, box=box, file_name=f"file {i}")
+            for i, box in enumerate(boxes)
+        )
+        BoxMedia.objects.bulk_create(
+            BoxMedia(user=self.user, box=self.box, file_name=f"extra {i}")
+            for i in range(size)
+        )
+        self.box_media = self.stored_media()
+
+    def stored_media(self, upload_status=BoxMedia.UPLOAD_STATUS_COMPLETE):
+        box_media = BoxMedia.objects.create(
+            user=self.user,
+            box=self.box,
+            file_name="stored.png",
+            upload_status=upload_status,
+        )
+        response = self.s3.put_object(
+            Bucket=TEST_BUCKET, Key=box_media.s3_bucket_file_path, Body=FILE_CONTENT
+        )
+        box_media.etag = response["ETag"]
+        box_media.save(update_fields=["etag"])
+        return box_media
+
+
+def _media_url(box_media, action=None):
+    if action is None:
+        return reverse("box:boxmedia-detail", args=[box_media.id])
+    return reverse(f"box:boxmedia-{action}", args=[box_media.id])
+
+
+# name -> prepare(fixture) returning (method, url, request kwargs); prepare
+# runs before every request so writes never act on a row twice
+ENDPOINTS = {
+    "repo-list": lambda f: ("get", reverse("box:repo-list"), {}),
+    "repo-create": lambda f: (
+        "post",
+        reverse("box:repo-list"),
+        {"data": {"user": f.user.id, "repo_name": "New repo"}},
+    ),
+    "repo-item": lambda f: ("get", reverse("box:repo_item", args=[f.repo.id]), {}),
+    "repo-item-signed-urls": lambda f: (
+        "get",
+        reverse("box:repo_item", args=[f.repo.id]) + "?signed_urls=1",
+        {},
+    ),
+    "repo-list-names": lambda f: (
+        "get",
+        reverse("box:repo-list") + "?fields=id,repo_name",
+        {},
+    ),
+    "repo-item-boxes": lambda f: (
+        "get",
+        reverse("box:repo_item", args=[f.repo.id]) + "?expand=boxes_list",
+        {},
+    ),
+    "box-list": lambda f: ("get", reverse("box:box-list"), {}),
+    "box-create": lambda f: (
+        "post",
+        reverse("box:box-list"),
+        {"data": {"user": f.user.id, "repo": f.repo.id, "box_name": "New box"}},
+    ),
+    "box-detail": lambda f: ("get", reverse("box:box-detail", args=[f.box.id]), {}),
+    "box-update": lambda f: (
+        "put",
+        reverse("box:box-detail", args=[f.box.id]),
+        {"data": {"user": f.user.id, "repo": f.repo.id, "box_name": "Box 0"}},
+    ),
+    "repoaccess-list": lambda f: ("get", reverse("box:repoaccess-list"), {}),
+    "repoaccess-create": lambda f: (
+        "post",
+        reverse("box:repoaccess-list"),
+        {
+            "data": {
+                "user": get_user_model()
+                .objects.create_user(
+                    username=f"viewer_{time.perf_counter_ns()}@boxrepo.com"
+                )
+                .id,
+                "repo": f.repo.id,
+                "access_type": RepoAccess.REPO_ACCESS_TYPE_VIEWER,
+            }
+        },
+    ),
+    "boxmedia-detail": lambda f: ("get", _media_url(f.box_media), {}),
+    "boxmedia-create": lambda f: (
+        "post",
+        reverse("box:boxmedia-list"),
+        {
+            "data": {"box": f.box.id, "file_name": "photo.png", "file": _upload()},
+            "format": "multipart",
+        },
+    ),
+    "boxmedia-update": lambda f: (
+        "put",
+        _media_url(f.box_media),
+        {
+            "data": {"box": f.box.id, "file_name": "photo.png", "file": _upload()},
+            "format": "multipart",
+        },
+    ),
+    "boxmedia-destroy": lambda f: ("delete", _media_url(f.stored_media()), {}),
+    "boxmedia-presign": lambda f: (
+        "post",
+        reverse("box:boxmedia-presign"),
+        {"data": {"box": f.box.id, "file_name": "photo.png", "file_size": 1024}},
+    ),
+    "boxmedia-finalize": lambda f: (
+        "post",
+        _media_url(f.stored_media(BoxMedia.UPLOAD_STATUS_PENDING), "finalize"),
+        {},
+    ),
+    "boxmedia-bulk-upload": lambda f: (
+        "post",
+        reverse("box:boxmedia-bulk-upload"),
+        {
+            "data": {
+                "box": f.box.id,
+                "file": [_upload(f"photo_{i}.png") for i in range(3)],
+            },
+            "format": "multipart",
+        },
+    ),
+    "boxmedia-bulk-delete": lambda f: (
+        "post",
+        reverse("box:boxmedia-bulk-delete"),
+        # Scales with the size, so a per-row query or S3 call shows as growth
+        {"data": {"ids": [f.stored_media().id for _ in range(min(f.size, 100))]}},
+    ),
+    "boxmedia-cache-stats": lambda f: ("get", reverse("box:boxmedia-cache-stats"), {}),
+}
+
+
+def _send(client, method, url, kwargs):
+    response = getattr(client, method)(url, **kwargs)
+    # Streamed bodies are only produced as they are consumed
+    return response, len(response.getvalue())
+
+
+def measure(client, fixture, prepare, full=True):
+    """Query count, best wall time, peak allocations and size of one request
+
+    Without full only the query count is measured.
+    """
+    # Warm caches and lazy imports so every size starts from the same state
+    _send(client, *prepare(fixture))
+
+    seconds = []
+    for _ in range(REPEAT if full else 1):
+        request = prepare(fixture)
+        reset_queries()
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            response, response_bytes = _send(client, *request)
+            seconds.append(time.perf_counter() - start)
+        # Read now; the next request clears the log the capture slices
+        queries = len(ctx.captured_queries)
+    assert response.status_code < 400, (response.status_code, response.content)
+    if not full:
+        return {"queries": queries}
+
+    request = prepare(fixture)
+    tracemalloc.start()
+    try:
+        _send(client, *request)
+        _, allocated_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "queries": queries,
+        "seconds": round(min(seconds), 6),
+        "allocated_bytes": allocated_bytes,
+        "response_bytes": response_bytes,
+    }
+
+
+def load_baseline():
+    if not BASELINE_PATH.exists():
+        return {}
+    return json.loads(BASELINE_PATH.read_text())
+
+
+def write_baseline(results):
+    baseline = load_baseline()
+    for name, by_size in results.items():
+        baseline.setdefault(name, {}).update(by_size)
+    BASELINE_PATH.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+
+
+def growth(by_size, metric, small, large, floor=0):
+    """How much a metric grows from the small to the large size"""
+    low, high = by_size[small][metric], by_size[large][metric]
+    return max(high - low, floor) / max(low, 1)
+
+
+@override_settings(TREE_CACHE_TIMEOUT=0)
+class EndpointBenchmarkTests(S3TestCase):
+    def test_endpoints_against_baseline(self):
+        results = {name: {} for name in ENDPOINTS}
+        for size in SIZES:
+            fixture = Fixture(self.s3, size)
+            client = APIClient()
+            client.force_authenticate(user=fixture.user)
+            for name, prepare in ENDPOINTS.items():
+                results[name][str(size)] = measure(
+                    client, fixture, prepare, full=FULL_CHECKS or UPDATE_BASELINE
+                )
+                logger.info(f"benchmark {name}@{size}: {results[name][str(size)]}")
+
+        if UPDATE_BASELINE:
+            write_baseline(results)
+            return
+        baseline = load_baseline()
+        if not baseline:
+            self.skipTest(f"No benchmark baseline at {BASELINE_PATH}")
+        for name, by_size in results.items():
+            with self.subTest(endpoint=name):
+                self.assertIn(name, baseline, "Endpoint missing from the baseline")
+                self.assertWithinBaseline(by_size, baseline[name])
+
+    def assertWithinBaseline(self, results, baseline):
+        sizes = [size for size in results if size in baseline]
+        for size in sizes:
+            self.assertLessEqual(
+                results[size]["queries"],
+                baseline[size]["queries"],
+                f"More queries than the baseline at size {size}",
+            )
+            if FULL_CHECKS:
+                self.assertLessEqual(
+                    results[size]["response_bytes"],
+                    baseline[size]["response_bytes"] * BYTES_TOLERANCE,
+                    f"Larger response than the baseline at size {size}",
+                )
+        if len(sizes) < 2:
+            return
+        small, large = min(sizes, key=int), max(sizes, key=int)
+        self.assertLessEqual(
+            growth(results, "queries", small, large),
+            growth(baseline, "queries", small, large),
+            f"Queries grow faster from size {small} to {large} than the baseline",
+        )
+        if not FULL_CHECKS:
+            return
+        for metric, floor in (
+            ("seconds", TIME_FLOOR),
+            ("allocated_bytes", ALLOCATION_FLOOR),
+        ):
+            self.assertLessEqual(
+                growth(results, metric, small, large, floor),
+                growth(baseline, metric, small, large, floor) * GROWTH_TOLERANCE,
+                f"{metric} grow faster from size {small} to {large} than the baseline",
+            )
@@ -1,4 +1,8 @@
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 
@@ -7,8 +11,10 @@ from rest_framework import status
 from rest_framework.renderers import JSONRenderer
 
 from user.models import Account
-from box.models import Box, Repo, RepoAccess, BoxMedia
+from box.models import Box, Repo, RepoAccess, BoxMedia, UserRepoCounter
 
+import io
+from datetime import timedelta
 import logging
 import json
 
@@ -96,6 +102,20 @@ class BoxApiTest(TestCase):
         owner_res = self.client.post(REPO_ACCESS_URL, payload)
         self.assertEqual(owner_res.status_code, status.HTTP_201_CREATED)
 
+    def test_duplicate_repo_access_is_rejected(self):
+        self.client.force_authenticate(user=self.user)
+        payload = {
+            "user": self.other_users[0].id,
+            "repo": self.repo.id,
+            "access_type": RepoAccess.REPO_ACCESS_TYPE_VIEWER,
+        }
+        self.client.post(REPO_ACCESS_URL, payload)
+
+        res = self.client.post(REPO_ACCESS_URL, payload)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(RepoAccess.objects.filter(repo=self.repo).count(), 2)
+
     def test_create_box_api(self):
         payload = {
             "user": self.user.id,
@@ -175,3 +195,501 @@ class BoxApiTest(TestCase):
         }
         res = self.client.post(BOX_URL, payload)
         self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(TREE_CACHE_TIMEOUT=0)
+@override_settings(SHARED_CACHE=True)
+class QueryBudgetTests(TestCase):
+    """Nested repo/box trees must be built from a fixed number of queries"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=self.user)
+
+    def _create_tree(self, repo_name, num_boxes, num_media):
+        repo = Repo.objects.create(user=self.user, repo_name=repo_name)
+        for i in range(num_boxes):
+            box = Box.objects.create(user=self.user, repo=repo, box_name=f"Box {i}")
+            BoxMedia.objects.bulk_create(
+                BoxMedia(user=self.user, box=box, file_name=f"file {j}")
+                for j in range(num_media)
+            )
+        return repo
+
+    def _count_queries(self, url):
+        # Warm the user's cached access map so both counts see the same path
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return len(ctx.captured_queries), res
+
+    def test_repo_retrieve_query_count_is_constant(self):
+        small = self._create_tree("Small", 1, 1)
+        large = self._create_tree("Large", 10, 5)
+
+        small_count, _ = self._count_queries(REPO_URL + f"{small.id}/")
+        large_count, res = self._count_queries(REPO_URL + f"{large.id}/")
+
+        self.assertEqual(small_count, large_count)
+        self.assertLessEqual(large_count, 4)
+        self.assertEqual(len(res.data["boxes_list"]), 10)
+        media = res.data["boxes_list"][0]["box_media_list"][0]
+        self.assertEqual(
+            media["s3_bucket_file_path"],
+            f"repo_{large.id}/box_{media['box_id']}/file_{media['id']}",
+        )
+
+    def test_box_retrieve_query_count_is_constant(self):
+        repo = self._create_tree("Repo", 2, 0)
+        small_box, large_box = repo.boxes.order_by("id")
+        BoxMedia.objects.create(user=self.user, box=small_box, file_name="file")
+        BoxMedia.objects.bulk_create(
+            BoxMedia(user=self.user, box=large_box, file_name=f"file {j}")
+            for j in range(20)
+        )
+
+        small_count, _ = self._count_queries(BOX_URL + f"{small_box.id}/")
+        large_count, res = self._count_queries(BOX_URL + f"{large_box.id}/")
+
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(len(res.data["box_media_list"]), 20)
+
+
+class PaginationTests(TestCase):
+    """List endpoints page through rows with an opaque keyset cursor"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.repos = [
+            Repo.objects.create(user=self.user, repo_name=f"Repo {i}") for i in range(7)
+        ]
+
+    def test_cursor_walks_every_repo_once(self):
+        seen = []
+        url = REPO_URL + "?page_size=3"
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(res.data["results"]), 3)
+            seen.extend(repo["id"] for repo in res.data["results"])
+            url = res.data["next"]
+
+        expected = [
+            repo.id
+            for repo in sorted(
+                self.repos, key=lambda r: (r.created_at, r.id), reverse=True
+            )
+        ]
+        self.assertEqual(seen, expected)
+
+    def test_previous_link_returns_prior_page(self):
+        first = self.client.get(REPO_URL + "?page_size=3")
+        self.assertIsNone(first.data["previous"])
+        second = self.client.get(first.data["next"])
+        back = self.client.get(second.data["previous"])
+        self.assertEqual(back.data["results"], first.data["results"])
+
+    def test_invalid_cursor_is_rejected(self):
+        res = self.client.get(REPO_URL + "?cursor=not-a-cursor")
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+# One test process, so its local cache is shared by every request
+@override_settings(SHARED_CACHE=True)
+class RepoPermissionCacheTests(TestCase):
+    """Repo access checks are served from a versioned access map cache"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.viewer = create_user(username="viewer@boxrepo.com", password="testpass")
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.repo_url = REPO_URL + f"{self.repo.id}/"
+
+    def test_warm_access_check_skips_repoaccess_table(self):
+        self.client.force_authenticate(user=self.user)
+        self.client.get(self.repo_url)
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(self.repo_url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertFalse(
+            any("box_repoaccess" in q["sql"] for q in ctx.captured_queries)
+        )
+
+    @override_settings(SHARED_CACHE=False)
+    def test_process_local_cache_is_not_trusted(self):
+        self.client.force_authenticate(user=self.user)
+        self.client.get(self.repo_url)
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(self.repo_url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(any("box_repoaccess" in q["sql"] for q in ctx.captured_queries))
+
+    def test_granting_and_revoking_access_invalidates_cache(self):
+        self.client.force_authenticate(user=self.viewer)
+        res = self.client.get(self.repo_url)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        access = RepoAccess.objects.create(
+            user=self.viewer,
+            repo=self.repo,
+            access_type=RepoAccess.REPO_ACCESS_TYPE_VIEWER,
+        )
+        res = self.client.get(self.repo_url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        access.delete()
+        res = self.client.get(self.repo_url)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_box_retrieve_requires_repo_access(self):
+        box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        self.client.force_authenticate(user=self.viewer)
+        res = self.client.get(BOX_URL + f"{box.id}/")
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(SHARED_CACHE=True)
+class ConditionalGetTests(TestCase):
+    """Repo and box detail answer revalidation with 304 Not Modified"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        self.repo_url = REPO_URL + f"{self.repo.id}/"
+        self.box_url = BOX_URL + f"{self.box.id}/"
+
+    def test_unchanged_repo_returns_304_without_loading_tree(self):
+        res = self.client.get(self.repo_url)
+        etag = res["ETag"]
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(self.repo_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_repo_etag_changes_when_tree_changes(self):
+        etag = self.client.get(self.repo_url)["ETag"]
+        media = BoxMedia.objects.create(user=self.user, box=self.box, file_name="a")
+        res = self.client.get(self.repo_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        etag = res["ETag"]
+        media.delete()
+        res = self.client.get(self.repo_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_box_conditional_get(self):
+        etag = self.client.get(self.box_url)["ETag"]
+        res = self.client.get(self.box_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        BoxMedia.objects.create(user=self.user, box=self.box, file_name="a")
+        res = self.client.get(self.box_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_unauthorized_user_gets_no_304(self):
+        etag = self.client.get(self.repo_url)["ETag"]
+        other_user = create_user(username="other@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=other_user)
+        res = self.client.get(self.repo_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(SHARED_CACHE=True)
+class TreeCacheTests(TestCase):
+    """Serialized trees are cached until a write to the repo invalidates them"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        self.repo_url = REPO_URL + f"{self.repo.id}/"
+        self.box_url = BOX_URL + f"{self.box.id}/"
+
+    def test_cached_tree_is_served_from_validators_query_alone(self):
+        first = self.client.get(self.repo_url)
+        with CaptureQueriesContext(connection) as ctx:
+            second = self.client.get(self.repo_url)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_media_writes_invalidate_repo_and_box_trees(self):
+        self.client.get(self.repo_url)
+        self.client.get(self.box_url)
+
+        media = BoxMedia.objects.create(user=self.user, box=self.box, file_name="a")
+        res = self.client.get(self.repo_url)
+        self.assertEqual(len(res.data["boxes_list"][0]["box_media_list"]), 1)
+
+        media.delete()
+        res = self.client.get(self.box_url)
+        self.assertEqual(res.data["box_media_list"], [])
+
+    def test_box_update_invalidates_repo_tree(self):
+        self.client.get(self.repo_url)
+
+        self.box.box_name = "Renamed"
+        self.box.save()
+
+        res = self.client.get(self.repo_url)
+        self.assertEqual(res.data["boxes_list"][0]["box_name"], "Renamed")
+
+    def test_missed_invalidation_still_serves_fresh_tree(self):
+        self.client.get(self.repo_url)
+
+        # A queryset update sends no signals, like a write whose
+        # invalidation never reached this worker's cache
+        Box.objects.filter(id=self.box.id).update(
+            box_name="Renamed", updated_at=timezone.now() + timedelta(seconds=1)
+        )
+
+        res = self.client.get(self.repo_url)
+        self.assertEqual(res.data["boxes_list"][0]["box_name"], "Renamed")
+
+
+class QuotaCounterTests(TestCase):
+    """Box and repo counts are maintained as rows are created and deleted"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+
+    def _box_count(self):
+        self.repo.refresh_from_db()
+        return self.repo.box_count
+
+    def test_counters_follow_creates_and_deletes(self):
+        box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        Box.objects.create(user=self.user, repo=self.repo, box_name="Box 2")
+        self.assertEqual(self._box_count(), 2)
+        self.assertEqual(self.user.repo_counter.repo_count, 1)
+
+        box.delete()
+        self.assertEqual(self._box_count(), 1)
+
+        self.repo.delete()
+        self.user.repo_counter.refresh_from_db()
+        self.assertEqual(self.user.repo_counter.repo_count, 0)
+
+    def test_moving_a_box_moves_its_count(self):
+        other_repo = Repo.objects.create(user=self.user, repo_name="Repo 2")
+        box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+
+        box = Box.objects.get(pk=box.pk)
+        box.repo = other_repo
+        box.save()
+
+        self.assertEqual(self._box_count(), 0)
+        other_repo.refresh_from_db()
+        self.assertEqual(other_repo.box_count, 1)
+
+    def test_box_quota_reads_the_counter(self):
+        Repo.objects.filter(pk=self.repo.pk).update(box_count=5)
+
+        res = self.client.post(
+            BOX_URL, {"user": self.user.id, "repo": self.repo.id, "box_name": "Box"}
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(Box.objects.exists())
+
+    def test_repo_quota_reads_the_counter(self):
+        UserRepoCounter.objects.filter(user=self.user).update(repo_count=5)
+
+        res = self.client.post(REPO_URL, {"repo_name": "Repo 2"})
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(Repo.objects.count(), 1)
+
+    def test_recompute_counters_repairs_drift(self):
+        Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        Repo.objects.update(box_count=7)
+        UserRepoCounter.objects.all().delete()
+
+        call_command("recompute_counters", stdout=io.StringIO())
+
+        self.assertEqual(self._box_count(), 1)
+        self.assertEqual(UserRepoCounter.objects.get(user=self.user).repo_count, 1)
+
+
+# One test process, so its local cache is shared by every request
+@override_settings(SHARED_CACHE=True)
+class EntitlementCacheTests(TestCase):
+    """Quota checks read the cached limits of the user's latest account"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=self.user)
+
+    def test_repo_create_does_not_query_accounts(self):
+        self.client.post(REPO_URL, {"user": self.user.id, "repo_name": "Repo 1"})
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.post(
+                REPO_URL, {"user": self.user.id, "repo_name": "Repo 2"}
+            )
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        tables = " ".join(query["sql"] for query in ctx.captured_queries)
+        self.assertNotIn("user_account", tables)
+
+    def test_new_account_lifts_the_limits(self):
+        UserRepoCounter.objects.create(user=self.user, repo_count=5)
+        payload = {"user": self.user.id, "repo_name": "Repo"}
+        res = self.client.post(REPO_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        res = self.client.post(
+            reverse("user:account-list"),
+            {"user": self.user.id, "account_type": "PAID", "account_paid_months": 1},
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+        res = self.client.post(REPO_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+    def test_account_update_invalidates_limits(self):
+        repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        Repo.objects.filter(pk=repo.pk).update(box_count=5)
+        payload = {"user": self.user.id, "repo": repo.id, "box_name": "Box"}
+        res = self.client.post(BOX_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        account = Account.objects.get(user=self.user)
+        account.account_type = Account.ACCOUNT_TYPE_PAID
+        account.save()
+
+        res = self.client.post(BOX_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+    @override_settings(SHARED_CACHE=False)
+    def test_process_local_cache_is_not_trusted(self):
+        UserRepoCounter.objects.create(user=self.user, repo_count=5)
+        payload = {"user": self.user.id, "repo_name": "Repo"}
+        res = self.client.post(REPO_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # A queryset update sends no signals, like an account saved by
+        # another worker whose invalidation never reached this cache
+        Account.objects.filter(user=self.user).update(
+            account_type=Account.ACCOUNT_TYPE_PAID
+        )
+
+        res = self.client.post(REPO_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+
+class SparseFieldsetTests(TestCase):
+    """?fields=, ?expand= and ?depth= trim the tree and what is queried for it"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo")
+        for i in range(3):
+            box = Box.objects.create(
+                user=self.user, repo=self.repo, box_name=f"Box {i}"
+            )
+            BoxMedia.objects.bulk_create(
+                BoxMedia(user=self.user, box=box, file_name=f"file {j}")
+                for j in range(2)
+            )
+        self.repo_url = REPO_URL + f"{self.repo.id}/"
+
+    def _get(self, url, params):
+        # The first request builds the tree, so it shows what was prefetched
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(url, params)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res, " ".join(query["sql"] for query in ctx.captured_queries)
+
+    def test_default_embeds_the_whole_tree(self):
+        res, _ = self._get(self.repo_url, {})
+
+        box = res.data["boxes_list"][0]
+        self.assertEqual(len(box["box_media_list"]), 2)
+        self.assertIn("file_name", box["box_media_list"][0])
+
+    def test_fields_without_relations_skip_their_queries(self):
+        res, sql = self._get(REPO_URL, {"fields": "id,repo_name"})
+
+        self.assertEqual(
+            res.data["results"], [{"id": self.repo.id, "repo_name": "Repo"}]
+        )
+        self.assertNotIn('FROM "box_box"', sql)
+        self.assertNotIn('FROM "box_boxmedia"', sql)
+
+    def test_dotted_fields_select_nested_fields(self):
+        res, sql = self._get(self.repo_url, {"fields": "repo_name,boxes_list.box_name"})
+
+        self.assertEqual(set(res.data), {"repo_name", "boxes_list"})
+        self.assertEqual(
+            sorted(box["box_name"] for box in res.data["boxes_list"]),
+            ["Box 0", "Box 1", "Box 2"],
+        )
+        self.assertEqual(set(res.data["boxes_list"][0]), {"box_name"})
+        self.assertNotIn('FROM "box_boxmedia"', sql)
+
+    def test_expand_embeds_only_named_relations(self):
+        res, sql = self._get(self.repo_url, {"expand": "boxes_list"})
+
+        self.assertIn("repo_name", res.data)
+        box = res.data["boxes_list"][0]
+        self.assertIn("box_name", box)
+        self.assertNotIn("box_media_list", box)
+        self.assertNotIn('FROM "box_boxmedia"', sql)
+
+        res, _ = self._get(self.repo_url, {"expand": "boxes_list.box_media_list"})
+        self.assertEqual(len(res.data["boxes_list"][0]["box_media_list"]), 2)
+
+    def test_depth_limits_nesting(self):
+        res, _ = self._get(self.repo_url, {"depth": "0"})
+        self.assertNotIn("boxes_list", res.data)
+
+        res, sql = self._get(self.repo_url, {"depth": "1"})
+        self.assertNotIn("box_media_list", res.data["boxes_list"][0])
+        self.assertNotIn('FROM "box_boxmedia"', sql)
+
+        res, _ = self._get(BOX_URL + f"{self.repo.boxes.first().id}/", {"depth": "1"})
+        self.assertEqual(len(res.data["box_media_list"]), 2)
+
+    def test_nested_media_fields(self):
+        res, _ = self._get(BOX_URL, {"fields": "id,box_media_list.file_name"})
+
+        for box in res.data["results"]:
+            self.assertEqual(set(box), {"id", "box_media_list"})
+            self.assertEqual(set(box["box_media_list"][0]), {"file_name"})
+
+    def test_unknown_fields_are_rejected(self):
+        for params in (
+            {"fields": "nope"},
+            {"fields": "boxes_list.nope"},
+            {"expand": "repo_name"},
+            {"depth": "-1"},
+            {"depth": "deep"},
+        ):
+            with self.subTest(params=params):
+                res = self.client.get(self.repo_url, params)
+                self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_writes_return_the_full_representation(self):
+        res = self.client.post(
+            REPO_URL + "?fields=id", {"user": self.user.id, "repo_name": "Repo 2"}
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data["repo_name"], "Repo 2")
+        self.assertIn("boxes_list", res.data)
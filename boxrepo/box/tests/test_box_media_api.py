@@ -0,0 +1,759 @@
+import base64
+import hashlib
+import os
+import tempfile
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from box.aws_utils.media_cache import media_cache
+from box.aws_utils.s3_utils import MB, S3FileManager, presigned_url_cache
+from box.blobs import upload_media_files
+from box.conditional import repo_tree_validators
+from box.models import Box, BoxMedia, MediaBlob, Repo
+from box.serializers import BoxMediaSerializer
+from box.tests.utils import TEST_BUCKET, S3TestCase, box_media_url, create_user
+from user.models import Account
+
+BOX_MEDIA_LIST_URL = reverse("box:boxmedia-list")
+
+
+class BoxMediaApiTests(S3TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        self.client.force_authenticate(user=self.user)
+
+    def _upload(self, content=b"image-bytes", content_type="image/png"):
+        upload = SimpleUploadedFile("photo.png", content, content_type=content_type)
+        res = self.client.post(
+            BOX_MEDIA_LIST_URL,
+            {"box": self.box.id, "file_name": "photo.png", "file": upload},
+            format="multipart",
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        return BoxMedia.objects.get(id=res.data["id"])
+
+    def test_upload_limit_follows_account_tier(self):
+        upload = SimpleUploadedFile("big.bin", os.urandom(6 * MB))
+        payload = {"box": self.box.id, "file_name": "big.bin", "file": upload}
+        res = self.client.post(BOX_MEDIA_LIST_URL, payload, format="multipart")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(res.data["max_size"], "5 MB")
+
+        Account.objects.create(user=self.user, account_type=Account.ACCOUNT_TYPE_PAID)
+        upload.seek(0)
+        with mock.patch.multiple(
+            "box.aws_utils.s3_utils",
+            MULTIPART_THRESHOLD=5 * MB,
+            MULTIPART_PART_SIZE=5 * MB,
+        ):
+            res = self.client.post(BOX_MEDIA_LIST_URL, payload, format="multipart")
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        box_media = BoxMedia.objects.get(id=res.data["id"])
+        self.assertTrue(box_media.etag.endswith('-2"'))
+
+    def test_retrieve_streams_raw_bytes(self):
+        content = os.urandom(200 * 1024)
+        box_media = self._upload(content)
+
+        res = self.client.get(box_media_url(box_media.id))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.streaming)
+        self.assertEqual(res["Content-Type"], "image/png")
+        self.assertEqual(int(res["Content-Length"]), len(content))
+        self.assertEqual(b"".join(res.streaming_content), content)
+
+    def test_retrieve_base64_is_opt_in(self):
+        box_media = self._upload(b"legacy")
+
+        res = self.client.get(box_media_url(box_media.id), {"encoding": "base64"})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.content, base64.b64encode(b"legacy"))
+
+    def test_retrieve_revalidates_with_stored_etag(self):
+        box_media = self._upload(b"cached")
+        res = self.client.get(box_media_url(box_media.id))
+        self.assertEqual(res["ETag"], box_media.etag)
+
+        with mock.patch("box.views.S3FileManager") as s3_manager:
+            res = self.client.get(
+                box_media_url(box_media.id), HTTP_IF_NONE_MATCH=box_media.etag
+            )
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        s3_manager.assert_not_called()
+
+    def test_retrieve_requires_repo_access(self):
+        box_media = self._upload()
+        other_user = create_user(username="other@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=other_user)
+
+        res = self.client.get(box_media_url(box_media.id))
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class BoxMediaRangeTests(S3TestCase):
+    """Range and If-Range map onto ranged S3 GETs"""
+
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        box = Box.objects.create(user=self.user, repo=repo, box_name="Box")
+        self.box_media = BoxMedia.objects.create(
+            user=self.user, box=box, file_name="photo.png"
+        )
+        self.etag = self.s3.put_object(
+            Bucket=TEST_BUCKET,
+            Key=self.box_media.s3_bucket_file_path,
+            Body=self.content,
+            ContentType="image/png",
+        )["ETag"]
+        self.client.force_authenticate(user=self.user)
+        self.url = box_media_url(self.box_media.id)
+
+    def test_single_range_returns_partial_content(self):
+        res = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(res["Content-Range"], f"bytes 10-19/{len(self.content)}")
+        self.assertEqual(b"".join(res.streaming_content), self.content[10:20])
+
+    def test_suffix_range(self):
+        res = self.client.get(self.url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(res.streaming_content), self.content[-5:])
+
+    def test_multiple_ranges_return_multipart_body(self):
+        res = self.client.get(self.url, HTTP_RANGE="bytes=0-3,100-103")
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(res["Content-Type"].startswith("multipart/byteranges"))
+        body = b"".join(res.streaming_content)
+        self.assertEqual(int(res["Content-Length"]), len(body))
+        self.assertIn(b"Content-Range: bytes 0-3/1024", body)
+        self.assertIn(self.content[0:4], body)
+        self.assertIn(b"Content-Range: bytes 100-103/1024", body)
+        self.assertIn(self.content[100:104], body)
+
+    def test_unsatisfiable_range(self):
+        res = self.client.get(self.url, HTTP_RANGE="bytes=5000-6000")
+        self.assertEqual(res.status_code, 416)
+        self.assertEqual(res["Content-Range"], f"bytes */{len(self.content)}")
+
+    def test_if_range_mismatch_sends_whole_file(self):
+        res = self.client.get(
+            self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"stale-etag"'
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(res.streaming_content), self.content)
+
+    def test_if_range_match_sends_range(self):
+        res = self.client.get(self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=self.etag)
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(res.streaming_content), self.content[:10])
+
+
+class PresignedUploadTests(S3TestCase):
+    """Uploads can go straight to S3 through a presign/finalize pair"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=repo, box_name="Box")
+        self.client.force_authenticate(user=self.user)
+
+    def _presign(self, **extra):
+        payload = {"box": self.box.id, "file_name": "photo.png", "file_size": 5}
+        payload.update(extra)
+        return self.client.post(reverse("box:boxmedia-presign"), payload)
+
+    def test_presign_reserves_pending_media(self):
+        res = self._presign(content_type="image/png")
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        box_media = BoxMedia.objects.get(id=res.data["box_media"]["id"])
+        self.assertEqual(box_media.upload_status, BoxMedia.UPLOAD_STATUS_PENDING)
+        self.assertEqual(res.data["upload"]["method"], "POST")
+        self.assertEqual(
+            res.data["upload"]["fields"]["key"], box_media.s3_bucket_file_path
+        )
+        res = self.client.get(box_media_url(box_media.id))
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+
+    def test_presign_put_and_finalize(self):
+        res = self._presign(method="put")
+        self.assertEqual(res.data["upload"]["method"], "PUT")
+        box_media = BoxMedia.objects.get(id=res.data["box_media"]["id"])
+        finalize_url = reverse("box:boxmedia-finalize", args=[box_media.id])
+
+        res = self.client.post(finalize_url)
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+
+        # Stand-in for the client's direct upload to the presigned URL
+        self.s3.put_object(
+            Bucket=TEST_BUCKET, Key=box_media.s3_bucket_file_path, Body=b"12345"
+        )
+        res = self.client.post(finalize_url)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        box_media.refresh_from_db()
+        self.assertEqual(box_media.upload_status, BoxMedia.UPLOAD_STATUS_COMPLETE)
+        self.assertTrue(box_media.etag)
+        res = self.client.get(box_media_url(box_media.id))
+        self.assertEqual(b"".join(res.streaming_content), b"12345")
+
+    def test_presign_rejects_oversized_files(self):
+        res = self._presign(file_size=1024 * 1024 * 1024)
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(BoxMedia.objects.exists())
+
+    def test_presign_requires_admin_access(self):
+        other_user = create_user(username="other@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=other_user)
+        res = self._presign()
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_presign_rejects_unknown_boxes(self):
+        self.assertEqual(
+            self._presign(box="x").status_code, status.HTTP_400_BAD_REQUEST
+        )
+        self.assertEqual(
+            self._presign(box=self.box.id + 1).status_code, status.HTTP_404_NOT_FOUND
+        )
+        self.assertFalse(BoxMedia.objects.exists())
+
+
+class PresignedDownloadTests(S3TestCase):
+    """Media can be handed out as short-lived presigned S3 URLs"""
+
+    def setUp(self):
+        super().setUp()
+        presigned_url_cache.clear()
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        self.box_media = BoxMedia.objects.create(
+            user=self.user, box=self.box, file_name="photo.png"
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_redirect_to_presigned_url(self):
+        res = self.client.get(
+            box_media_url(self.box_media.id), {"download": "redirect"}
+        )
+        self.assertEqual(res.status_code, status.HTTP_302_FOUND)
+        self.assertIn(self.box_media.s3_bucket_file_path, res["Location"])
+        self.assertIn("Signature", res["Location"])
+
+    def test_presigned_url_as_json(self):
+        res = self.client.get(box_media_url(self.box_media.id), {"download": "url"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn(self.box_media.s3_bucket_file_path, res.data["url"])
+
+    def test_repo_listing_embeds_cached_signed_urls(self):
+        repo_url = reverse("box:repo_item", args=[self.repo.id])
+        res = self.client.get(repo_url)
+        media = res.data["boxes_list"][0]["box_media_list"][0]
+        self.assertNotIn("download_url", media)
+
+        first = self.client.get(repo_url, {"signed_urls": 1})
+        second = self.client.get(repo_url, {"signed_urls": 1})
+        url = first.data["boxes_list"][0]["box_media_list"][0]["download_url"]
+        self.assertIn(self.box_media.s3_bucket_file_path, url)
+        self.assertEqual(
+            url, second.data["boxes_list"][0]["box_media_list"][0]["download_url"]
+        )
+        self.assertNotIn("ETag", first)
+
+    def test_non_members_get_no_signed_urls(self):
+        other_user = create_user(username="other@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=other_user)
+
+        for url in (reverse("box:repo-list"), reverse("box:box-list")):
+            with self.subTest(url=url):
+                res = self.client.get(url, {"signed_urls": 1})
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                self.assertEqual(res.data["results"], [])
+
+        request = Request(
+            APIRequestFactory().get("/", {"signed_urls": 1}),
+        )
+        request.user = other_user
+        data = BoxMediaSerializer(self.box_media, context={"request": request}).data
+        self.assertIsNone(data["download_url"])
+
+
+class BulkUploadTests(S3TestCase):
+    """Many files can be uploaded into a box in one request"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=repo, box_name="Box")
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse("box:boxmedia-bulk-upload")
+
+    def test_bulk_upload_reports_each_file(self):
+        files = [
+            SimpleUploadedFile(f"photo_{i}.png", f"image {i}".encode())
+            for i in range(3)
+        ]
+        files.append(SimpleUploadedFile("huge.bin", os.urandom(6 * MB)))
+
+        res = self.client.post(
+            self.url,
+            {"box": self.box.id, "file": files},
+            format="multipart",
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_207_MULTI_STATUS)
+        statuses = [result["status"] for result in res.data["results"]]
+        self.assertEqual(statuses, ["created", "created", "created", "failed"])
+        self.assertEqual(BoxMedia.objects.filter(box=self.box).count(), 3)
+        for box_media in BoxMedia.objects.filter(box=self.box):
+            body = self.s3.get_object(
+                Bucket=TEST_BUCKET, Key=box_media.s3_bucket_file_path
+            )["Body"].read()
+            self.assertEqual(body, f"image {box_media.file_name[6]}".encode())
+            self.assertTrue(box_media.etag)
+
+    def test_failed_storage_write_removes_row(self):
+        files = [SimpleUploadedFile(f"photo_{i}.png", b"image") for i in range(2)]
+
+        def flaky_upload(key, file_content, content_type=None):
+            if file_content.name == "photo_1.png":
+                raise RuntimeError("timeout")
+            return '"etag"'
+
+        with mock.patch(
+            "box.aws_utils.s3_utils.S3FileManager.upload_file",
+            side_effect=flaky_upload,
+        ):
+            res = self.client.post(
+                self.url,
+                {"box": self.box.id, "file": files, "file_name": ["a", "b"]},
+                format="multipart",
+            )
+        self.assertEqual(res.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(
+            list(BoxMedia.objects.values_list("file_name", flat=True)), ["a"]
+        )
+
+    def test_finishing_the_upload_changes_the_tree_etag(self):
+        etags = []
+
+        def upload(s3, box_media_list, received_files):
+            # The rows exist, without their ETags, while the files upload
+            etags.append(repo_tree_validators(self.box.repo_id).etag)
+            return upload_media_files(s3, box_media_list, received_files)
+
+        with mock.patch("box.views.upload_media_files", side_effect=upload):
+            res = self.client.post(
+                self.url,
+                {"box": self.box.id, "file": [SimpleUploadedFile("a.png", b"a")]},
+                format="multipart",
+            )
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        box_media = BoxMedia.objects.get(box=self.box)
+        self.assertTrue(box_media.etag)
+        self.assertNotEqual(repo_tree_validators(self.box.repo_id).etag, etags[0])
+
+    def test_bulk_upload_checks_permission(self):
+        other_user = create_user(username="other@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=other_user)
+        res = self.client.post(
+            self.url,
+            {"box": self.box.id, "file": [SimpleUploadedFile("a.png", b"a")]},
+            format="multipart",
+        )
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_bulk_upload_rejects_unknown_boxes(self):
+        for box, expected in (
+            ("x", status.HTTP_400_BAD_REQUEST),
+            (self.box.id + 1, status.HTTP_404_NOT_FOUND),
+        ):
+            with self.subTest(box=box):
+                res = self.client.post(
+                    self.url,
+                    {"box": box, "file": [SimpleUploadedFile("a.png", b"a")]},
+                    format="multipart",
+                )
+                self.assertEqual(res.status_code, expected)
+        self.assertFalse(BoxMedia.objects.exists())
+
+
+class BulkDeleteTests(S3TestCase):
+    """Many media can be deleted with batched DeleteObjects calls"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=repo, box_name="Box")
+        self.box_media_list = []
+        for i in range(3):
+            box_media = BoxMedia.objects.create(
+                user=self.user, box=self.box, file_name=f"photo_{i}.png"
+            )
+            self.s3.put_object(
+                Bucket=TEST_BUCKET, Key=box_media.s3_bucket_file_path, Body=b"x"
+            )
+            self.box_media_list.append(box_media)
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse("box:boxmedia-bulk-delete")
+
+    def _stored_keys(self):
+        listing = self.s3.list_objects_v2(Bucket=TEST_BUCKET)
+        return {obj["Key"] for obj in listing.get("Contents", [])}
+
+    def test_bulk_delete_by_ids(self):
+        doomed = self.box_media_list[:2]
+        res = self.client.post(
+            self.url, {"ids": [box_media.id for box_media in doomed]}, format="json"
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(res.data["deleted"]), [box_media.id for box_media in doomed]
+        )
+        self.assertEqual(
+            list(BoxMedia.objects.values_list("id", flat=True)),
+            [self.box_media_list[2].id],
+        )
+        self.assertEqual(
+            self._stored_keys(), {self.box_media_list[2].s3_bucket_file_path}
+        )
+
+    def test_bulk_delete_whole_box(self):
+        res = self.client.post(self.url, {"box": self.box.id}, format="json")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertFalse(BoxMedia.objects.exists())
+        self.assertEqual(self._stored_keys(), set())
+
+    def test_bulk_delete_checks_permission(self):
+        other_user = create_user(username="other@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=other_user)
+        res = self.client.post(self.url, {"box": self.box.id}, format="json")
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(BoxMedia.objects.count(), 3)
+
+    def test_non_integer_ids_are_rejected(self):
+        for payload in ({"ids": ["1", "x"]}, {"ids": [[1]]}, {"box": "x"}):
+            with self.subTest(payload=payload):
+                res = self.client.post(self.url, payload, format="json")
+                self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(BoxMedia.objects.count(), 3)
+
+    def test_rows_are_deleted_in_one_query(self):
+        counts = []
+        for doomed in (self.box_media_list[:1], self.box_media_list[1:]):
+            with CaptureQueriesContext(connection) as ctx:
+                res = self.client.post(
+                    self.url, {"ids": [box_media.id for box_media in doomed]}
+                )
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            statements = [query["sql"] for query in ctx.captured_queries]
+            self.assertEqual(
+                len([sql for sql in statements if sql.startswith("DELETE")]), 1
+            )
+            counts.append(len(statements))
+
+        self.assertFalse(BoxMedia.objects.exists())
+        self.assertEqual(counts[0], counts[1])
+
+    def test_each_repo_tree_is_bumped_once(self):
+        with mock.patch("box.batching.bump_tree_generation") as bump:
+            res = self.client.post(
+                self.url,
+                {"ids": [box_media.id for box_media in self.box_media_list]},
+                format="json",
+            )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        bump.assert_called_once_with(self.box.repo_id)
+
+    def test_box_delete_does_not_look_up_the_box_per_media(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.box.delete()
+
+        self.assertFalse(
+            any(
+                'SELECT "box_box"."repo_id"' in query["sql"]
+                for query in ctx.captured_queries
+            )
+        )
+
+    def test_keys_are_deleted_in_1000_key_batches(self):
+        s3 = S3FileManager()
+        with mock.patch.object(s3.client, "delete_objects", return_value={}) as call:
+            failed = s3.delete_files(f"key_{i}" for i in range(2500))
+        self.assertEqual(failed, set())
+        batch_sizes = sorted(
+            len(kwargs["Delete"]["Objects"]) for _, kwargs in call.call_args_list
+        )
+        self.assertEqual(batch_sizes, [500, 1000, 1000])
+
+
+@override_settings(BOX_MEDIA_DEDUPLICATION=True)
+class DeduplicatedStorageTests(S3TestCase):
+    """Identical content is stored once and shared between BoxMedia rows"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=repo, box_name="Box")
+        self.client.force_authenticate(user=self.user)
+
+    def _upload(self, content):
+        upload = SimpleUploadedFile("photo.png", content, content_type="image/png")
+        res = self.client.post(
+            BOX_MEDIA_LIST_URL,
+            {"box": self.box.id, "file_name": "photo.png", "file": upload},
+            format="multipart",
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        return BoxMedia.objects.get(id=res.data["id"])
+
+    def _stored_keys(self):
+        listing = self.s3.list_objects_v2(Bucket=TEST_BUCKET)
+        return [item["Key"] for item in listing.get("Contents", [])]
+
+    def test_reupload_skips_the_storage_write(self):
+        first = self._upload(b"same bytes")
+        with mock.patch.object(
+            S3FileManager, "upload_file", side_effect=AssertionError
+        ):
+            second = self._upload(b"same bytes")
+
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(second.etag, first.etag)
+        self.assertEqual(MediaBlob.objects.get().ref_count, 2)
+        self.assertEqual(self._stored_keys(), [first.s3_bucket_file_path])
+        res = self.client.get(box_media_url(second.id))
+        self.assertEqual(b"".join(res.streaming_content), b"same bytes")
+
+    def test_object_is_deleted_with_its_last_reference(self):
+        first = self._upload(b"shared")
+        second = self._upload(b"shared")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(box_media_url(first.id))
+        self.assertEqual(MediaBlob.objects.get().ref_count, 1)
+        self.assertEqual(self._stored_keys(), [second.s3_bucket_file_path])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(box_media_url(second.id))
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertEqual(self._stored_keys(), [])
+
+    def test_bulk_delete_releases_shared_blobs_once(self):
+        box_media_ids = [self._upload(b"shared").id for _ in range(3)]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as ctx:
+                res = self.client.post(
+                    reverse("box:boxmedia-bulk-delete"),
+                    {"ids": box_media_ids},
+                    format="json",
+                )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        updates = [
+            query["sql"]
+            for query in ctx.captured_queries
+            if query["sql"].startswith('UPDATE "box_mediablob"')
+        ]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertEqual(self._stored_keys(), [])
+
+    def test_box_delete_schedules_one_purge_per_blob(self):
+        for _ in range(3):
+            self._upload(b"shared")
+
+        with mock.patch("box.blobs.purge_blob") as purge_blob:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.box.delete()
+
+        purge_blob.assert_called_once()
+        self.assertEqual(MediaBlob.objects.get().ref_count, 0)
+
+    def test_failed_purge_does_not_fail_the_delete(self):
+        box_media = self._upload(b"content")
+
+        with mock.patch.object(
+            S3FileManager, "delete_file", side_effect=ClientError({}, "DeleteObject")
+        ):
+            with self.assertLogs("django", level="ERROR"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    res = self.client.delete(box_media_url(box_media.id))
+
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(BoxMedia.objects.exists())
+        self.assertFalse(MediaBlob.objects.exists())
+        # Orphaned until the next upload of the same content overwrites it
+        self.assertEqual(self._stored_keys(), [box_media.s3_bucket_file_path])
+
+    def test_object_is_deleted_after_its_row(self):
+        box_media = self._upload(b"content")
+
+        def delete_file(key):
+            self.assertFalse(MediaBlob.objects.exists())
+            self.s3.delete_object(Bucket=TEST_BUCKET, Key=key)
+
+        with mock.patch.object(
+            S3FileManager, "delete_file", side_effect=delete_file
+        ) as delete:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete(box_media_url(box_media.id))
+
+        delete.assert_called_once_with(key=box_media.s3_bucket_file_path)
+        self.assertEqual(self._stored_keys(), [])
+
+    def test_content_uploaded_during_a_purge_is_kept(self):
+        box_media = self._upload(b"content")
+        with self.captureOnCommitCallbacks() as purges:
+            self.client.delete(box_media_url(box_media.id))
+        with self.captureOnCommitCallbacks() as object_deletes:
+            for purge in purges:
+                purge()
+
+        uploaded_again = self._upload(b"content")
+        for delete_object in object_deletes:
+            delete_object()
+
+        res = self.client.get(box_media_url(uploaded_again.id))
+        self.assertEqual(b"".join(res.streaming_content), b"content")
+
+    def test_uploads_are_hashed_as_they_arrive(self):
+        content = os.urandom(1024)
+
+        with mock.patch.object(
+            S3FileManager, "upload_file", wraps=S3FileManager().upload_file
+        ) as upload_file:
+            self._upload(content)
+
+        received_file = upload_file.call_args.kwargs["file_content"]
+        self.assertEqual(received_file.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(MediaBlob.objects.get().digest, received_file.sha256)
+
+    def test_update_releases_the_previous_content(self):
+        box_media = self._upload(b"old")
+        upload = SimpleUploadedFile("photo.png", b"new", content_type="image/png")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.put(
+                box_media_url(box_media.id),
+                {"box": self.box.id, "file": upload},
+                format="multipart",
+            )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        box_media.refresh_from_db()
+        self.assertEqual(MediaBlob.objects.get().digest, box_media.blob_id)
+        self.assertEqual(self._stored_keys(), [box_media.s3_bucket_file_path])
+
+    def test_bulk_upload_stores_duplicates_once(self):
+        files = [SimpleUploadedFile(f"copy_{i}.png", b"duplicate") for i in range(3)]
+
+        res = self.client.post(
+            reverse("box:boxmedia-bulk-upload"),
+            {"box": self.box.id, "file": files},
+            format="multipart",
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(MediaBlob.objects.get().ref_count, 3)
+        self.assertEqual(
+            set(BoxMedia.objects.values_list("etag", flat=True)),
+            {MediaBlob.objects.get().etag},
+        )
+        self.assertEqual(len(self._stored_keys()), 1)
+
+
+class MediaCacheRetrieveTests(S3TestCase):
+    """Whole-object downloads are served from the local disk cache"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(media_cache, "directory", directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=repo, box_name="Box")
+        self.client.force_authenticate(user=self.user)
+
+    def _upload(self, content, box_media_id=None):
+        upload = SimpleUploadedFile("photo.png", content, content_type="image/png")
+        payload = {"box": self.box.id, "file_name": "photo.png", "file": upload}
+        if box_media_id is None:
+            res = self.client.post(BOX_MEDIA_LIST_URL, payload, format="multipart")
+        else:
+            res = self.client.put(
+                box_media_url(box_media_id), payload, format="multipart"
+            )
+        return res.data["id"]
+
+    def _download(self, box_media_id):
+        res = self.client.get(box_media_url(box_media_id))
+        content = b"".join(res.streaming_content)
+        res.close()
+        return content
+
+    def test_second_download_skips_s3(self):
+        box_media_id = self._upload(b"hot media")
+        self.assertEqual(self._download(box_media_id), b"hot media")
+
+        with mock.patch.object(
+            S3FileManager, "get_file_object", side_effect=AssertionError
+        ):
+            self.assertEqual(self._download(box_media_id), b"hot media")
+        self.assertEqual(media_cache.stats()["entries"], 1)
+
+    def test_update_invalidates_cached_copy(self):
+        box_media_id = self._upload(b"version one")
+        self._download(box_media_id)
+
+        self._upload(b"version two", box_media_id=box_media_id)
+
+        self.assertEqual(media_cache.stats()["entries"], 0)
+        self.assertEqual(self._download(box_media_id), b"version two")
+
+    def test_stats_are_staff_only(self):
+        url = reverse("box:boxmedia-cache-stats")
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.data["enabled"])
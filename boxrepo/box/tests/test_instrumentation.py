@@ -0,0 +1,126 @@
+import json
+import re
+
+from botocore.exceptions import ClientError
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, reset_queries
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from box.aws_utils.s3_utils import S3FileManager
+from box.metrics import S3_ERRORS
+from box.models import Box, BoxMedia, Repo
+from box.tests.utils import TEST_BUCKET, S3TestCase, create_user
+
+BOX_MEDIA_BULK_URL = reverse("box:boxmedia-bulk-upload")
+
+
+def server_timing(response):
+    """Server-Timing metrics as {name: (duration, description)}"""
+    return {
+        name: (float(duration), description)
+        for name, duration, description in re.findall(
+            r'(\w+);dur=([\d.]+)(?:;desc="([^"]*)")?', response["Server-Timing"]
+        )
+    }
+
+
+@override_settings(SERVER_TIMING_HEADER=True)
+class RequestInstrumentationTests(S3TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.repo = Repo.objects.create(user=self.user, repo_name="Repo 1")
+        self.box = Box.objects.create(user=self.user, repo=self.repo, box_name="Box")
+        self.client.force_authenticate(user=self.user)
+
+    def test_server_timing_counts_queries_and_rendering(self):
+        url = reverse("box:repo_item", args=[self.repo.id])
+        reset_queries()
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(url)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        metrics = server_timing(res)
+        self.assertEqual(metrics["db"][1], f"{len(ctx.captured_queries)} queries")
+        self.assertEqual(metrics["s3"][1], "0 calls, 0 bytes")
+        self.assertGreater(metrics["render"][0], 0)
+        self.assertGreaterEqual(metrics["total"][0], metrics["db"][0])
+
+    def test_s3_calls_from_upload_threads_are_counted(self):
+        files = [
+            SimpleUploadedFile(f"photo_{i}.png", b"x" * 100, content_type="image/png")
+            for i in range(3)
+        ]
+        res = self.client.post(
+            BOX_MEDIA_BULK_URL,
+            {"box": self.box.id, "file": files},
+            format="multipart",
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(server_timing(res)["s3"][1], "3 calls, 300 bytes")
+
+    def test_download_bytes_are_counted(self):
+        box_media = BoxMedia.objects.create(
+            user=self.user, box=self.box, file_name="photo.png"
+        )
+        self.s3.put_object(
+            Bucket=TEST_BUCKET, Key=box_media.s3_bucket_file_path, Body=b"y" * 512
+        )
+
+        res = self.client.get(reverse("box:boxmedia-detail", args=[box_media.id]))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(server_timing(res)["s3"][1], "1 calls, 512 bytes")
+
+    def test_only_failed_s3_calls_are_errors(self):
+        s3 = S3FileManager()
+        stored = s3.client.put_object(Bucket=TEST_BUCKET, Key="photo.png", Body=b"y")
+        key = S3_ERRORS._key({"operation": "GetObject"})
+        before = S3_ERRORS.values.get(key, 0)
+
+        # Not Modified is raised as an error but is a successful answer
+        with self.assertRaises(ClientError):
+            s3.client.get_object(
+                Bucket=TEST_BUCKET, Key="photo.png", IfNoneMatch=stored["ETag"]
+            )
+        self.assertEqual(S3_ERRORS.values.get(key, 0), before)
+
+        with self.assertRaises(ClientError):
+            s3.client.get_object(Bucket=TEST_BUCKET, Key="missing.png")
+        self.assertEqual(S3_ERRORS.values.get(key, 0), before + 1)
+
+    def test_logs_one_json_line_per_request(self):
+        with self.assertLogs("box.instrumentation", level="INFO") as logs:
+            self.client.get(reverse("box:repo_item", args=[self.repo.id]))
+
+        self.assertEqual(len(logs.records), 1)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["method"], "GET")
+        self.assertEqual(record["status"], status.HTTP_200_OK)
+        self.assertGreater(record["db_queries"], 0)
+        self.assertEqual(record["s3_calls"], 0)
+
+    @override_settings(SERVER_TIMING_HEADER=False)
+    def test_header_can_be_turned_off(self):
+        res = self.client.get(reverse("box:repo_item", args=[self.repo.id]))
+
+        self.assertNotIn("Server-Timing", res)
+
+    async def test_async_views_are_instrumented(self):
+        token = await Token.objects.acreate(user=self.user)
+
+        res = await self.async_client.get(
+            reverse("box:async_boxmedia-detail", args=[0]),
+            headers={"Authorization": f"Token {token.key}"},
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertRegex(server_timing(res)["db"][1], re.compile(r"^[1-9]\d* queries$"))
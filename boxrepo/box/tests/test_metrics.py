@@ -0,0 +1,189 @@
+import json
+import os
+import tempfile
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from box.metrics import registry
+from box.tests.utils import create_user
+
+METRICS_URL = reverse("metrics")
+# Above any pid_max, so never a live process
+DEAD_PID = 999999999
+
+
+def sample(text, name, **labels):
+    """The value of one sample in exposition text, or None"""
+    label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    prefix = f"{name}{{{label_text}}} " if labels else f"{name} "
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix) :])
+    return None
+
+
+class MetricsEndpointTests(TestCase):
+    def setUp(self):
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        self.metrics_dir = metrics_dir.name
+        settings = override_settings(
+            METRICS_DIR=self.metrics_dir, METRICS_TOKEN="scrape-secret"
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.client = APIClient()
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.group = str(os.getppid())
+
+    def _scrape(self):
+        res = self.client.get(METRICS_URL, HTTP_AUTHORIZATION="Bearer scrape-secret")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res.content.decode()
+
+    def _write_worker_file(self, pid, data, started=0):
+        path = os.path.join(self.metrics_dir, f"{self.group}-{pid}-{started}.json")
+        with open(path, "w") as file:
+            json.dump(data, file)
+        return path
+
+    def test_request_latency_per_viewset_action(self):
+        labels = {"view": "RepoViewSet", "action": "list"}
+        before = sample(
+            self._scrape(), "boxrepo_http_request_duration_seconds_count", **labels
+        )
+
+        self.client.get(reverse("box:repo-list"))
+        text = self._scrape()
+
+        self.assertEqual(
+            sample(text, "boxrepo_http_request_duration_seconds_count", **labels),
+            (before or 0) + 1,
+        )
+        self.assertIsNotNone(
+            sample(
+                text,
+                "boxrepo_http_request_duration_seconds_bucket",
+                **labels,
+                le="+Inf",
+            )
+        )
+        self.assertIsNotNone(
+            sample(
+                text,
+                "boxrepo_http_requests_total",
+                **labels,
+                method="GET",
+                status=200,
+            )
+        )
+        self.assertIn("# TYPE boxrepo_http_requests_in_flight gauge", text)
+
+    def test_cache_lookups_are_counted(self):
+        repo = self.client.post(
+            reverse("box:repo-list"), {"user": self.user.id, "repo_name": "Repo"}
+        ).data
+        url = reverse("box:repo_item", args=[repo["id"]])
+        self.client.get(url)
+        before = sample(
+            self._scrape(), "boxrepo_cache_requests_total", cache="tree", result="hit"
+        )
+
+        self.client.get(url)
+
+        self.assertEqual(
+            sample(
+                self._scrape(),
+                "boxrepo_cache_requests_total",
+                cache="tree",
+                result="hit",
+            ),
+            (before or 0) + 1,
+        )
+
+    def test_other_workers_are_merged(self):
+        before = sample(self._scrape(), "boxrepo_s3_bytes_total", operation="MergeTest")
+        self._write_worker_file(
+            os.getppid(),
+            {
+                "boxrepo_s3_bytes_total": [[["MergeTest"], 100]],
+                "boxrepo_http_requests_in_flight": [[[], 3]],
+            },
+        )
+
+        text = self._scrape()
+
+        self.assertEqual(
+            sample(text, "boxrepo_s3_bytes_total", operation="MergeTest"),
+            (before or 0) + 100,
+        )
+        self.assertGreaterEqual(sample(text, "boxrepo_http_requests_in_flight"), 3)
+
+    def test_exited_workers_are_archived(self):
+        path = self._write_worker_file(
+            DEAD_PID,
+            {
+                "boxrepo_s3_bytes_total": [[["ArchiveTest"], 100]],
+                "boxrepo_http_requests_in_flight": [[[], 50]],
+            },
+        )
+
+        text = self._scrape()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(
+            sample(text, "boxrepo_s3_bytes_total", operation="ArchiveTest"), 100
+        )
+        self.assertLess(sample(text, "boxrepo_http_requests_in_flight"), 50)
+
+        text = self._scrape()
+        self.assertEqual(
+            sample(text, "boxrepo_s3_bytes_total", operation="ArchiveTest"), 100
+        )
+
+    def test_previous_master_files_are_removed(self):
+        path = os.path.join(self.metrics_dir, f"{DEAD_PID}-1-0.json")
+        with open(path, "w") as file:
+            json.dump({"boxrepo_s3_bytes_total": [[["OldMaster"], 100]]}, file)
+
+        text = self._scrape()
+
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(sample(text, "boxrepo_s3_bytes_total", operation="OldMaster"))
+
+    def test_token_is_required(self):
+        res = self.client.get(METRICS_URL)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        res = self.client.get(METRICS_URL, HTTP_AUTHORIZATION="Bearer wrong")
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_scrapes_are_refused_without_a_configured_token(self):
+        res = self.client.get(METRICS_URL)
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = registry.histogram(
+            "boxrepo_test_histogram", "Test histogram", ["case"], buckets=(1, 5)
+        )
+        self.addCleanup(registry.metrics.pop, histogram.name)
+        for value in (0.5, 3, 3, 10):
+            histogram.observe(value, case="a")
+
+        text = self._scrape()
+
+        self.assertEqual(
+            sample(text, "boxrepo_test_histogram_bucket", case="a", le="1.0"), 1
+        )
+        self.assertEqual(
+            sample(text, "boxrepo_test_histogram_bucket", case="a", le="5.0"), 3
+        )
+        self.assertEqual(
+            sample(text, "boxrepo_test_histogram_bucket", case="a", le="+Inf"), 4
+        )
+        self.assertEqual(sample(text, "boxrepo_test_histogram_sum", case="a"), 16.5)
+        self.assertEqual(sample(text, "boxrepo_test_histogram_count", case="a"), 4)
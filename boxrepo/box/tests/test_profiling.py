@@ -0,0 +1,99 @@
+import os
+import pstats
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from box.tests.utils import create_user
+
+REPO_URL = reverse("box:repo-list")
+PROFILE_LIST_URL = reverse("box:profile-list")
+
+
+def profile_url(profile_id, action=None):
+    if action is None:
+        return reverse("box:profile-detail", args=[profile_id])
+    return reverse(f"box:profile-{action}", args=[profile_id])
+
+
+class RequestProfilingTests(TestCase):
+    def setUp(self):
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        settings = override_settings(PROFILE_DIR=profile_dir.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.staff = create_user(
+            username="staff@boxrepo.com", password="testpass", is_staff=True
+        )
+        self.user = create_user(username="test@boxrepo.com", password="testpass")
+        self.client = self._client_for(self.staff)
+
+    def _client_for(self, user):
+        client = APIClient()
+        token = Token.objects.create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        return client
+
+    def test_staff_request_is_profiled(self):
+        res = self.client.get(REPO_URL, HTTP_X_PROFILE="1")
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        profile_id = res["X-Profile-Id"]
+        res = self.client.get(PROFILE_LIST_URL)
+        self.assertEqual([profile["id"] for profile in res.data], [profile_id])
+
+    def test_query_parameter_triggers_profiling(self):
+        res = self.client.get(REPO_URL, {"profile": "1"})
+
+        self.assertIn("X-Profile-Id", res)
+
+    def test_profile_can_be_downloaded_and_summarized(self):
+        profile_id = self.client.get(REPO_URL, HTTP_X_PROFILE="1")["X-Profile-Id"]
+
+        res = self.client.get(profile_url(profile_id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        with tempfile.NamedTemporaryFile(suffix=".prof", delete=False) as file:
+            file.write(b"".join(res.streaming_content))
+        self.addCleanup(os.unlink, file.name)
+        self.assertGreater(pstats.Stats(file.name).total_calls, 0)
+
+        res = self.client.get(profile_url(profile_id, "stats"), {"sort": "tottime"})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn(b"function calls", res.content)
+
+    def test_unknown_profile_is_not_found(self):
+        res = self.client.get(profile_url(f"1-{'0' * 32}"))
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_non_staff_cannot_profile_or_download(self):
+        client = self._client_for(self.user)
+
+        res = client.get(REPO_URL, HTTP_X_PROFILE="1")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotIn("X-Profile-Id", res)
+        res = client.get(PROFILE_LIST_URL)
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_untriggered_requests_are_not_profiled(self):
+        with mock.patch("box.profiling.cProfile.Profile") as profiler:
+            res = self.client.get(REPO_URL)
+
+        self.assertNotIn("X-Profile-Id", res)
+        profiler.assert_not_called()
+
+    @override_settings(PROFILE_MAX_FILES=2)
+    def test_oldest_profiles_are_pruned(self):
+        ids = [
+            self.client.get(REPO_URL, HTTP_X_PROFILE="1")["X-Profile-Id"]
+            for _ in range(3)
+        ]
+
+        res = self.client.get(PROFILE_LIST_URL)
+        self.assertEqual([profile["id"] for profile in res.data], ids[:0:-1])
@@ -0,0 +1,93 @@
+import os
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+
+from box.models import Box, BoxMedia, Repo, RepoAccess
+from user.models import Account
+
+# Rows per table; raise it to check plans against production-sized tables
+FIXTURE_ROWS = int(os.getenv("BOX_QUERY_PLAN_ROWS", 2000))
+
+
+class QueryPlanTests(TestCase):
+    """The hot lookups are served by index scans, not table scans or sorts"""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = get_user_model().objects.bulk_create(
+            get_user_model()(username=f"user_{i}@boxrepo.com")
+            for i in range(FIXTURE_ROWS // 10)
+        )
+        Account.objects.bulk_create(
+            Account(user=user) for user in users for _ in range(2)
+        )
+        repos = Repo.objects.bulk_create(
+            Repo(user=users[i % len(users)], repo_name=f"Repo {i}")
+            for i in range(FIXTURE_ROWS)
+        )
+        RepoAccess.objects.bulk_create(
+            RepoAccess(
+                user=users[i % len(users)],
+                repo=repo,
+                access_type=RepoAccess.REPO_ACCESS_TYPE_VIEWER,
+            )
+            for i, repo in enumerate(repos)
+        )
+        boxes = Box.objects.bulk_create(
+            Box(user=users[0], repo=repos[i % len(repos)], box_name=f"Box {i}")
+            for i in range(FIXTURE_ROWS)
+        )
+        BoxMedia.objects.bulk_create(
+            BoxMedia(user=users[0], box=boxes[i % len(boxes)], file_name=f"file {i}")
+            for i in range(FIXTURE_ROWS)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        cls.user = users[1]
+        cls.repo = repos[1]
+        cls.box = boxes[1]
+
+    def assertIndexScan(self, queryset):
+        plan = queryset.explain()
+        if connection.vendor == "postgresql":
+            self.assertNotIn("Seq Scan", plan)
+            self.assertNotIn("Sort", plan)
+        elif connection.vendor == "sqlite":
+            self.assertIn("USING", plan)
+            self.assertNotRegex(plan, r"\bSCAN\b")
+            self.assertNotIn("TEMP B-TREE", plan)
+        else:
+            self.skipTest(f"No plan check for {connection.vendor}")
+
+    def test_access_map_lookup(self):
+        self.assertIndexScan(
+            RepoAccess.objects.filter(user_id=self.user.pk).values_list(
+                "repo_id", "access_type"
+            )
+        )
+
+    def test_owner_access_lookup(self):
+        self.assertIndexScan(
+            RepoAccess.objects.filter(
+                user_id=self.user.pk,
+                repo_id=self.repo.pk,
+                access_type=RepoAccess.REPO_ACCESS_TYPE_OWNER,
+            )
+        )
+
+    def test_boxes_of_repo(self):
+        self.assertIndexScan(
+            Box.objects.filter(repo_id=self.repo.pk).order_by("created_at")
+        )
+
+    def test_media_of_box(self):
+        self.assertIndexScan(
+            BoxMedia.objects.filter(box_id=self.box.pk).order_by("created_at")
+        )
+
+    def test_latest_account_of_user(self):
+        self.assertIndexScan(
+            Account.objects.filter(user_id=self.user.pk).order_by("-id")[:1]
+        )
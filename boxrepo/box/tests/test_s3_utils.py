@@ -0,0 +1,240 @@
+import io
+import os
+import tempfile
+import threading
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from django.test import SimpleTestCase
+
+from box.aws_utils import s3_utils
+from box.aws_utils.media_cache import MediaCache
+from box.aws_utils.async_s3_utils import (
+    AsyncS3FileManager,
+    close_async_s3_client,
+    get_async_s3_client,
+)
+from box.aws_utils.s3_utils import (
+    MB,
+    S3FileManager,
+    get_s3_client,
+    reset_s3_client,
+)
+from box.tests.utils import TEST_BUCKET, S3TestCase
+
+
+class SharedS3ClientTests(SimpleTestCase):
+    """S3FileManager instances share one pooled client per process"""
+
+    def setUp(self):
+        reset_s3_client()
+        self.addCleanup(reset_s3_client)
+
+    def test_managers_reuse_the_same_client(self):
+        self.assertIs(S3FileManager().client, S3FileManager().client)
+
+    def test_forked_process_builds_its_own_client(self):
+        parent_client = get_s3_client()
+        with mock.patch.object(s3_utils.os, "getpid", return_value=-1):
+            child_client = get_s3_client()
+        self.assertIsNot(parent_client, child_client)
+
+    def test_pool_settings_come_from_env(self):
+        env = {
+            "S3_MAX_POOL_CONNECTIONS": "7",
+            "S3_CONNECT_TIMEOUT": "2",
+            "S3_READ_TIMEOUT": "9",
+            "S3_TCP_KEEPALIVE": "false",
+        }
+        with mock.patch.dict(s3_utils.os.environ, env):
+            config = get_s3_client().meta.config
+        self.assertEqual(config.max_pool_connections, 7)
+        self.assertEqual(config.connect_timeout, 2)
+        self.assertEqual(config.read_timeout, 9)
+        self.assertFalse(config.tcp_keepalive)
+
+
+class AsyncS3ClientTests(SimpleTestCase):
+    """Coroutines on one event loop share a single aioboto3 client"""
+
+    async def test_client_is_shared_on_a_loop(self):
+        with mock.patch.dict(os.environ, {"AWS_DEFAULT_REGION": "us-east-1"}):
+            client = await get_async_s3_client()
+            try:
+                self.assertIs(await get_async_s3_client(), client)
+            finally:
+                await close_async_s3_client()
+
+    async def test_uploads_are_read_off_the_event_loop(self):
+        loop_thread = threading.current_thread()
+        readers = []
+
+        class Upload(io.BytesIO):
+            def read(self, size=-1):
+                readers.append(threading.current_thread())
+                return super().read(size)
+
+        client = mock.AsyncMock()
+        client.put_object.return_value = {"ETag": '"etag"'}
+        with mock.patch(
+            "box.aws_utils.async_s3_utils.get_async_s3_client", return_value=client
+        ):
+            etag = await AsyncS3FileManager().upload_file("key", Upload(b"body"))
+
+        self.assertEqual(etag, '"etag"')
+        self.assertEqual(client.put_object.call_args.kwargs["Body"], b"body")
+        self.assertTrue(readers)
+        self.assertNotIn(loop_thread, readers)
+
+
+class MultipartUploadTests(S3TestCase):
+    """Large files are uploaded as concurrent multipart parts"""
+
+    def test_multipart_upload_round_trip(self):
+        content = os.urandom(11 * MB)
+        s3 = S3FileManager()
+
+        etag = s3.multipart_upload(
+            "big-file", io.BytesIO(content), part_size=5 * MB, concurrency=3
+        )
+
+        self.assertTrue(etag.endswith('-3"'))
+        body = self.s3.get_object(Bucket=TEST_BUCKET, Key="big-file")["Body"]
+        self.assertEqual(body.read(), content)
+
+    def test_failed_part_aborts_upload(self):
+        s3 = S3FileManager()
+        with mock.patch.object(
+            s3, "_upload_part", side_effect=RuntimeError("connection reset")
+        ):
+            with self.assertRaises(RuntimeError):
+                s3.multipart_upload("big-file", io.BytesIO(os.urandom(6 * MB)))
+
+        uploads = self.s3.list_multipart_uploads(Bucket=TEST_BUCKET)
+        self.assertEqual(uploads.get("Uploads", []), [])
+        with self.assertRaises(ClientError):
+            self.s3.head_object(Bucket=TEST_BUCKET, Key="big-file")
+
+
+class FakeStreamingBody:
+    def __init__(self, content):
+        self.stream = io.BytesIO(content)
+        self.closed = False
+
+    def read(self, amt=None):
+        return self.stream.read(amt)
+
+    def iter_chunks(self, chunk_size):
+        while chunk := self.stream.read(chunk_size):
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class MediaCacheTests(SimpleTestCase):
+    """Object bodies are cached on disk per key and version"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.cache = MediaCache(self.directory, max_bytes=10_000, max_object_bytes=4000)
+
+    def _s3_object(self, content):
+        return {
+            "Body": FakeStreamingBody(content),
+            "ContentLength": len(content),
+            "ContentType": "image/png",
+            "ETag": '"abc"',
+        }
+
+    def _fill(self, key, version, content):
+        s3_object = self.cache.store(key, version, self._s3_object(content))
+        data = b"".join(s3_object["Body"].iter_chunks(1024))
+        s3_object["Body"].close()
+        return data
+
+    def test_entry_is_served_after_a_full_read(self):
+        content = os.urandom(3000)
+        self.assertIsNone(self.cache.get("key", "v1"))
+
+        self.assertEqual(self._fill("key", "v1", content), content)
+
+        cached = self.cache.get("key", "v1")
+        self.assertEqual(cached["Body"].read(), content)
+        cached["Body"].close()
+        self.assertEqual(cached["ContentType"], "image/png")
+        self.assertEqual(cached["ContentLength"], len(content))
+        self.assertIsNone(self.cache.get("key", "v2"))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_interrupted_read_leaves_no_entry(self):
+        s3_object = self.cache.store("key", "v1", self._s3_object(b"x" * 3000))
+        next(s3_object["Body"].iter_chunks(1024))
+        s3_object["Body"].close()
+
+        self.assertIsNone(self.cache.get("key", "v1"))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_large_objects_are_not_cached(self):
+        s3_object = self._s3_object(b"x" * 5000)
+        self.assertIs(self.cache.store("key", "v1", s3_object), s3_object)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for index in range(3):
+            self._fill(f"key-{index}", "v1", b"x" * 3000)
+            path = self.cache._path(f"key-{index}", "v1")
+            os.utime(path, (index, index))
+        self.cache.get("key-0", "v1")["Body"].close()
+
+        self._fill("key-3", "v1", b"x" * 3000)
+
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertIsNone(self.cache.get("key-1", "v1"))
+        self.assertFalse(os.path.exists(self.cache._key_directory("key-1")))
+        self.assertIsNotNone(self.cache.get("key-0", "v1"))
+
+    def test_fills_under_the_limit_do_not_scan_the_directory(self):
+        self._fill("key-0", "v1", b"x" * 1500)
+
+        with mock.patch.object(self.cache, "evict", wraps=self.cache.evict) as evict:
+            for index in range(1, 5):
+                self._fill(f"key-{index}", "v1", b"x" * 1500)
+            evict.assert_not_called()
+
+            self._fill("key-5", "v1", b"x" * 3000)
+            evict.assert_called_once_with()
+
+    def test_other_workers_fills_are_picked_up_by_a_rescan(self):
+        self.cache.rescan_fills = 2
+        other_worker = MediaCache(
+            self.directory, max_bytes=10_000, max_object_bytes=4000
+        )
+        self._fill("key-0", "v1", b"x" * 1000)
+        for index in (1, 2):
+            s3_object = other_worker.store(
+                f"key-{index}", "v1", self._s3_object(b"x" * 3000)
+            )
+            b"".join(s3_object["Body"].iter_chunks(1024))
+            s3_object["Body"].close()
+
+        self._fill("key-3", "v1", b"x" * 3000)
+        self._fill("key-4", "v1", b"x" * 1000)
+
+        self.assertGreater(self.cache.evictions, 0)
+        self.assertLessEqual(self.cache.stats()["bytes"], 10_000)
+
+    def test_invalidate_removes_every_version(self):
+        self._fill("key", "v1", b"one")
+        self._fill("key", "v2", b"two")
+        self._fill("other", "v1", b"other")
+
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            self.cache.invalidate("key")
+
+        # Only the key's own directory is listed, however many keys are cached
+        scandir.assert_called_once_with(self.cache._key_directory("key"))
+        self.assertIsNone(self.cache.get("key", "v1"))
+        self.assertIsNone(self.cache.get("key", "v2"))
+        self.assertIsNotNone(self.cache.get("other", "v1"))
@@ -0,0 +1,50 @@
+"""Fixtures shared by the box test modules"""
+
+import os
+from unittest import mock
+
+import boto3
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from moto import mock_aws
+
+from box.aws_utils.s3_utils import reset_s3_client
+from user.models import Account
+
+TEST_BUCKET = "boxrepo-test"
+ACCOUNT_TYPE_FREE = "FREE"
+
+
+def create_user(**params):
+    user = get_user_model().objects.create_user(**params)
+    Account.objects.create(user=user, account_type=ACCOUNT_TYPE_FREE)
+    return user
+
+
+def box_media_url(box_media_id):
+    return reverse("box:boxmedia-detail", args=[box_media_id])
+
+
+class S3TestCase(TestCase):
+    """Runs every test against an in-process moto S3 bucket"""
+
+    def setUp(self):
+        env = mock.patch.dict(
+            os.environ,
+            {
+                "AWS_ACCESS_KEY_ID": "testing",
+                "AWS_SECRET_ACCESS_KEY": "testing",
+                "AWS_DEFAULT_REGION": "us-east-1",
+                "S3_BUCKET_NAME": TEST_BUCKET,
+            },
+        )
+        env.start()
+        self.addCleanup(env.stop)
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        reset_s3_client()
+        self.addCleanup(reset_s3_client)
+        self.s3 = boto3.client("s3")
+        self.s3.create_bucket(Bucket=TEST_BUCKET)
@@ -0,0 +1,53 @@
+"""Shared cache of serialized repo and box trees
+
+Entries are keyed by the tree's ETag, which the conditional GET code
+computes from the database on every request, so a changed tree is never
+served even from a cache private to one worker. They are also keyed by a
+per-repo generation that signals replace whenever the repo, its boxes,
+their media or its access grants are written. Generations are replaced
+again when the write commits; otherwise a request reading the old rows
+before the commit could cache them under the new generation.
+"""
+
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from box.metrics import record_cache_lookup
+
+TREE_GENERATION_KEY = "tree_generation:{repo_id}"
+TREE_DATA_KEY = "tree_data:{kind}:{pk}:{generation}:{variant}"
+
+
+def get_tree_generation(repo_id):
+    key = TREE_GENERATION_KEY.format(repo_id=repo_id)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+
+def _replace_generation(repo_id):
+    cache.set(TREE_GENERATION_KEY.format(repo_id=repo_id), uuid.uuid4().hex, None)
+
+
+def bump_tree_generation(repo_id):
+    """Invalidate every cached tree of a repo, now and when the write commits"""
+    _replace_generation(repo_id)
+    transaction.on_commit(lambda: _replace_generation(repo_id))
+
+
+def cached_tree_data(kind, pk, repo_id, variant, build):
+    """Return the cached serialized tree, building and storing it on a miss"""
+    key = TREE_DATA_KEY.format(
+        kind=kind, pk=pk, generation=get_tree_generation(repo_id), variant=variant
+    )
+    data = cache.get(key)
+    record_cache_lookup("tree", data is not None)
+    if data is None:
+        data = build()
+        cache.set(key, data, settings.TREE_CACHE_TIMEOUT)
+    return data
@@ -0,0 +1,47 @@
+"""Upload handlers that hash files as the request body streams in
+
+With BOX_MEDIA_DEDUPLICATION on, each uploaded file gets a sha256
+attribute holding the hex digest of its content, computed chunk by chunk
+while Django receives it, so storing it needs no second pass over the
+file before the upload to S3.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler,
+)
+
+
+class HashingUploadHandlerMixin:
+    def new_file(self, *args, **kwargs):
+        # Set first: the memory handler raises StopFutureHandlers from here
+        self.sha256 = hashlib.sha256() if settings.BOX_MEDIA_DEDUPLICATION else None
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super().receive_data_chunk(raw_data, start)
+        # Chunks passed on belong to the next handler, which hashes them
+        if data is None and self.sha256 is not None:
+            self.sha256.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None and self.sha256 is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(
+    HashingUploadHandlerMixin, MemoryFileUploadHandler
+):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(
+    HashingUploadHandlerMixin, TemporaryFileUploadHandler
+):
+    pass
@@ -1,5 +1,5 @@
 from django.urls import path, include
-from box import views
+from box import async_views, views
 from rest_framework.routers import DefaultRouter
 
 router = DefaultRouter()
@@ -7,11 +7,22 @@ router.register("box", views.BoxViewSet)
 router.register("repo", views.RepoViewSet)
 router.register("repoaccess", views.RepoAccessViewSet)
 router.register("boxmedia", views.BoxMediaViewSet)
+router.register("profiles", views.ProfileViewSet, basename="profile")
 
 app_name = "box"
 
 urlpatterns = [
     path("", include(router.urls)),
     path("repo/<int:pk>/", views.RepoRetrieveViewSet.as_view(), name="repo_item"),
+    path(
+        "async/boxmedia/",
+        async_views.box_media_list,
+        name="async_boxmedia-list",
+    ),
+    path(
+        "async/boxmedia/<int:pk>/",
+        async_views.box_media_detail,
+        name="async_boxmedia-detail",
+    ),
     # path("token/", views.CreateTokenView.as_view(), name="token"),
 ]
\ No newline at end of file
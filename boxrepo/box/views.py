@@ -1,7 +1,17 @@
-from django.shortcuts import render
-from django.http import HttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.db import transaction
+from django.conf import settings
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseNotAllowed,
+    HttpResponseRedirect,
+)
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated, IsAdminUser
 
 from rest_framework.settings import api_settings
 from rest_framework.authtoken.models import Token
@@ -9,6 +19,7 @@ from rest_framework.authtoken.models import Token
 from django.contrib.auth import get_user_model
 from rest_framework import generics, authentication, permissions
 from rest_framework import viewsets, mixins, status
+from rest_framework.decorators import action
 
 from rest_framework.exceptions import APIException
 from rest_framework.response import Response
@@ -19,18 +30,72 @@ from box.serializers import (
     RepoAccessSerializer,
     BoxSerializer,
     BoxMediaSerializer,
+    signed_urls_requested,
+)
+from box.batching import batched_media_deletes
+from box.blobs import save_media_file, upload_media_files
+from box.conditional import (
+    box_tree_validators,
+    not_modified_response,
+    repo_tree_validators,
+    set_validator_headers,
 )
-from box.models import Repo, RepoAccess, Box, BoxMedia
-from user.models import Account
+from box.fieldsets import Fieldset, parse_fieldset
+from box.models import Repo, RepoAccess, Box, BoxMedia, UserRepoCounter
+from box.metrics import registry
+from box.pagination import KeysetCursorPagination
+from box.profiling import PROFILE_ID_RE, list_profiles, profile_path, profile_summary
+from box.permissions import RepoPermissionResolver, get_repo_permissions
+from box.streaming import s3_media_response
+from box.tree_cache import bump_tree_generation, cached_tree_data
+from user.authentication import API_AUTHENTICATION_CLASSES
+from user.entitlements import get_entitlements
 import logging
+import pstats
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from box.aws_utils.s3_utils import S3FileManager
+from box.aws_utils.media_cache import media_cache
+from box.aws_utils.s3_utils import MB, S3FileManager
 
 logger = logging.getLogger(__name__)
-MAX_FILESIZE_MB = 5  # TODO: Make configurable by account type
+
+
+def get_max_filesize_mb(user):
+    """Per-file upload limit of the user's latest account"""
+    return get_entitlements(user).max_file_size_mb
+
+
+def media_cache_version(box_media):
+    """Changes whenever the stored object does"""
+    return box_media.etag or box_media.updated_at.isoformat()
+
+
+def file_too_large_response(max_filesize_mb):
+    return Response(
+        {
+            "msg": f"Max size of file is {max_filesize_mb} MB",
+            "max_size": f"{max_filesize_mb} MB",
+        },
+        status=status.HTTP_400_BAD_REQUEST,
+    )
+
+
+def box_id_from_body(data):
+    """The integer box id of a request body, or None if missing or malformed"""
+    try:
+        return int(data["box"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def invalid_box_response():
+    return Response(
+        {"msg": "box must be the id of a box"},
+        status=status.HTTP_400_BAD_REQUEST,
+    )
 
 
 def user_has_repo_admin_access(
@@ -41,15 +106,91 @@ def user_has_repo_admin_access(
         RepoAccess.REPO_ACCESS_TYPE_ADMIN,
         RepoAccess.REPO_ACCESS_TYPE_OWNER,
     ],
+    request=None,
 ):
-    return RepoAccess.objects.filter(
-        user=user,
-        repo=repo,
-        access_type__in=required_access,
-    ).exists()
+    """Check access against the user's cached access map
+
+    Passing the request reuses the map already resolved for it.
+    """
+    if request is not None and request.user == user:
+        resolver = get_repo_permissions(request)
+    else:
+        resolver = RepoPermissionResolver(user)
+    return resolver.has_access(repo, required_access)
+
+
+class CachedTreeMixin:
+    """Serves serialized repo and box trees from the shared tree cache"""
+
+    def get_tree_data(self, kind, validators, cacheable):
+        """Bodies embedding signed URLs expire, so they are never cached"""
+
+        def build():
+            return self.get_serializer(self.get_object()).data
+
+        if not cacheable:
+            return build()
+        # The ETag fingerprints the rows and the query string from the
+        # database, so a worker that missed an invalidation still misses
+        return cached_tree_data(
+            kind,
+            self.kwargs[self.lookup_field],
+            validators.repo_id,
+            validators.etag,
+            build,
+        )
+
+
+class SparseFieldsetMixin:
+    """Serializes and prefetches only what a read request asked for
+
+    See box.fieldsets for the query parameters. Writes always get the full
+    representation, since dropping fields would also drop their input.
+    """
+
+    def get_fieldset(self):
+        if not hasattr(self, "_fieldset"):
+            serializer_class = self.get_serializer_class()
+            if self.request.method in SAFE_METHODS:
+                self._fieldset = parse_fieldset(
+                    self.request.query_params, serializer_class
+                )
+            else:
+                self._fieldset = Fieldset(serializer_class)
+        return self._fieldset
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return queryset.prefetch_related(*self.get_fieldset().prefetch_lookups())
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault("fieldset", self.get_fieldset())
+        return super().get_serializer(*args, **kwargs)
+
+
+class AccessibleListMixin:
+    """Lists only hold rows of repos the user can view
+
+    Other actions look rows up by id and answer 401 themselves.
+    """
+
+    repo_lookup = "repo_id"
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action != "list":
+            return queryset
+        # A subquery, so filtering costs no query of its own
+        repo_ids = RepoAccess.objects.filter(user_id=self.request.user.pk).values(
+            "repo_id"
+        )
+        return queryset.filter(**{f"{self.repo_lookup}__in": repo_ids})
 
 
 class BoxViewSet(
+    AccessibleListMixin,
+    SparseFieldsetMixin,
+    CachedTreeMixin,
     viewsets.GenericViewSet,
     mixins.ListModelMixin,
     mixins.CreateModelMixin,
@@ -60,18 +201,37 @@ class BoxViewSet(
 
     queryset = Box.objects.all()
     serializer_class = BoxSerializer
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = (IsAuthenticated,)
+    pagination_class = KeysetCursorPagination
 
-    def get(self, request, *args, **kwargs):
-        box = self.get_object()
-        user_has_repo_access = user_has_repo_admin_access(request.user, box.repo)
+    def retrieve(self, request, *args, **kwargs):
+        # The router maps GET to retrieve, so the access check has to live here
+        validators = box_tree_validators(
+            self.kwargs[self.lookup_field], variant=request.META.get("QUERY_STRING")
+        )
+        if validators is None:
+            raise Http404
+        user_has_repo_access = user_has_repo_admin_access(
+            request.user, validators.repo_id, request=request
+        )
         if not user_has_repo_access:
             return Response(
                 {"msg": "You are not authorized to view this repo"},
                 status=status.HTTP_401_UNAUTHORIZED,
             )
-        return super().get(request, *args, **kwargs)
+        # Embedded download URLs expire, so those bodies are never revalidated
+        revalidate = not signed_urls_requested(request)
+        if revalidate:
+            not_modified = not_modified_response(
+                request, validators.etag, validators.last_modified
+            )
+            if not_modified is not None:
+                return not_modified
+        response = Response(self.get_tree_data("box", validators, revalidate))
+        if revalidate:
+            set_validator_headers(response, validators.etag, validators.last_modified)
+        return response
 
     def perform_create(self, serializer):
         """Create a new box for a user"""
@@ -81,37 +241,43 @@ class BoxViewSet(
         """Restricts creation of boxes for free accounts
         Also ensures only admins can create boxes
         """
-        repo = Repo.objects.get(id=request.data["repo"])
-        user_has_repo_access = user_has_repo_admin_access(request.user, repo)
-        if not user_has_repo_access:
-            return Response(
-                {"msg": "Unauthorized to perform action"},
-                status=status.HTTP_401_UNAUTHORIZED,
+        with transaction.atomic():
+            # The row lock makes concurrent creates take turns on box_count
+            repo = Repo.objects.select_for_update().get(id=request.data["repo"])
+            user_has_repo_access = user_has_repo_admin_access(
+                request.user, repo, request=request
             )
-        account = Account.objects.filter(user=request.user).order_by("-id")[0]
-        num_boxes = len(repo.boxes_list)
-        logger.info(
-            f"""RepoViewSet.create user {request.user}'s latest account {account} is a {account.account_type} one and repo {repo} currently has {num_boxes} boxes"""
-        )
-        if num_boxes + 1 > account.max_boxes:
-            return Response(
-                {"msg": "You can't have more than 5 boxes per repo on a free account!"},
-                status=status.HTTP_401_UNAUTHORIZED,
+            if not user_has_repo_access:
+                return Response(
+                    {"msg": "Unauthorized to perform action"},
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
+            entitlements = get_entitlements(request.user)
+            num_boxes = repo.box_count
+            logger.info(
+                f"""BoxViewSet.create user {request.user}'s latest account is a {entitlements.account_type} one and repo {repo} currently has {num_boxes} boxes"""
             )
+            if num_boxes + 1 > entitlements.max_boxes:
+                return Response(
+                    {
+                        "msg": "You can't have more than 5 boxes per repo on a free account!"
+                    },
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
 
-        return super().create(request, *args, **kwargs)
+            return super().create(request, *args, **kwargs)
 
     def update(self, request, *args, **kwargs):
         box = self.get_object()
-        repo = box.repo
 
         user_has_repo_access = user_has_repo_admin_access(
             request.user,
-            repo,
+            box.repo_id,
             required_access=[
                 RepoAccess.REPO_ACCESS_TYPE_ADMIN,
                 RepoAccess.REPO_ACCESS_TYPE_OWNER,
             ],
+            request=request,
         )
         if not user_has_repo_access:
             return Response(
@@ -122,25 +288,48 @@ class BoxViewSet(
 
 
 class RepoRetrieveViewSet(
+    SparseFieldsetMixin,
+    CachedTreeMixin,
     generics.RetrieveAPIView,
 ):
     queryset = Repo.objects.all()
     serializer_class = RepoSerializer
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
-        repo = self.get_object()
-        user_has_repo_access = user_has_repo_admin_access(request.user, repo)
+        # Validators come from one aggregate query so an unchanged tree is
+        # answered with a 304 before anything is prefetched or serialized
+        validators = repo_tree_validators(
+            self.kwargs[self.lookup_field], variant=request.META.get("QUERY_STRING")
+        )
+        if validators is None:
+            raise Http404
+        user_has_repo_access = user_has_repo_admin_access(
+            request.user, validators.repo_id, request=request
+        )
         if not user_has_repo_access:
             return Response(
                 {"msg": "You are not authorized to view this repo"},
                 status=status.HTTP_401_UNAUTHORIZED,
             )
-        return super().get(request, *args, **kwargs)
+        # Embedded download URLs expire, so those bodies are never revalidated
+        revalidate = not signed_urls_requested(request)
+        if revalidate:
+            not_modified = not_modified_response(
+                request, validators.etag, validators.last_modified
+            )
+            if not_modified is not None:
+                return not_modified
+        response = Response(self.get_tree_data("repo", validators, revalidate))
+        if revalidate:
+            set_validator_headers(response, validators.etag, validators.last_modified)
+        return response
 
 
 class RepoViewSet(
+    AccessibleListMixin,
+    SparseFieldsetMixin,
     viewsets.GenericViewSet,
     mixins.ListModelMixin,
     mixins.CreateModelMixin,
@@ -148,26 +337,33 @@ class RepoViewSet(
     """Class to manage accounts in the db"""
 
     queryset = Repo.objects.all()
+    repo_lookup = "id"
     serializer_class = RepoSerializer
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = (IsAuthenticated,)
+    pagination_class = KeysetCursorPagination
 
     def perform_create(self, serializer):
         """Create a new repo for a user"""
         serializer.save(user=self.request.user)
 
     def create(self, request, *args, **kwargs):
-        account = Account.objects.filter(user=request.user).order_by("-id")[0]
-        num_repos = len(Repo.objects.filter(user=request.user))
-        logger.info(
-            f"""RepoViewSet.create user {request.user}'s latest account {account} is a {account.account_type} one and currently has {num_repos} repos"""
-        )
-        if num_repos + 1 > account.max_repos:
-            return Response(
-                {"msg": "You can't have more than 5 repos on a free account!"},
-                status=status.HTTP_401_UNAUTHORIZED,
+        with transaction.atomic():
+            # The row lock makes concurrent creates take turns on repo_count
+            counter, _ = UserRepoCounter.objects.select_for_update().get_or_create(
+                user=request.user
             )
-        return super().create(request, *args, **kwargs)
+            entitlements = get_entitlements(request.user)
+            num_repos = counter.repo_count
+            logger.info(
+                f"""RepoViewSet.create user {request.user}'s latest account is a {entitlements.account_type} one and currently has {num_repos} repos"""
+            )
+            if num_repos + 1 > entitlements.max_repos:
+                return Response(
+                    {"msg": "You can't have more than 5 repos on a free account!"},
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
+            return super().create(request, *args, **kwargs)
 
 
 class RepoAccessViewSet(
@@ -177,20 +373,21 @@ class RepoAccessViewSet(
 
     queryset = RepoAccess.objects.all()
     serializer_class = RepoAccessSerializer
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = (IsAuthenticated,)
+    pagination_class = KeysetCursorPagination
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
-        repo = Repo.objects.get(id=request.data["repo"])
         serializer.is_valid(raise_exception=True)
         user_has_repo_access = user_has_repo_admin_access(
             request.user,
-            repo,
+            serializer.validated_data["repo"],
             required_access=[
                 RepoAccess.REPO_ACCESS_TYPE_ADMIN,
                 RepoAccess.REPO_ACCESS_TYPE_OWNER,
             ],
+            request=request,
         )
         if not user_has_repo_access:
             return Response(
@@ -210,38 +407,73 @@ class BoxMediaViewSet(
     generics.RetrieveUpdateDestroyAPIView,
     mixins.CreateModelMixin,
 ):
-    queryset = BoxMedia.objects.all()
+    queryset = BoxMedia.objects.select_related("box")
     serializer_class = BoxMediaSerializer
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = (IsAuthenticated,)
 
     def retrieve(self, request, *args, **kwargs):
         box_media = self.get_object()
         user_has_repo_access = user_has_repo_admin_access(
             request.user,
-            box_media.box.repo,
+            box_media.box.repo_id,
             required_access=[
                 RepoAccess.REPO_ACCESS_TYPE_ADMIN,
                 RepoAccess.REPO_ACCESS_TYPE_OWNER,
                 RepoAccess.REPO_ACCESS_TYPE_VIEWER,
             ],
+            request=request,
         )
         if not user_has_repo_access:
             return Response(
                 {"msg": "Not authorized to perform action"},
                 status=status.HTTP_401_UNAUTHORIZED,
             )
+        if box_media.upload_status != BoxMedia.UPLOAD_STATUS_COMPLETE:
+            return Response(
+                {"msg": "File upload has not been finalized"},
+                status=status.HTTP_409_CONFLICT,
+            )
+        if box_media.etag:
+            # The stored S3 ETag answers revalidation without touching S3
+            not_modified = not_modified_response(
+                request, box_media.etag, box_media.updated_at
+            )
+            if not_modified is not None:
+                return not_modified
         s3 = S3FileManager()
         file_path = box_media.s3_bucket_file_path
         logger.info(f"file_path:{file_path}")
-        file_content = s3.get_file_content(
-            key=file_path,
-        )
-        return HttpResponse(
-            file_content,
-        )
-        # return Response(file_content, content_type="image/jpeg")
-        # return super().retrieve(request, *args, **kwargs)
+        download = request.query_params.get("download")
+        if download in ("redirect", "url"):
+            # Hand the transfer to S3 instead of proxying bytes through Django
+            url = s3.presigned_download_url(file_path)
+            if download == "redirect":
+                return HttpResponseRedirect(url)
+            return Response({"url": url})
+        if request.query_params.get("encoding") == "base64":
+            # Legacy clients that expect the whole file as a base64 string
+            file_content = s3.get_file_content(
+                key=file_path, version=media_cache_version(box_media)
+            )
+            return HttpResponse(
+                file_content,
+            )
+        try:
+            return s3_media_response(
+                s3,
+                file_path,
+                range_header=request.META.get("HTTP_RANGE"),
+                if_range=request.META.get("HTTP_IF_RANGE"),
+                version=media_cache_version(box_media),
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+            return Response(
+                {"msg": "File not found in storage"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
 
     def perform_create(self, serializer):
         """Create a new BoxMedia for a user"""
@@ -252,11 +484,12 @@ class BoxMediaViewSet(
         box = Box.objects.get(id=int(box_id))
         user_has_repo_access = user_has_repo_admin_access(
             request.user,
-            box.repo,
+            box.repo_id,
             required_access=[
                 RepoAccess.REPO_ACCESS_TYPE_ADMIN,
                 RepoAccess.REPO_ACCESS_TYPE_OWNER,
             ],
+            request=request,
         )
         if not user_has_repo_access:
             return Response(
@@ -272,15 +505,9 @@ class BoxMediaViewSet(
         received_file = request.FILES.getlist("file")[0]
         file_size = received_file.size
 
-        if file_size > MAX_FILESIZE_MB * 1024 * 1024:
-            return Response(
-                {
-                    "msg": f"Max size of file is \
-                                {MAX_FILESIZE_MB} MB",
-                    "max_size": f"{MAX_FILESIZE_MB} MB",
-                },
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        max_filesize_mb = get_max_filesize_mb(request.user)
+        if file_size > max_filesize_mb * MB:
+            return file_too_large_response(max_filesize_mb)
         box_media = BoxMedia.objects.create(
             **{
                 "user": request.user,
@@ -288,8 +515,7 @@ class BoxMediaViewSet(
                 "file_name": request.data["file_name"],
             }
         )
-        s3 = S3FileManager()
-        s3.upload_file(key=box_media.s3_bucket_file_path, file_content=received_file)
+        save_media_file(S3FileManager(), box_media, received_file)
         serializer = self.get_serializer(box_media)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -298,19 +524,23 @@ class BoxMediaViewSet(
         logger.info(f"""Attempting to destroy {box_media}""")
         user_has_repo_access = user_has_repo_admin_access(
             request.user,
-            box_media.box.repo,
+            box_media.box.repo_id,
             required_access=[
                 RepoAccess.REPO_ACCESS_TYPE_ADMIN,
                 RepoAccess.REPO_ACCESS_TYPE_OWNER,
             ],
+            request=request,
         )
         if not user_has_repo_access:
             return Response(
                 {"msg": "Not authorized to perform action"},
                 status=status.HTTP_401_UNAUTHORIZED,
             )
-        s3 = S3FileManager()
-        s3.delete_file(key=box_media.s3_bucket_file_path)
+        if not box_media.blob_id:
+            # Shared blobs are released when the row is deleted
+            s3 = S3FileManager()
+            s3.delete_file(key=box_media.s3_bucket_file_path)
+            media_cache.invalidate(box_media.s3_bucket_file_path)
         logger.info(f"Successfully deleted {box_media}")
 
         return super().destroy(request, *args, **kwargs)
@@ -320,11 +550,12 @@ class BoxMediaViewSet(
         box = Box.objects.get(id=int(box_id))
         user_has_repo_access = user_has_repo_admin_access(
             request.user,
-            box.repo,
+            box.repo_id,
             required_access=[
                 RepoAccess.REPO_ACCESS_TYPE_ADMIN,
                 RepoAccess.REPO_ACCESS_TYPE_OWNER,
             ],
+            request=request,
         )
         if not user_has_repo_access:
             return Response(
@@ -335,24 +566,348 @@ class BoxMediaViewSet(
         received_file = request.FILES.getlist("file")[0]
         file_size = received_file.size
 
-        if file_size > MAX_FILESIZE_MB * 1024 * 1024:
+        max_filesize_mb = get_max_filesize_mb(request.user)
+        if file_size > max_filesize_mb * MB:
+            return file_too_large_response(max_filesize_mb)
+        box_media = self.get_object()
+        box_media.file_name = request.data.get("file_name", box_media.file_name)
+        save_media_file(
+            S3FileManager(), box_media, received_file, update_fields=["file_name"]
+        )
+        serializer = self.get_serializer(box_media)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["post"])
+    def presign(self, request, *args, **kwargs):
+        """Reserve a BoxMedia row and return a URL to upload it straight to S3"""
+        box_id = box_id_from_body(request.data)
+        if box_id is None:
+            return invalid_box_response()
+        box = get_object_or_404(Box, id=box_id)
+        user_has_repo_access = user_has_repo_admin_access(
+            request.user,
+            box.repo_id,
+            required_access=[
+                RepoAccess.REPO_ACCESS_TYPE_ADMIN,
+                RepoAccess.REPO_ACCESS_TYPE_OWNER,
+            ],
+            request=request,
+        )
+        if not user_has_repo_access:
+            return Response(
+                {"msg": "Not authorized to perform action"},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+        max_filesize_mb = get_max_filesize_mb(request.user)
+        max_size = max_filesize_mb * MB
+        try:
+            file_size = int(request.data["file_size"])
+        except (KeyError, ValueError):
+            return Response(
+                {"msg": "file_size is missing in body"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if file_size > max_size:
+            return file_too_large_response(max_filesize_mb)
+        upload_method = request.data.get("method", "POST").upper()
+        if upload_method not in ("POST", "PUT"):
             return Response(
-                {
-                    "msg": f"Max size of file is \
-                                {MAX_FILESIZE_MB} MB",
-                    "max_size": f"{MAX_FILESIZE_MB} MB",
-                },
+                {"msg": "method must be POST or PUT"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
+
+        box_media = BoxMedia.objects.create(
+            user=request.user,
+            box=box,
+            file_name=request.data.get("file_name", ""),
+            upload_status=BoxMedia.UPLOAD_STATUS_PENDING,
+        )
+        s3 = S3FileManager()
+        content_type = request.data.get("content_type")
+        if upload_method == "POST":
+            presigned = s3.presigned_upload_post(
+                key=box_media.s3_bucket_file_path,
+                max_size=max_size,
+                content_type=content_type,
+            )
+            upload = {"method": "POST", **presigned}
+        else:
+            upload = {
+                "method": "PUT",
+                "url": s3.presigned_upload_put(
+                    key=box_media.s3_bucket_file_path, content_type=content_type
+                ),
+                "headers": {"Content-Type": content_type} if content_type else {},
+            }
+        serializer = self.get_serializer(box_media)
+        return Response(
+            {"box_media": serializer.data, "upload": upload},
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(detail=True, methods=["post"])
+    def finalize(self, request, *args, **kwargs):
+        """Confirm a presigned upload landed in S3 and mark the media complete"""
         box_media = self.get_object()
-        file_name = request.data.get("file_name", box_media.file_name)
-        if box_media.file_name != file_name:
-            box_media.file_name = file_name
-            box_media.save()
+        user_has_repo_access = user_has_repo_admin_access(
+            request.user,
+            box_media.box.repo_id,
+            required_access=[
+                RepoAccess.REPO_ACCESS_TYPE_ADMIN,
+                RepoAccess.REPO_ACCESS_TYPE_OWNER,
+            ],
+            request=request,
+        )
+        if not user_has_repo_access:
+            return Response(
+                {"msg": "Not authorized to perform action"},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
         s3 = S3FileManager()
-        s3.upload_file(key=box_media.s3_bucket_file_path, file_content=received_file)
+        try:
+            head = s3.head_file(box_media.s3_bucket_file_path)
+        except ClientError as error:
+            if error.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+            return Response(
+                {"msg": "File has not been uploaded to storage"},
+                status=status.HTTP_409_CONFLICT,
+            )
+        max_filesize_mb = get_max_filesize_mb(request.user)
+        if head["ContentLength"] > max_filesize_mb * MB:
+            # Presigned PUTs cannot enforce a size limit, so enforce it here
+            s3.delete_file(key=box_media.s3_bucket_file_path)
+            return file_too_large_response(max_filesize_mb)
+        box_media.etag = head["ETag"]
+        box_media.upload_status = BoxMedia.UPLOAD_STATUS_COMPLETE
+        box_media.save(update_fields=["etag", "upload_status", "updated_at"])
         serializer = self.get_serializer(box_media)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-    # #TODO: Update image in the S3 bucket
-    # return super().update(request, *args, **kwargs)
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk_upload(self, request, *args, **kwargs):
+        """Upload many files into one box with a single permission check"""
+        box_id = box_id_from_body(request.data)
+        if box_id is None:
+            return invalid_box_response()
+        box = get_object_or_404(Box, id=box_id)
+        user_has_repo_access = user_has_repo_admin_access(
+            request.user,
+            box.repo_id,
+            required_access=[
+                RepoAccess.REPO_ACCESS_TYPE_ADMIN,
+                RepoAccess.REPO_ACCESS_TYPE_OWNER,
+            ],
+            request=request,
+        )
+        if not user_has_repo_access:
+            return Response(
+                {"msg": "Not authorized to perform action"},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+        received_files = request.FILES.getlist("file")
+        if not received_files:
+            return Response(
+                {"msg": "file key is missing in body"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        file_names = (
+            request.data.getlist("file_name")
+            if hasattr(request.data, "getlist")
+            else []
+        )
+        max_filesize_mb = get_max_filesize_mb(request.user)
+
+        results = []
+        accepted = []
+        for index, received_file in enumerate(received_files):
+            file_name = (
+                file_names[index] if index < len(file_names) else received_file.name
+            )
+            result = {"file_name": file_name}
+            results.append(result)
+            if received_file.size > max_filesize_mb * MB:
+                result["status"] = "failed"
+                result["msg"] = f"Max size of file is {max_filesize_mb} MB"
+                continue
+            accepted.append((result, received_file))
+
+        box_media_list = BoxMedia.objects.bulk_create(
+            BoxMedia(user=request.user, box=box, file_name=result["file_name"])
+            for result, _ in accepted
+        )
+        etags = upload_media_files(
+            S3FileManager(),
+            box_media_list,
+            [received_file for _, received_file in accepted],
+        )
+
+        uploaded, failed_ids = [], []
+        # bulk_update skips auto_now, and the tree ETags follow updated_at
+        uploaded_at = timezone.now()
+        for box_media, (result, _), etag in zip(box_media_list, accepted, etags):
+            if isinstance(etag, Exception):
+                failed_ids.append(box_media.id)
+                result["status"] = "failed"
+                result["msg"] = "Upload to storage failed"
+                continue
+            box_media.etag = etag
+            box_media.updated_at = uploaded_at
+            uploaded.append(box_media)
+            result["status"] = "created"
+            result["box_media"] = self.get_serializer(box_media).data
+        BoxMedia.objects.bulk_update(uploaded, ["etag", "blob", "updated_at"])
+        # Bulk writes send no model signals
+        bump_tree_generation(box.repo_id)
+        if failed_ids:
+            BoxMedia.objects.filter(id__in=failed_ids).delete()
+
+        all_created = len(uploaded) == len(received_files)
+        return Response(
+            {"results": results},
+            status=(
+                status.HTTP_201_CREATED if all_created else status.HTTP_207_MULTI_STATUS
+            ),
+        )
+
+    @action(
+        detail=False,
+        methods=["get"],
+        url_path="cache_stats",
+        permission_classes=(IsAdminUser,),
+    )
+    def cache_stats(self, request, *args, **kwargs):
+        """Disk media cache counters for this worker"""
+        return Response(media_cache.stats(), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["post"], url_path="bulk_delete")
+    def bulk_delete(self, request, *args, **kwargs):
+        """Delete many media by id, or every media in a box, in batches"""
+        if request.data.get("box") is not None:
+            try:
+                box_id = int(request.data["box"])
+            except (TypeError, ValueError):
+                return Response(
+                    {"msg": "box must be an integer"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            box_media_qs = BoxMedia.objects.filter(box_id=box_id)
+        else:
+            ids = (
+                request.data.getlist("ids")
+                if hasattr(request.data, "getlist")
+                else request.data.get("ids")
+            )
+            if not ids:
+                return Response(
+                    {"msg": "ids or box is required"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            try:
+                ids = [int(media_id) for media_id in ids]
+            except (TypeError, ValueError):
+                return Response(
+                    {"msg": "ids must be a list of integers"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            box_media_qs = BoxMedia.objects.filter(id__in=ids)
+        box_media_list = list(
+            box_media_qs.select_related("box").only(
+                "id", "blob", "box__id", "box__repo_id"
+            )
+        )
+
+        permissions = get_repo_permissions(request)
+        repo_ids = {box_media.box.repo_id for box_media in box_media_list}
+        for repo_id in repo_ids:
+            if not permissions.has_access(
+                repo_id,
+                [RepoAccess.REPO_ACCESS_TYPE_ADMIN, RepoAccess.REPO_ACCESS_TYPE_OWNER],
+            ):
+                return Response(
+                    {"msg": "Not authorized to perform action"},
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
+
+        # Shared blobs are released by the row deletes, not deleted here
+        keys = {
+            box_media.s3_bucket_file_path: box_media.id
+            for box_media in box_media_list
+            if not box_media.blob_id
+        }
+        s3 = S3FileManager()
+        failed_keys = s3.delete_files(keys)
+        media_cache.invalidate(*keys)
+        # Rows whose object could not be deleted are kept so they can be retried
+        deleted = [
+            box_media
+            for box_media in box_media_list
+            if box_media.s3_bucket_file_path not in failed_keys
+        ]
+        deleted_ids = [box_media.id for box_media in deleted]
+        repo_ids = {box_media.box.repo_id for box_media in deleted}
+        with transaction.atomic(), batched_media_deletes(repo_ids):
+            BoxMedia.objects.filter(id__in=deleted_ids).delete()
+        logger.info(f"Bulk deleted {len(deleted_ids)} box media")
+        return Response(
+            {
+                "deleted": deleted_ids,
+                "failed": [keys[key] for key in failed_keys],
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+def metrics(request):
+    """Every worker's metrics in the Prometheus text format"""
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not settings.METRICS_TOKEN:
+        # Never public; it names every view and how busy the service is
+        return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+    if not constant_time_compare(
+        request.headers.get("Authorization", ""), f"Bearer {settings.METRICS_TOKEN}"
+    ):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(
+        registry.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+class ProfileViewSet(viewsets.ViewSet):
+    """Request profiles captured by RequestProfilerMiddleware, for staff"""
+
+    authentication_classes = API_AUTHENTICATION_CLASSES
+    permission_classes = (IsAdminUser,)
+    lookup_value_regex = PROFILE_ID_RE.pattern.strip("^$")
+
+    def list(self, request):
+        return Response(list_profiles(), status=status.HTTP_200_OK)
+
+    def retrieve(self, request, pk=None):
+        """Download the raw stats, for pstats or snakeviz"""
+        try:
+            profile = open(profile_path(pk), "rb")
+        except FileNotFoundError:
+            raise Http404
+        return FileResponse(
+            profile,
+            as_attachment=True,
+            filename=f"{pk}.prof",
+            content_type="application/octet-stream",
+        )
+
+    @action(detail=True, methods=["get"])
+    def stats(self, request, pk=None):
+        """The top functions as text, sorted by ?sort= (cumulative by default)"""
+        sort = request.query_params.get("sort", "cumulative")
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            return Response(
+                {"msg": f"Unknown sort key {sort}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            summary = profile_summary(pk, sort=sort)
+        except FileNotFoundError:
+            raise Http404
+        return HttpResponse(summary, content_type="text/plain; charset=utf-8")
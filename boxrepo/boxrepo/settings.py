@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
+import tempfile
 import logging 
 import logging.config
 from dotenv import load_dotenv
@@ -30,6 +32,10 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv("DJANGO_SECRET_KEY")
+# Retired keys, comma separated, that signed tokens may still be verified with
+SECRET_KEY_FALLBACKS = [
+    key for key in os.getenv("DJANGO_SECRET_KEY_FALLBACKS", "").split(",") if key
+]
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = False
@@ -55,6 +61,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its total covers every other middleware
+    "box.instrumentation.RequestInstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -63,6 +71,8 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    # Last, so a profile holds the view rather than the middleware stack
+    "box.profiling.RequestProfilerMiddleware",
 
 ]
 
@@ -104,6 +114,80 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=600)
 DATABASES['default'].update(db_from_env)
 
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# LocMemCache is private to each gunicorn worker, so an invalidation made by
+# one worker is never seen by the others. Repo access maps and account
+# entitlements, and signed token revocation checks, are therefore only cached
+# when SHARED_CACHE is on; it follows the backend unless DJANGO_CACHE_SHARED
+# says otherwise (a single worker).
+
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv(
+            "DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("DJANGO_CACHE_LOCATION", "boxrepo"),
+    }
+}
+SHARED_CACHE = os.getenv(
+    "DJANGO_CACHE_SHARED", str("LocMemCache" not in CACHES["default"]["BACKEND"])
+).lower() in ("1", "true", "yes")
+
+# Seconds a user's repo access map may be served from the cache
+REPO_ACCESS_CACHE_TIMEOUT = int(os.getenv("REPO_ACCESS_CACHE_TIMEOUT", 60 * 60))
+
+# Lifetime in seconds of the signed access tokens, whether each request
+# checks the revocation table, and for how long a check may be served from
+# a shared cache. Without SHARED_CACHE every request that carries a signed
+# token still runs one indexed query on that table; only a shared cache
+# backend makes signed-token requests free of queries.
+SIGNED_TOKEN_MAX_AGE = int(os.getenv("SIGNED_TOKEN_MAX_AGE", 12 * 60 * 60))
+SIGNED_TOKEN_CHECK_REVOCATION = os.getenv(
+    "SIGNED_TOKEN_CHECK_REVOCATION", "true"
+).lower() in ("1", "true", "yes")
+SIGNED_TOKEN_REVOCATION_CACHE_TIMEOUT = int(
+    os.getenv("SIGNED_TOKEN_REVOCATION_CACHE_TIMEOUT", 60)
+)
+
+# Time SQL, S3 and rendering per request; reported in a JSON log line
+# from the box.instrumentation logger and, when SERVER_TIMING_HEADER is on,
+# in a Server-Timing header. The header shows every client how long our
+# queries and S3 calls take, so it is off unless asked for.
+REQUEST_INSTRUMENTATION = os.getenv(
+    "REQUEST_INSTRUMENTATION", "true"
+).lower() in ("1", "true", "yes")
+SERVER_TIMING_HEADER = os.getenv(
+    "SERVER_TIMING_HEADER", "false"
+).lower() in ("1", "true", "yes")
+
+# Prometheus metrics at /metrics; each worker flushes its values to
+# METRICS_DIR every METRICS_FLUSH_INTERVAL seconds and scrapes read them
+# all. Scrapes must send "Authorization: Bearer <METRICS_TOKEN>"; without
+# a METRICS_TOKEN every scrape is refused.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_DIR = os.getenv(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), "boxrepo-metrics")
+)
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or None
+
+# Staff can profile one request with an X-Profile header or ?profile=1;
+# the newest PROFILE_MAX_FILES profiles are kept in PROFILE_DIR
+REQUEST_PROFILING = os.getenv(
+    "REQUEST_PROFILING", "true"
+).lower() in ("1", "true", "yes")
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "boxrepo-profiles")
+)
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 100))
+
+# Seconds a user's account limits may be served from the cache
+ENTITLEMENT_CACHE_TIMEOUT = int(os.getenv("ENTITLEMENT_CACHE_TIMEOUT", 60 * 60))
+
+# Seconds a serialized repo or box tree may be served from the cache
+TREE_CACHE_TIMEOUT = int(os.getenv("TREE_CACHE_TIMEOUT", 10 * 60))
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -145,6 +229,28 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Bulk media uploads send many files in one request
+DATA_UPLOAD_MAX_NUMBER_FILES = int(os.getenv("DATA_UPLOAD_MAX_NUMBER_FILES", 1000))
+
+# Django's handlers, but hashing each file as it arrives for deduplication
+FILE_UPLOAD_HANDLERS = [
+    "box.uploadhandlers.HashingMemoryFileUploadHandler",
+    "box.uploadhandlers.HashingTemporaryFileUploadHandler",
+]
+
+# Keyset pagination for the repo, box and repoaccess list endpoints
+BOX_PAGE_SIZE = int(os.getenv("BOX_PAGE_SIZE", 50))
+BOX_MAX_PAGE_SIZE = int(os.getenv("BOX_MAX_PAGE_SIZE", 500))
+
+# Store uploaded media once per SHA-256 digest and share it between rows
+BOX_MEDIA_DEDUPLICATION = os.getenv("BOX_MEDIA_DEDUPLICATION", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+TESTING = sys.argv[1:2] == ["test"]
+
 LOGGING_CONFIG = None
 logging.config.dictConfig(
     {
@@ -168,6 +274,15 @@ logging.config.dictConfig(
                 "level": 'INFO' if DEBUG else 'WARNING',
                 "handlers": ["console"],
             },
+            # One line per request, kept when the root logger only warns;
+            # not while the test suite runs, where it buries the results
+            "box.instrumentation": {
+                "level": os.getenv(
+                    "REQUEST_LOG_LEVEL", "WARNING" if TESTING else "INFO"
+                ),
+                "handlers": ["console"],
+                "propagate": False,
+            },
         },
     }
 )
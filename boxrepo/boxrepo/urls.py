@@ -17,8 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from box.views import metrics
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/user/", include("user.urls")),
     path("api/box/", include("box.urls")),
+    path("metrics", metrics, name="metrics"),
 ]
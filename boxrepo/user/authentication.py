@@ -0,0 +1,196 @@
+"""Stateless signed access tokens
+
+A signed token carries the user's id, username and staff flag, signed with
+SECRET_KEY through django.core.signing, so verifying one needs no
+authtoken_token or auth_user lookup. Keys listed in SECRET_KEY_FALLBACKS
+still verify, which lets SECRET_KEY be rotated without logging everyone out.
+
+Revocations are rows in SignedTokenRevocation, kept for as long as a token
+could still be valid. When the cache is shared by every worker, lookups are
+cached for SIGNED_TOKEN_REVOCATION_CACHE_TIMEOUT and revoking writes the
+cache too, so it takes effect at once. Otherwise each check reads the table:
+a per-worker cache would keep accepting a token another worker revoked. So
+with the default LocMemCache a signed token skips the user and token tables
+but not this one; set up a shared cache, or turn off
+SIGNED_TOKEN_CHECK_REVOCATION, to authenticate without any query.
+"""
+
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.authentication import (
+    BaseAuthentication,
+    TokenAuthentication,
+    get_authorization_header,
+)
+from rest_framework.exceptions import AuthenticationFailed
+
+from user.models import SignedTokenRevocation
+
+SIGNED_TOKEN_SALT = "user.authentication.SignedTokenAuthentication"
+REVOKED_TOKEN_KEY = "revoked_signed_token:{token_id}"
+USER_NOT_BEFORE_KEY = "signed_tokens_not_before:{user_id}"
+
+
+def issue_signed_token(user):
+    """Sign a new token for a user; returned as the token and its lifetime"""
+    payload = {
+        "u": user.pk,
+        "n": user.get_username(),
+        "s": int(user.is_staff),
+        "j": uuid.uuid4().hex,
+        "t": int(time.time()),
+    }
+    return {
+        "signed_token": signing.dumps(payload, salt=SIGNED_TOKEN_SALT, compress=True),
+        "expires_in": settings.SIGNED_TOKEN_MAX_AGE,
+    }
+
+
+def _revocation_expires_at():
+    # Rows of expired revocations are deleted on the next revocation
+    SignedTokenRevocation.objects.filter(expires_at__lt=timezone.now()).delete()
+    return timezone.now() + timedelta(seconds=settings.SIGNED_TOKEN_MAX_AGE)
+
+
+def revoke_signed_token(token):
+    """Reject one token for the rest of its lifetime"""
+    try:
+        payload = signing.loads(
+            token, salt=SIGNED_TOKEN_SALT, max_age=settings.SIGNED_TOKEN_MAX_AGE
+        )
+    except signing.BadSignature:
+        return
+    SignedTokenRevocation.objects.get_or_create(
+        token_id=payload["j"], defaults={"expires_at": _revocation_expires_at()}
+    )
+    if settings.SHARED_CACHE:
+        cache.set(
+            REVOKED_TOKEN_KEY.format(token_id=payload["j"]),
+            True,
+            settings.SIGNED_TOKEN_REVOCATION_CACHE_TIMEOUT,
+        )
+
+
+def revoke_user_signed_tokens(user_id):
+    """Reject every token issued to a user until now"""
+    issued_before = int(time.time())
+    SignedTokenRevocation.objects.create(
+        user_id=user_id,
+        issued_before=issued_before,
+        expires_at=_revocation_expires_at(),
+    )
+    if settings.SHARED_CACHE:
+        cache.set(
+            USER_NOT_BEFORE_KEY.format(user_id=user_id),
+            issued_before,
+            settings.SIGNED_TOKEN_REVOCATION_CACHE_TIMEOUT,
+        )
+
+
+def load_revocations(payload):
+    """(whether the token is revoked, the user's cutoff) from one query"""
+    token_revoked = False
+    not_before = -1
+    for token_id, issued_before in SignedTokenRevocation.objects.filter(
+        Q(token_id=payload["j"]) | Q(user_id=payload["u"])
+    ).values_list("token_id", "issued_before"):
+        if token_id == payload["j"]:
+            token_revoked = True
+        elif issued_before is not None:
+            not_before = max(not_before, issued_before)
+    return token_revoked, not_before
+
+
+def is_revoked(payload):
+    if not settings.SIGNED_TOKEN_CHECK_REVOCATION:
+        return False
+    if not settings.SHARED_CACHE:
+        # Another worker's revocation would never reach a local cache
+        token_revoked, not_before = load_revocations(payload)
+    else:
+        token_key = REVOKED_TOKEN_KEY.format(token_id=payload["j"])
+        user_key = USER_NOT_BEFORE_KEY.format(user_id=payload["u"])
+        cached = cache.get_many([token_key, user_key])
+        if token_key in cached and user_key in cached:
+            token_revoked, not_before = cached[token_key], cached[user_key]
+        else:
+            token_revoked, not_before = load_revocations(payload)
+            # add, so a revocation cached meanwhile is never overwritten
+            timeout = settings.SIGNED_TOKEN_REVOCATION_CACHE_TIMEOUT
+            cache.add(token_key, token_revoked, timeout)
+            cache.add(user_key, not_before, timeout)
+    # Tokens issued in the same second as the revocation are rejected too
+    return token_revoked or payload["t"] <= not_before
+
+
+def _read_only_user(*args, **kwargs):
+    raise NotImplementedError(
+        "Users built from signed tokens are read-only; load the user to change it."
+    )
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """Authenticate 'Authorization: Bearer <signed token>' without the database
+
+    request.user is an unsaved user built from the token's claims; it
+    carries the primary key, so it works for filters and foreign keys, but
+    saving or deleting it raises NotImplementedError.
+    """
+
+    keyword = "Bearer"
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed("Invalid token header.")
+        try:
+            token = auth[1].decode()
+            payload = signing.loads(
+                token, salt=SIGNED_TOKEN_SALT, max_age=settings.SIGNED_TOKEN_MAX_AGE
+            )
+        except (UnicodeError, signing.BadSignature):
+            # SignatureExpired is a BadSignature too
+            raise AuthenticationFailed("Invalid or expired token.")
+        if is_revoked(payload):
+            raise AuthenticationFailed("Token has been revoked.")
+        return self.build_user(payload), token
+
+    def build_user(self, payload):
+        user = get_user_model()(
+            pk=payload["u"],
+            is_active=True,
+            is_staff=bool(payload["s"]),
+        )
+        setattr(user, get_user_model().USERNAME_FIELD, payload["n"])
+        # Only the claims are loaded, so writing it back would blank the row
+        user.save = user.delete = _read_only_user
+        return user
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+# Signed tokens first; the legacy token table stays as a fallback
+API_AUTHENTICATION_CLASSES = (SignedTokenAuthentication, TokenAuthentication)
+
+
+def authenticate_request(request):
+    """Run the API authentication classes outside DRF; returns a user or None"""
+    for authentication_class in API_AUTHENTICATION_CLASSES:
+        try:
+            result = authentication_class().authenticate(request)
+        except AuthenticationFailed:
+            return None
+        if result is not None:
+            return result[0]
+    return None
@@ -0,0 +1,76 @@
+"""Cached account entitlements
+
+A user's limits come from their latest Account. They are resolved once and
+cached under a per-user version that the Account signals replace, so quota
+checks on the create paths cost no query until the user's accounts change.
+The signals replace the version only in the cache of the worker that saved
+the account, so entitlements are cached only when SHARED_CACHE says every
+worker reads the same cache. The version is replaced again when the write
+commits, so a quota check that read the old account before the commit
+cannot cache it under the new version.
+"""
+
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from box.metrics import record_cache_lookup
+from user.models import Account
+
+ENTITLEMENT_VERSION_KEY = "entitlement_version:{user_id}"
+ENTITLEMENT_KEY = "entitlements:{user_id}:{version}"
+
+Entitlements = namedtuple(
+    "Entitlements", ["account_type", "max_repos", "max_boxes", "max_file_size_mb"]
+)
+
+
+def get_entitlement_version(user_id):
+    key = ENTITLEMENT_VERSION_KEY.format(user_id=user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def _replace_version(user_id):
+    cache.set(ENTITLEMENT_VERSION_KEY.format(user_id=user_id), uuid.uuid4().hex, None)
+
+
+def bump_entitlement_version(user_id):
+    """Invalidate a user's cached entitlements, now and when the write commits"""
+    _replace_version(user_id)
+    transaction.on_commit(lambda: _replace_version(user_id))
+
+
+def load_entitlements(user_id):
+    """Entitlements of the user's latest account, read from the database"""
+    account = Account.objects.filter(user_id=user_id).order_by("-id").first()
+    if account is None:
+        raise Account.DoesNotExist(f"User {user_id} has no account")
+    return Entitlements(
+        account_type=account.account_type,
+        max_repos=account.max_repos,
+        max_boxes=account.max_boxes,
+        max_file_size_mb=account.max_file_size_mb,
+    )
+
+
+def get_entitlements(user):
+    """Return the user's entitlements, from the cache when possible"""
+    if not settings.SHARED_CACHE:
+        # Other workers would keep enforcing old limits from their copy
+        return load_entitlements(user.pk)
+    key = ENTITLEMENT_KEY.format(
+        user_id=user.pk, version=get_entitlement_version(user.pk)
+    )
+    entitlements = cache.get(key)
+    record_cache_lookup("entitlements", entitlements is not None)
+    if entitlements is None:
+        entitlements = load_entitlements(user.pk)
+        cache.set(key, entitlements, settings.ENTITLEMENT_CACHE_TIMEOUT)
+    return entitlements
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-18 07:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user", "0002_account_created_at_account_updated_at"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="account",
+            index=models.Index(fields=["user", "-id"], name="account_user_latest_idx"),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.5 on 2026-10-18 08:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user", "0003_access_pattern_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SignedTokenRevocation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token_id", models.CharField(max_length=32, null=True, unique=True)),
+                ("user_id", models.IntegerField(null=True)),
+                ("issued_before", models.IntegerField(null=True)),
+                ("expires_at", models.DateTimeField()),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["user_id"], name="revocation_user_idx"),
+                    models.Index(
+                        fields=["expires_at"], name="revocation_expires_at_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -9,6 +9,7 @@ class Account(models.Model):
 
     max_box_dict = {ACCOUNT_TYPE_FREE: 5, ACCOUNT_TYPE_PAID: float("inf")}
     max_repo_dict = {ACCOUNT_TYPE_FREE: 5, ACCOUNT_TYPE_PAID: float("inf")}
+    max_file_size_mb_dict = {ACCOUNT_TYPE_FREE: 5, ACCOUNT_TYPE_PAID: 5 * 1024}
 
     ACCOUNT_PAID_MONTHS_CHOICES = (
         (1, 1),
@@ -30,6 +31,12 @@ class Account(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # The latest account of a user decides their limits
+            models.Index(fields=["user", "-id"], name="account_user_latest_idx"),
+        ]
+
     @property
     def max_boxes(self):
         return self.max_box_dict[self.account_type]
@@ -37,3 +44,27 @@ class Account(models.Model):
     @property
     def max_repos(self):
         return self.max_repo_dict[self.account_type]
+
+    @property
+    def max_file_size_mb(self):
+        return self.max_file_size_mb_dict[self.account_type]
+
+
+class SignedTokenRevocation(models.Model):
+    """Rejects signed tokens before they expire
+
+    A row names one token by its id, or rejects every token of a user issued
+    at or before issued_before. user_id is a plain column rather than a
+    foreign key so the row outlives a deleted user.
+    """
+
+    token_id = models.CharField(max_length=32, null=True, unique=True)
+    user_id = models.IntegerField(null=True)
+    issued_before = models.IntegerField(null=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_id"], name="revocation_user_idx"),
+            models.Index(fields=["expires_at"], name="revocation_expires_at_idx"),
+        ]
@@ -0,0 +1,44 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from user.authentication import revoke_user_signed_tokens
+from user.entitlements import bump_entitlement_version
+from user.models import Account
+
+# Signed tokens assert these, or were issued under the old password
+TOKEN_CLAIM_FIELDS = ("is_active", "is_staff", "password")
+
+
+@receiver(pre_save, sender=get_user_model())
+def detect_token_claim_changes(sender, instance, update_fields=None, **kwargs):
+    instance._revoke_signed_tokens = False
+    if instance._state.adding:
+        return
+    if update_fields is not None and not set(update_fields) & set(TOKEN_CLAIM_FIELDS):
+        # Logins only write last_login
+        return
+    stored = sender.objects.filter(pk=instance.pk).values(*TOKEN_CLAIM_FIELDS).first()
+    instance._revoke_signed_tokens = stored is not None and any(
+        stored[field] != getattr(instance, field) for field in TOKEN_CLAIM_FIELDS
+    )
+
+
+@receiver(post_save, sender=get_user_model())
+def revoke_changed_user_tokens(sender, instance, created, **kwargs):
+    """A deactivation, demotion or password change revokes the user's tokens"""
+    if getattr(instance, "_revoke_signed_tokens", False):
+        instance._revoke_signed_tokens = False
+        revoke_user_signed_tokens(instance.pk)
+
+
+@receiver(post_delete, sender=get_user_model())
+def revoke_deleted_user_tokens(sender, instance, **kwargs):
+    """Tokens of a deleted user would authenticate a user without a row"""
+    revoke_user_signed_tokens(instance.pk)
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_entitlements(sender, instance, **kwargs):
+    bump_entitlement_version(instance.user_id)
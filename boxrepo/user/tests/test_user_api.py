@@ -1,9 +1,22 @@
-from django.test import TestCase
+import time
+from unittest import mock
+
+from django.core import signing
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 
 from rest_framework.test import APIClient
 from rest_framework import status
+from user.authentication import (
+    SIGNED_TOKEN_SALT,
+    SignedTokenAuthentication,
+    issue_signed_token,
+    revoke_signed_token,
+)
 import logging
 
 logger = logging.getLogger(__name__)
@@ -100,3 +113,152 @@ class AccountApiTests(TestCase):
         res = self.client.post(ACCOUNT_URL, payload)
         self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
 
+
+class SignedTokenTests(TestCase):
+    """Signed tokens authenticate without touching the user or token tables"""
+
+    def setUp(self):
+        self.client = APIClient()
+        payload = {"username": "test@boxrepo.com", "password": "testpass"}
+        self.user = create_user(**payload)
+        res = self.client.post(TOKEN_URL, payload)
+        self.token = res.data["signed_token"]
+
+    def _get_accounts(self, token):
+        return self.client.get(ACCOUNT_URL, HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_signed_token_skips_user_lookup(self):
+        with CaptureQueriesContext(connection) as ctx:
+            res = self._get_accounts(self.token)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        tables = " ".join(query["sql"] for query in ctx.captured_queries)
+        self.assertNotIn("auth_user", tables)
+        self.assertNotIn("authtoken_token", tables)
+
+    def test_token_user_cannot_be_saved(self):
+        user = SignedTokenAuthentication().build_user(
+            signing.loads(self.token, salt=SIGNED_TOKEN_SALT)
+        )
+
+        with self.assertRaises(NotImplementedError):
+            user.save()
+        with self.assertRaises(NotImplementedError):
+            user.delete()
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password("testpass"))
+
+    def test_create_user_issues_signed_token(self):
+        payload = {"username": "new@boxrepo.com", "password": "testpass"}
+        res = self.client.post(CREATE_USER_URL, payload)
+
+        self.assertIn("signed_token", res.data)
+        res = self._get_accounts(res.data["signed_token"])
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_expired_token_is_rejected(self):
+        issued_at = time.time()
+        with mock.patch("django.core.signing.time.time", return_value=issued_at):
+            token = issue_signed_token(self.user)["signed_token"]
+        later = issued_at + 13 * 60 * 60
+        with mock.patch("django.core.signing.time.time", return_value=later):
+            res = self._get_accounts(token)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_tampered_token_is_rejected(self):
+        res = self._get_accounts(self.token[:-2] + "xx")
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_token_survives_secret_key_rotation(self):
+        with override_settings(SECRET_KEY="old-key"):
+            token = issue_signed_token(self.user)["signed_token"]
+
+        with override_settings(SECRET_KEY="new-key", SECRET_KEY_FALLBACKS=["old-key"]):
+            self.assertEqual(self._get_accounts(token).status_code, status.HTTP_200_OK)
+        with override_settings(SECRET_KEY="new-key", SECRET_KEY_FALLBACKS=[]):
+            self.assertEqual(
+                self._get_accounts(token).status_code, status.HTTP_401_UNAUTHORIZED
+            )
+
+    def test_revoked_token_is_rejected(self):
+        revoke_signed_token(self.token)
+
+        res = self._get_accounts(self.token)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_revocation_outlives_the_cache(self):
+        revoke_signed_token(self.token)
+
+        for shared in (False, True):
+            with self.subTest(shared=shared), override_settings(SHARED_CACHE=shared):
+                # Another worker, or an evicted entry, starts from an empty cache
+                cache.clear()
+                res = self._get_accounts(self.token)
+                self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(SHARED_CACHE=False)
+    def test_local_cache_reads_revocations_every_request(self):
+        self._get_accounts(self.token)
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = self._get_accounts(self.token)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        tables = " ".join(query["sql"] for query in ctx.captured_queries)
+        self.assertIn("user_signedtokenrevocation", tables)
+
+    @override_settings(SHARED_CACHE=True)
+    def test_shared_cache_serves_revocation_checks(self):
+        self._get_accounts(self.token)
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = self._get_accounts(self.token)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        tables = " ".join(query["sql"] for query in ctx.captured_queries)
+        self.assertNotIn("user_signedtokenrevocation", tables)
+
+    def test_deactivating_user_revokes_tokens(self):
+        self.user.is_active = False
+        self.user.save()
+
+        res = self._get_accounts(self.token)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_demoting_staff_revokes_tokens(self):
+        staff = create_user(username="staff@boxrepo.com", is_staff=True)
+        token = issue_signed_token(staff)["signed_token"]
+
+        staff.is_staff = False
+        staff.save()
+
+        res = self._get_accounts(token)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_change_revokes_tokens(self):
+        self.user.set_password("newpass")
+        self.user.save()
+
+        res = self._get_accounts(self.token)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleting_user_revokes_tokens(self):
+        self.user.delete()
+
+        res = self._get_accounts(self.token)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_unrelated_user_changes_keep_tokens(self):
+        self.user.save(update_fields=["last_login"])
+        self.user.first_name = "Test"
+        self.user.save()
+
+        res = self._get_accounts(self.token)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
@@ -14,6 +14,7 @@ from rest_framework.exceptions import APIException
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from user.authentication import API_AUTHENTICATION_CLASSES, issue_signed_token
 from user.serializers import UserSerializer, AccountSerializer, AuthTokenSerializer
 from user.models import Account
 import logging
@@ -28,6 +29,13 @@ class CreateTokenView(ObtainAuthToken):
     serializer_class = AuthTokenSerializer
     renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES
 
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = serializer.validated_data["user"]
+        token, created = Token.objects.get_or_create(user=user)
+        return Response({"token": token.key, **issue_signed_token(user)})
+
 
 class CreateUserView(generics.CreateAPIView):
     """Create a new account"""
@@ -42,6 +50,7 @@ class CreateUserView(generics.CreateAPIView):
             return Response({
                 "token": token.key,
                 "id": user.id,
+                **issue_signed_token(user),
             })
         return res
 
@@ -50,7 +59,7 @@ class AccountViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.Crea
 
     queryset = Account.objects.all()
     serializer_class = AccountSerializer
-    authentication_classes = (TokenAuthentication,)
+    authentication_classes = API_AUTHENTICATION_CLASSES
     permission_classes = (IsAuthenticated,)
 
     def create(self, request, *args, **kwargs):